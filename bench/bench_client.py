@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare the metadata fetcher engines against a local fake peer
+
+usage: bench/bench_client.py [fetches] [size] [engines] [peers] [shards]
+
+Start `peers` (default 1) fake peers serving `fetches` (default 2000) random
+metadata of `size` bytes (default 40000) by BEP 9, then fetch them all from
+every peer with each engine of the comma separated list `engines` (default
+poll,gevent) and print the completed metadata per second and the CPU time
+per fetch of the client process. With `shards` (default 1) greater than 1,
+the hashs are spread over that many clients by torrent.ClientShards.
+"""
+import os
+import sys
+import time
+import socket
+import struct
+import hashlib
+import resource
+import threading
+import SocketServer
+import multiprocessing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from btdht.utils import bencode, _bdecode
+
+
+class FakePeer(SocketServer.BaseRequestHandler):
+    """Answer the handshake then the ut_metadata requests of one connection"""
+
+    def recv(self, size):
+        data = []
+        while size > 0:
+            chunk = self.request.recv(size)
+            if not chunk:
+                raise EOFError()
+            data.append(chunk)
+            size -= len(chunk)
+        return "".join(data)
+
+    def send_ext(self, ext_id, payload):
+        self.request.sendall(struct.pack("!IBB", len(payload) + 2, 20, ext_id) + payload)
+
+    def handle(self):
+        try:
+            msg = self.recv(1 + 19 + 8 + 20 + 20)
+            hash = msg[28:48]
+            metadata = self.server.metadata[hash]
+            self.request.sendall("%sBitTorrent protocol%s%s%s" % (chr(19), "\0\0\0\0\0\x10\0\0", hash, os.urandom(20)))
+            self.send_ext(0, bencode({'m': {'ut_metadata': 1}, 'metadata_size': len(metadata)}))
+            self.request.sendall(struct.pack("!IB", 1, 1)) # unchoke
+            ut_metadata = None
+            while True:
+                length = struct.unpack("!I", self.recv(4))[0]
+                if length == 0:
+                    continue
+                msg = self.recv(length)
+                if ord(msg[0]) != 20:
+                    continue
+                if ord(msg[1]) == 0:
+                    ut_metadata = _bdecode(msg[2:])[0]['m']['ut_metadata']
+                elif ord(msg[1]) == 1 and ut_metadata:
+                    piece = _bdecode(msg[2:])[0]['piece']
+                    data = metadata[piece * 16384:(piece + 1) * 16384]
+                    self.send_ext(ut_metadata, bencode({'msg_type': 1, 'piece': piece, 'total_size': len(metadata)}) + data)
+        except (EOFError, socket.error, KeyError):
+            pass
+
+
+class FakePeerServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+
+def serve(ports, metadata):
+    servers = []
+    for port in ports:
+        server = FakePeerServer(("127.0.0.1", port), FakePeer)
+        server.metadata = metadata
+        servers.append(server)
+    for server in servers[1:]:
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+    servers[0].serve_forever()
+
+
+def bench(engine, ports, hashs, shards=1, timeout=300):
+    import torrent
+    clients = []
+    for i in range(shards):
+        if engine == "gevent":
+            import torrent_gevent
+            clients.append(torrent_gevent.Client(connect_timeout=10))
+        else:
+            clients.append(torrent.Client(connect_timeout=10))
+    client = clients[0] if shards == 1 else torrent.ClientShards(clients)
+    completed = []
+    client.on_metadata.append(completed.append)
+    client.start()
+    cpu = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    for hash in hashs:
+        for port in ports:
+            client.add("127.0.0.1", port, hash)
+    while len(completed) < len(hashs) and time.time() - start < timeout:
+        time.sleep(0.01)
+    duration = time.time() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    client.stoped = True
+    cpu_time = (usage.ru_utime - cpu.ru_utime) + (usage.ru_stime - cpu.ru_stime)
+    return len(completed), duration, cpu_time, client.stats().get("pieces_duplicate")
+
+
+def main():
+    count = int(sys.argv[1]) if sys.argv[1:] else 2000
+    size = int(sys.argv[2]) if sys.argv[2:] else 40000
+    engines = sys.argv[3].split(",") if sys.argv[3:] else ["poll", "gevent"]
+    peers = int(sys.argv[4]) if sys.argv[4:] else 1
+    shards = int(sys.argv[5]) if sys.argv[5:] else 1
+    metadata = {}
+    for i in range(count):
+        data = os.urandom(size)
+        metadata[hashlib.sha1(data).digest()] = data
+    port = 20000 + os.getpid() % 10000
+    ports = range(port, port + peers)
+    server = multiprocessing.Process(target=serve, args=(ports, metadata))
+    server.daemon = True
+    server.start()
+    time.sleep(1)
+    try:
+        for engine in engines:
+            # a new process by engine so they do not share the cpu counters
+            queue = multiprocessing.Queue()
+            p = multiprocessing.Process(target=lambda: queue.put(bench(engine, ports, list(metadata), shards)))
+            p.start()
+            completed, duration, cpu_time, duplicate = queue.get()
+            p.join()
+            print("%-7s %s/%s metadata in %.2fs: %.1f metadata/s, %.3fms cpu/fetch%s" % (
+                engine, completed, count, duration, completed / duration, cpu_time * 1000 / max(completed, 1),
+                ", %s duplicate pieces" % duplicate if duplicate is not None else ""
+            ))
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare the flat and sharded torrents_dir layouts
+
+usage: bench/bench_listdir.py [files] [directory]
+
+Create `files` (default 1000000) empty .torrent files in each layout under
+`directory` (default a temporary directory on the current filesystem), then
+time listing the files, stat'ing random ones and creating new ones.
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import dirindex
+
+
+def populate(path, hashs, sharded):
+    start = time.time()
+    for hash in hashs:
+        open(dirindex.torrent_path(path, hash, sharded, create=sharded), 'w').close()
+    return time.time() - start
+
+
+def bench(path, hashs, sharded, samples=10000):
+    # drop what we can from the dentry cache by listing once first
+    dirindex.list_torrents(path, sharded)
+    start = time.time()
+    listed = dirindex.list_torrents(path, sharded)
+    list_time = time.time() - start
+    assert len(listed) == len(hashs)
+
+    sample = random.sample(hashs, min(samples, len(hashs)))
+    start = time.time()
+    for hash in sample:
+        os.path.isfile(dirindex.torrent_path(path, hash, sharded))
+    stat_time = (time.time() - start) / len(sample)
+
+    new = ["%040x" % random.getrandbits(160) for i in range(len(sample))]
+    start = time.time()
+    for hash in new:
+        open(dirindex.torrent_path(path, hash, sharded, create=sharded), 'w').close()
+    create_time = (time.time() - start) / len(new)
+    return list_time, stat_time, create_time
+
+
+def main():
+    count = int(sys.argv[1]) if sys.argv[1:] else 1000000
+    base = tempfile.mkdtemp(prefix="bench_listdir-", dir=sys.argv[2] if sys.argv[2:] else ".")
+    try:
+        hashs = ["%040x" % random.getrandbits(160) for i in range(count)]
+        for name, sharded in [("flat", False), ("sharded", True)]:
+            path = os.path.join(base, name)
+            os.mkdir(path)
+            populate_time = populate(path, hashs, sharded)
+            list_time, stat_time, create_time = bench(path, hashs, sharded)
+            print("%-8s %s files: populate %.1fs, list %.3fs, stat %.1fus, create %.1fus" % (
+                name, count, populate_time, list_time, stat_time * 1000000, create_time * 1000000
+            ))
+            shutil.rmtree(path)
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare the string and bytearray framing of the peer wire messages
+
+usage: bench/bench_recv.py [metadata_size] [rounds]
+
+Send `rounds` times (default 10) the metadata pieces messages of a
+`metadata_size` bytes (default 4MB) torrent through a socket pair, handle
+them with torrent.Client.recv and with the former string concatenation
+framing, and print the throughput of each.
+"""
+import os
+import sys
+import time
+import errno
+import select
+import socket
+import struct
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from btdht.utils import bencode
+import torrent
+
+
+def stream(metadata_size):
+    """Return the ut_metadata data messages of a `metadata_size` metadata"""
+    msgs = []
+    for piece in range(0, (metadata_size + 16383) // 16384):
+        pl = bencode({'msg_type': 1, 'piece': piece, 'total_size': metadata_size}) + os.urandom(16384)
+        msgs.append(struct.pack("!IBB", 1 + 1 + len(pl), 20, 1) + pl)
+    return "".join(msgs)
+
+
+def string_recv(s, state, handler):
+    """The string based framing torrent.Client.recv used to do"""
+    while True:
+        try:
+            data = s.recv(4096)
+        except socket.error as e:
+            if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                return
+            raise
+        state['toread'] += data
+        while state['toread']:
+            msg = state['toread']
+            msgl = len(msg)
+            if msgl < 4:
+                break
+            msg_len = struct.unpack("!I", msg[:4])[0]
+            if msgl < msg_len + 4:
+                break
+            state['toread'] = msg[4+msg_len:]
+            handler(None, msg[5:4+msg_len])
+
+
+def run(data, rounds, recv):
+    """Send `data` `rounds` times from a child process, return the time taken by `recv` to handle it"""
+    (reader, writer) = socket.socketpair()
+    pid = os.fork()
+    if pid == 0:
+        reader.close()
+        for i in range(rounds):
+            writer.sendall(data)
+        # wait for the reader to be done, EOF is not part of the bench
+        writer.recv(1)
+        os._exit(0)
+    writer.close()
+    reader.setblocking(0)
+    poll = select.poll()
+    poll.register(reader, select.POLLIN)
+    handled = [0]
+    def handler(peer, payload):
+        handled[0] += len(payload) + 5
+    start = time.time()
+    while handled[0] < len(data) * rounds:
+        poll.poll(1000)
+        recv(reader, handler)
+    duration = time.time() - start
+    reader.close()
+    os.waitpid(pid, 0)
+    return duration
+
+
+def main():
+    metadata_size = int(sys.argv[1]) if sys.argv[1:] else 4 * 1024 * 1024
+    rounds = int(sys.argv[2]) if sys.argv[2:] else 10
+    data = stream(metadata_size)
+
+    state = {'toread': ""}
+    string_time = run(data, rounds, lambda s, handler: string_recv(s, state, handler))
+
+    client = torrent.Client()
+    peers = {}
+    def buffer_recv(s, handler):
+        if not s in peers:
+            client._handlers[20] = handler
+            peers[s] = torrent.Peer(s, "127.0.0.1", 6881, "\0" * 20)
+            peers[s].handshake = True
+        client.recv(peers[s])
+    buffer_time = run(data, rounds, buffer_recv)
+
+    for name, duration in [("string", string_time), ("bytearray", buffer_time)]:
+        print("%-9s %.1f MB/s" % (name, len(data) * rounds / duration / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare the update_hash write paths on a local MySQL/MariaDB
+
+usage: bench/bench_update_hash.py [rows] [existing rows]
+
+It uses the db of config.py, where sql/staging.sql must have been loaded,
+and creates (then drops) the bench_torrents and bench_torrents_dht_staging
+tables. While writing, a reader thread query bench_torrents in loop, its
+worst latency shows how long the table stays locked.
+"""
+import os
+import sys
+import time
+import threading
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import MySQLdb
+import config
+import dbwriter
+
+
+class Reader(threading.Thread):
+    def __init__(self):
+        super(Reader, self).__init__()
+        self.daemon = True
+        self.stoped = False
+        self.latencies = []
+
+    def run(self):
+        db = MySQLdb.connect(**config.mysql)
+        cur = db.cursor()
+        while not self.stoped:
+            start = time.time()
+            cur.execute("SELECT COUNT(*) FROM bench_torrents WHERE dht_last_get IS NOT NULL")
+            cur.fetchall()
+            self.latencies.append(time.time() - start)
+            time.sleep(0.01)
+        db.close()
+
+
+def setup(cur, existing):
+    cur.execute("DROP TABLE IF EXISTS bench_torrents, bench_torrents_dht_staging")
+    cur.execute("CREATE TABLE bench_torrents LIKE torrents")
+    cur.execute("ALTER TABLE bench_torrents ENGINE=MyISAM")
+    cur.execute("CREATE TABLE bench_torrents_dht_staging LIKE torrents_dht_staging")
+    writer = dbwriter.HashUpdateWriter(config.mysql)
+    writer.table = "bench_torrents"
+    for i in range(0, len(existing), 5000):
+        writer.write(cur, "get", existing[i:i+5000])
+
+
+def run(name, writer, hashs, merge=False):
+    writer.table = "bench_torrents"
+    writer.staging_table = "bench_torrents_dht_staging"
+    reader = Reader()
+    reader.start()
+    start = time.time()
+    writer.start()
+    # the crawler flush its pending hashs every 60s, flush here by 20000
+    for i in range(0, len(hashs), 20000):
+        writer.put("get" if i % 40000 else "announce", hashs[i:i+20000])
+    writer.stop(timeout=None)
+    write_time = time.time() - start
+    merge_time = 0
+    if merge:
+        db = MySQLdb.connect(**config.mysql)
+        start = time.time()
+        writer.merge(db)
+        merge_time = time.time() - start
+        db.close()
+    reader.stoped = True
+    reader.join()
+    total = write_time + merge_time
+    print("%-8s %8.2fs write %8.2fs merge %10.0f rows/s  reader max %.3fs, avg %.3fs" % (
+        name, write_time, merge_time, len(hashs) / total,
+        max(reader.latencies or [0]), sum(reader.latencies or [0]) / max(1, len(reader.latencies))
+    ))
+
+
+def main():
+    rows = int(sys.argv[1]) if sys.argv[1:] else 200000
+    existing = int(sys.argv[2]) if sys.argv[2:] else 1000000
+    db = MySQLdb.connect(**config.mysql)
+    cur = db.cursor()
+    try:
+        existing = [os.urandom(20) for i in range(existing)]
+        print("creating bench tables with %s rows" % len(existing))
+        setup(cur, existing)
+        db.commit()
+        # half updates of existing hashs, half new hashs
+        hashs = existing[:rows // 2] + [os.urandom(20) for i in range(rows - rows // 2)]
+        run("upsert", dbwriter.HashUpdateWriter(config.mysql), hashs)
+        run("staging", dbwriter.HashStagingWriter(config.mysql, merge_interval=3600), hashs, merge=True)
+        # needs local_infile to be enabled on the server
+        run("infile", dbwriter.HashInfileWriter(config.mysql, merge_interval=3600), hashs, merge=True)
+    finally:
+        cur.execute("DROP TABLE IF EXISTS bench_torrents, bench_torrents_dht_staging")
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
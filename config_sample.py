@@ -21,6 +21,32 @@ crawler_base_port = 12345
 # the instance number instead
 crawler_worker = 1
 
+# engine used to download torrents metadata from the peers:
+#  * "poll": torrent.Client, one epoll thread
+#  * "gevent": torrent_gevent.Client, one greenlet by peer connection,
+#    needs the python gevent module
+crawler_client_engine = "poll"
+# number of metadata clients, each with its own receive loop thread, the
+# info_hashs are spread over them and client_max_connections is split
+# between them
+client_shards = 1
+# at most client_max_connections sockets are opened to download metadata,
+# keep it under the open files limit (4096, set by crawler.py). Others peers
+# are queued, the ones which announced the hash first.
+client_max_connections = 3000
+# at most client_max_peers_per_hash connections are opened to download the
+# metadata of a hash. Its pieces are spread over them, at most
+# client_max_requests_per_peer at once by peer, a piece not received after
+# client_piece_timeout seconds is requested to another peer
+client_max_peers_per_hash = 8
+client_max_requests_per_peer = 4
+client_piece_timeout = 10
+# outcome of the last peer_reputation_size peers connected to. Peers failing
+# to connect or to send metadata are not tried again for any hash during
+# peer_reputation_ttl seconds, peers which sent metadata are tried first
+peer_reputation_size = 200000
+peer_reputation_ttl = 3600
+
 # power of 2 if the number of dht instance de lauch by worker
 # while crawling: 4 is for 2^4=16 instances
 crawler_instance = 3  # 8 instances
@@ -28,14 +54,84 @@ crawler_instance = 3  # 8 instances
 # max resident memory in byte
 crawler_max_memory = 8 * 1024 * 1024 * 1024 # 8GB
 
+# the crawler keep a bloom filter of the hashs already in the db
+# so that unknown hashs do not need a db query. Set capacity to a
+# bit more than the number of torrents in your db. The filter use
+# about 1.8 byte by hash with an error rate of 0.001
+# set hash_filter_capacity to 0 to disable the filter
+hash_filter_capacity = 20000000
+hash_filter_error_rate = 0.001
+# the filter only learns the hashs fetched by this process: it is rebuilt
+# from the db every hash_filter_rebuild_interval seconds to see the ones
+# added by others crawlers or feed.py. Until then they may be fetched again
+hash_filter_rebuild_interval = 3600
+
+# file of the sorted known hashs, memory mapped by every crawler
+# process so they share one copy of it. It is rebuilt from the db
+# every hash_index_rebuild_interval seconds, in the background when the
+# file is missing at startup. The hashs it misses and the bloom filter above
+# does not rule out are checked in the db. Set to None to disable
+hash_index_file = "known_hashs.idx"
+hash_index_rebuild_interval = 3600
+
+# max number of hashs remembered as not in the db (for 10 minutes)
+# by each crawler process. about 100 bytes by hash
+hash_negative_cache_size = 2000000
+
+# unknown hashs are looked up in the db by batches: how long
+# in seconds to wait for more hashs before querying the db
+hash_lookup_delay = 0.005
+# at most hash_lookup_max_pending hashs wait for the db, others are
+# skipped while the db is lagging or down
+hash_lookup_max_pending = 100000
+
+# max number of rows by INSERT statement when writing the dht
+# get/announce dates of the crawled hashs. Each row is about 60
+# bytes, keep chunk_size * 60 under mysql max_allowed_packet
+update_hash_chunk_size = 5000
+# at most update_hash_max_pending rows wait to be written, the oldest are
+# dropped past it while the db is down or lagging
+update_hash_max_pending = 1000000
+
+# how the crawler write the dht get/announce dates of the hashs:
+#  * "upsert": INSERT ... ON DUPLICATE KEY UPDATE into the torrents table
+#  * "staging": INSERT into the torrents_dht_staging table (see sql/staging.sql)
+#    merged into the torrents table every staging_merge_interval seconds
+#  * "infile": like "staging" but using LOAD DATA LOCAL INFILE, the mysql
+#    server must allow local_infile
+update_hash_mode = "upsert"
+staging_merge_interval = 20
+
 # where to write torrents retreived from dht or torcache
 torrents_dir = "torrents/"
+# the content of torrents_dir is kept in memory by crawler.py and
+# feed.py, and listed again every torrents_dir_refresh_interval seconds
+torrents_dir_refresh_interval = 60
+# downloaded metadata are written to torrents_dir by a dedicated thread, by
+# batches of at most torrents_write_batch_size files, waiting
+# torrents_write_batch_delay seconds for a batch to fill
+torrents_write_batch_size = 100
+torrents_write_batch_delay = 0.1
 # where to move processed torrents
 torrents_done = "torrents_done/"
 # where to archive torrent. The script will create
 # one subdirectory by day in this directory
 torrents_archive = "torrents_archives/"
 
+# If True, archived torrents are appended to one pack file by day in
+# torrents_archive (YYYY-MM-DD.pack and its index YYYY-MM-DD.idx, see pack.py)
+# instead of one file by torrent in a YYYY-MM-DD directory.
+# Each torrent in the pack can be compressed: None, "zlib" or "zstd" (needs
+# the python zstd module)
+torrents_archive_packed = False
+torrents_archive_compression = "zlib"
+
+# If True, torrents_dir, torrents_done and the daily archive directories
+# use a sharded layout: the torrent abcdef... is stored in ab/cd/abcdef....torrent
+# which keep the directories small. Use migrate_layout.py to move existing
+# files from one layout to the other
+torrents_sharded = False
+
 # If the torrent has successfully been uploaded to torcache
 # the liste of pieces will be removed in the torrent file
 # before archiving. It allow to keep all the interesting
@@ -73,6 +169,28 @@ scrape_interval = 60 # in minute, set 0 to disable scraping
 # something like num_torrents / (scrape_interval / 5)
 # Set to None to scrape all torrents that need to be scraped
 scape_limit = 250000 # set to None to disable
+# torrents to scrape are read by pages while scraping, at most
+# scrape_queue_size batchs of 50 hashs are read ahead or being scraped
+scrape_queue_size = 200
+# trackers to scrape, udp or http announce urls, or (url, rate, in_flight)
+# tuples to override scrape_tracker_rate and scrape_tracker_in_flight
+scrape_trackers = [
+    "udp://open.demonii.com:1337/announce",
+]
+# each batch of hashs is scraped on the scrape_tracker_fanout healthiest
+# trackers, keeping the max of the seeders, leechers and downloads. With 1,
+# the batchs are spread over the trackers.
+scrape_tracker_fanout = 1
+# at most scrape_tracker_rate requests by second and scrape_tracker_in_flight
+# requests waiting for a response by tracker
+scrape_tracker_rate = 20
+scrape_tracker_in_flight = 100
+# udp trackers are scraped through one socket, a request not answered is
+# sent again after scrape_udp_timeout seconds, doubled on each try
+scrape_udp_timeout = 2
+# scrape results are written to the db by one connection, by multi-row
+# upserts of scrape_write_chunk_size rows
+scrape_write_chunk_size = 1000
 
 # if True generate a description from the torrent files list
 # if False, set it to NULL
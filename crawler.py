@@ -7,6 +7,7 @@ import psutil
 import socket
 import struct
 import MySQLdb
+import itertools
 import collections
 import multiprocessing
 import threading
@@ -17,10 +18,23 @@ from btdht.utils import enumerate_ids
 import config
 import resource
 import torrent
+import hashindex
+import dbwriter
+import scheduler
+import dirindex
 
 class HashToIgnore(object):
     hash_to_ignore = set()
-    hash_not_to_ignore = collections.defaultdict(int)
+    # hashs recently checked not to be in the db
+    hash_not_to_ignore = hashindex.NegativeCache(config.hash_negative_cache_size, ttl=600)
+    # bloom filter of the known hashs, None until load_filter has completed
+    filter = None
+    # time the db was read to build filter, it is rebuilt every hash_filter_rebuild_interval
+    filter_built = 0
+    # shared memory mapped index of the known hashs, see reload_index
+    index = None
+    # HashLookup used by check to query the db without blocking
+    lookup = None
     _db = collections.defaultdict(lambda:MySQLdb.connect(**config.mysql))
 
     # One db connection by thread
@@ -48,26 +62,87 @@ class HashToIgnore(object):
         self.db.cursor().execute("SET SESSION TRANSACTION ISOLATION LEVEL READ UNCOMMITTED")
         
 
+    def load_filter(self, debug=None):
+        """Build the bloom filter of known hashs from the db"""
+        if debug:
+            debug("Loading known hashs filter")
+        started = time.time()
+        bloom = hashindex.load_bloom_filter(config.mysql, config.hash_filter_capacity, config.hash_filter_error_rate)
+        # hashs added while the filter was loading
+        for item in list(self.hash_to_ignore):
+            bloom.add(item)
+        HashToIgnore.filter = bloom
+        HashToIgnore.filter_built = started
+        if debug:
+            debug("Known hashs filter loaded: %s hashs, %s bytes" % (len(bloom), bloom.size))
+
+    def reload_index(self):
+        """Map the shared known hashs index, or remap it if it has been rebuilt
+
+        Once the index is mapped, hash_to_ignore only keep the hashs added
+        since the last index build.
+        """
+        if not config.hash_index_file:
+            return False
+        if self.index is None:
+            HashToIgnore.index = hashindex.HashIndex(config.hash_index_file)
+            remapped = self.index.loaded
+        else:
+            remapped = self.index.reload()
+        if remapped:
+            for item in list(self.hash_to_ignore):
+                if item in self.index:
+                    self.hash_to_ignore.discard(item)
+        return remapped
+
     def add(self, item):
         self.hash_to_ignore.add(item)
-        try:
-            del self.hash_not_to_ignore[item]
-        except KeyError:
-            pass
+        if self.filter is not None:
+            self.filter.add(item)
+        self.hash_not_to_ignore.discard(item)
+
+    def known(self, item):
+        """Return True or False if we know without querying the db if item is to ignore, None otherwise"""
+        if item in self.hash_to_ignore:
+            return True
+        # the index misses the hashs added since its last build, the filter
+        # rules out most of the others without asking the db
+        if self.index is not None and item in self.index:
+            return True
+        if self.filter is not None and not item in self.filter:
+            return False
+        if item in self.hash_not_to_ignore:
+            return False
+        return None
+
+    def check(self, item, callback, run=None):
+        """Call callback(is_to_ignore) without blocking on the db
+
+        If the answer is known locally, callback is called immediately, otherwise
+        it will be called by run(callback, is_to_ignore) from the lookup thread
+        once the db has been queried.
+        """
+        is_known = self.known(item)
+        if is_known is None and self.lookup is not None:
+            self.lookup.lookup(item, callback, run)
+        else:
+            callback(item in self if is_known is None else is_known)
 
     def __contains__(self, item, errno=0):
         if not item in self.hash_to_ignore:
-            if time.time() - self.hash_not_to_ignore[item] > 600:
+            if self.index is not None and item in self.index:
+                return True
+            # negative answers of the filter are at most hash_filter_rebuild_interval old
+            if self.filter is not None and not item in self.filter:
+                return False
+            if not item in self.hash_not_to_ignore:
                 try:
                     if self.db.cursor().execute("select (1) from torrents where hash=%s AND created_at IS NOT NULL limit 1", (item.encode("hex"),)):
                         self.hash_to_ignore.add(item)
-                        try:
-                            del self.hash_not_to_ignore[item]
-                        except KeyError:
-                            pass
+                        self.hash_not_to_ignore.discard(item)
                         return True
                     else:
-                        self.hash_not_to_ignore[item] = time.time()
+                        self.hash_not_to_ignore.add(item)
                         return False
                 except (MySQLdb.Error,) as e:
                     if errno > 5:
@@ -81,19 +156,176 @@ class HashToIgnore(object):
         else:
             return True
 
+class HashLookup(object):
+    """Query the db for unknown hashs by batches, in a dedicated thread
+
+    Hashs are collected for `delay` seconds and resolved with a single query.
+    Concurrent lookups of the same hash share the same pending query. At most
+    `max_pending` hashs wait for the db, the lookups of others and of the
+    batches failing `max_retry` times in a row are dropped unanswered: the
+    hash is skipped until the dht brings it again.
+    """
+
+    def __init__(self, hash_to_ignore, delay=0.005, max_batch=500, max_pending=100000, max_retry=5, debug=None):
+        self.hash_to_ignore = hash_to_ignore
+        self.delay = delay
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.max_retry = max_retry
+        self.debug = debug
+        self.db = None
+        self.lookups_dropped = 0
+        self._pending = collections.OrderedDict() # hash -> (callback, run) list
+        self._lock = Lock()
+        self._event = threading.Event()
+        self.stoped = True
+        self.threads = []
+
+    def start(self):
+        self.stoped = False
+        t = Thread(target=self._loop)
+        t.setName("HashLookup:loop")
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
+
+    def stop(self):
+        self.stoped = True
+        self._event.set()
+
+    def lookup(self, item, callback, run=None):
+        """Call callback(is_to_ignore) once the db has been queried, by run(callback, is_to_ignore) if given
+
+        If max_pending hashs already wait for the db, the lookup is dropped
+        and callback is never called.
+        """
+        with self._lock:
+            if item in self._pending:
+                self._pending[item].append((callback, run))
+                return
+            if len(self._pending) >= self.max_pending:
+                # the db is lagging or down, skip the hash
+                self.lookups_dropped += 1
+                return
+            self._pending[item] = [(callback, run)]
+        self._event.set()
+
+    def pending(self):
+        return len(self._pending)
+
+    def _answer(self, hashs, known):
+        for item in hashs:
+            with self._lock:
+                callbacks = self._pending.pop(item, [])
+            for (callback, run) in callbacks:
+                try:
+                    if run is not None:
+                        run(callback, item in known)
+                    else:
+                        callback(item in known)
+                except Exception as e:
+                    if self.debug:
+                        self.debug("%r" % e)
+
+    def _query(self, hashs):
+        if self.db is None:
+            self.db = MySQLdb.connect(**config.mysql)
+            self.db.cursor().execute("SET SESSION TRANSACTION ISOLATION LEVEL READ UNCOMMITTED")
+        cur = self.db.cursor()
+        try:
+            cur.execute("SELECT hash FROM torrents WHERE created_at IS NOT NULL AND hash IN (%s)" % ", ".join("%s" for h in hashs), [h.encode("hex") for h in hashs])
+            return set(r[0].lower().decode("hex") for r in cur)
+        finally:
+            cur.close()
+
+    def _loop(self):
+        errno = 0
+        while True:
+            self._event.wait(1)
+            if self.stoped:
+                try:self.db.close()
+                except:pass
+                return
+            # let some more hashs come in
+            time.sleep(self.delay)
+            with self._lock:
+                hashs = list(itertools.islice(self._pending, self.max_batch))
+                if len(hashs) >= len(self._pending):
+                    self._event.clear()
+            if not hashs:
+                continue
+            try:
+                known = self._query(hashs)
+                errno = 0
+            except (MySQLdb.Error, ) as e:
+                if self.debug:
+                    self.debug("%r" % e)
+                try:self.db.close()
+                except:pass
+                self.db = None
+                errno += 1
+                if errno >= self.max_retry:
+                    with self._lock:
+                        for item in hashs:
+                            self.lookups_dropped += len(self._pending.pop(item, []))
+                time.sleep(min(0.1 * errno, 10))
+                self._event.set()
+                continue
+            for item in hashs:
+                if item in known:
+                    self.hash_to_ignore.add(item)
+                else:
+                    self.hash_to_ignore.hash_not_to_ignore.add(item)
+            self._answer(hashs, known)
+
+
 class Crawler(DHT):
     def __init__(self, *args, **kwargs):
         super(Crawler, self).__init__(*args, **kwargs)
         if self.master:
-            self.root.client = torrent.Client(debug=self.debuglvl>0)
+            self.root.reputation = scheduler.PeerReputation(config.peer_reputation_size, config.peer_reputation_ttl)
+            # the info_hashs are spread over client_shards clients
+            shards = max(config.client_shards, 1)
+            clients = []
+            for i in range(shards):
+                if config.crawler_client_engine == "gevent":
+                    import torrent_gevent
+                    clients.append(torrent_gevent.Client(
+                        debug=self.debuglvl>0,
+                        reputation=self.root.reputation,
+                        max_connections=config.client_max_connections // shards,
+                        max_peers_per_hash=config.client_max_peers_per_hash,
+                        max_requests_per_peer=config.client_max_requests_per_peer,
+                        piece_timeout=config.client_piece_timeout
+                    ))
+                else:
+                    clients.append(torrent.Client(
+                        debug=self.debuglvl>0,
+                        reputation=self.root.reputation,
+                        max_connections=config.client_max_connections // shards,
+                        max_peers_per_hash=config.client_max_peers_per_hash,
+                        max_requests_per_peer=config.client_max_requests_per_peer,
+                        piece_timeout=config.client_piece_timeout
+                    ))
+            self.root.client = clients[0] if len(clients) == 1 else torrent.ClientShards(clients)
         self.db = None
         self.register_message("get_peers")
         self.register_message("announce_peer")
 
     def stop(self):
-        self.update_hash(None, None)
         if self.master:
+            self.update_hash(None, None)
             self.root.client.stoped = True
+            self.root.hash_to_ignore.lookup.stop()
+            self.root.hash_writer.stop()
+            self.root.torrent_writer.stop()
+            self.root.torrents_dir.stop()
+        try: self.root.client.on_metadata.remove(self.fetch.complete)
+        except (AttributeError, ValueError): pass
+        try:
+            self.root.torrent_writer.on_written.remove(self._metadata_written)
+            self.root.torrent_writer.on_failed.remove(self._metadata_write_failed)
+        except (AttributeError, ValueError): pass
         super(Crawler, self).stop()
         if self.db:
             try:self.db.close()
@@ -104,14 +336,26 @@ class Crawler(DHT):
         # doing some initialisation
         if self.master:
             self.root.hash_to_ignore = HashToIgnore()
+            self.root.hash_to_ignore.lookup = HashLookup(self.root.hash_to_ignore, delay=config.hash_lookup_delay, max_pending=config.hash_lookup_max_pending, debug=lambda msg:self.debug(0, msg))
+            self.root.hash_to_ignore.reload_index()
+            self.root.last_reload_index = time.time()
+            self.root.load_filter_thread = None
+            self.schedule_load_filter()
             self.root.update_hash = set()
             self.root.update_hash_lock = Lock()
+            self.root.hash_writer = dbwriter.hash_update_writer(config.update_hash_mode, config.mysql, chunk_size=config.update_hash_chunk_size, max_pending=config.update_hash_max_pending, merge_interval=config.staging_merge_interval, debug=lambda msg:self.debug(0, msg))
             self.root.bad_info_hash = {}
             self.root.good_info_hash = {}
             self.root.last_update_hash = 0
-        self.hash_to_fetch = collections.OrderedDict()
-        self.hash_to_fetch_tried = collections.defaultdict(set)
-        self.hash_to_fetch_totry = collections.defaultdict(set)
+            self.root.torrents_dir = dirindex.TorrentsDir(config.torrents_dir, refresh_interval=config.torrents_dir_refresh_interval, sharded=config.torrents_sharded)
+            self.root.torrents_dir.refresh()
+            self.root.torrent_writer = dirindex.TorrentWriter(self.root.torrents_dir, batch_size=config.torrents_write_batch_size, batch_delay=config.torrents_write_batch_delay, debug=lambda msg:self.debug(0, msg))
+            self.root.torrent_writer.on_written.append(lambda hash: self.debug(1, "%s downloaded" % hash.encode("hex")))
+            self.root.client.metadata_writer = self.root.torrent_writer
+        self.fetch = scheduler.FetchScheduler()
+        self.root.client.on_metadata.append(self.fetch.complete)
+        self.root.torrent_writer.on_written.append(self._metadata_written)
+        self.root.torrent_writer.on_failed.append(self._metadata_write_failed)
 
         # calling parent method
         super(Crawler, self).start()
@@ -129,64 +373,118 @@ class Crawler(DHT):
             self.root.client.start()
             self._threads.extend(self.root.client.threads)
             self.threads.extend(self.root.client.threads)
+            self.root.hash_to_ignore.lookup.start()
+            self._threads.extend(self.root.hash_to_ignore.lookup.threads)
+            self.threads.extend(self.root.hash_to_ignore.lookup.threads)
+            self.root.hash_writer.start()
+            self._threads.extend(self.root.hash_writer.threads)
+            self.threads.extend(self.root.hash_writer.threads)
+            self.root.torrents_dir.start()
+            self._threads.extend(self.root.torrents_dir.threads)
+            self.threads.extend(self.root.torrents_dir.threads)
+            self.root.torrent_writer.start()
+            self._threads.extend(self.root.torrent_writer.threads)
+            self.threads.extend(self.root.torrent_writer.threads)
 
     def _client_loop(self):
-        failed_count = collections.defaultdict(int)
-        last_fail = collections.defaultdict(int)
         while True:
-            processed = False
-            for hash in self.hash_to_fetch.keys():
-                if self.stoped:
-                    return
-                if hash in self.root.client.meta_data or os.path.isfile("%s/%s.torrent" % (config.torrents_dir, hash.encode("hex"))):
-                    if hash in self.root.client.meta_data and self.root.client.meta_data[hash] is not True:
-                        with open("%s/%s.torrent.new" % (config.torrents_dir, hash.encode("hex")), 'wb') as f:
-                            f.write("d4:info%se" % self.root.client.meta_data[hash])
-                        os.rename("%s/%s.torrent.new" % (config.torrents_dir, hash.encode("hex")), "%s/%s.torrent" % (config.torrents_dir, hash.encode("hex"))) 
-                        self.debug(1, "%s downloaded" % hash.encode("hex"))
-                    self.root.client.meta_data[hash] = True
-                    self.root.client.clean_hash(hash)
-                    self.root.hash_to_ignore.add(hash)
-                    try: del self.hash_to_fetch[hash]
-                    except: pass
-                    try: del self.hash_to_fetch_tried[hash]
-                    except: pass
-                    try: del self.hash_to_fetch_totry[hash]
-                    except: pass
-                    del self.root.client.meta_data[hash]
-                else:
-                    self.get_peers(hash, block=False, limit=1000)
-                    if time.time() - last_fail[hash] > 10:
-                        try:
-                            (ip, port) = self.hash_to_fetch_totry[hash].pop()
-                            self.hash_to_fetch_tried[hash].add((ip, port))
-                            self.root.client.add(ip, port, hash)
-                            processed = True
-                        except KeyError:
-                            last_fail[hash]=time.time()
-                            failed_count[hash]+=1
-                        if failed_count[hash] >= 18:
-                            self.root.client.meta_data[hash] = True
-                            self.root.client.clean_hash(hash)
-                            self.root.good_info_hash[hash]=time.time()
-                            try: del self.hash_to_fetch[hash]
-                            except: pass
-                            try: del self.hash_to_fetch_tried[hash]
-                            except: pass
-                            try: del self.hash_to_fetch_totry[hash]
-                            except: pass
-                            self.debug(1, "%s failed" % hash.encode("hex"))
-                            del failed_count[hash]
-                            del self.root.client.meta_data[hash]
-            if not processed:
-                self.sleep(10)
-                
+            if self.stoped:
+                return
+            item = self.fetch.pop(timeout=1)
+            if item is None:
+                continue
+            (kind, value) = item
+            if kind == "complete":
+                self._fetch_attempt(self.fetch.get(value))
+            elif kind == "call":
+                # hash_to_ignore lookups answered by the db
+                (function, args) = value
+                try:
+                    function(*args)
+                except Exception as e:
+                    self.debug(0, "%r" % e)
+            else:
+                self._fetch_attempt(value)
+
+    def _fetch_done(self, hash):
+        self.root.client.meta_data[hash] = True
+        self.root.client.clean_hash(hash)
+        self.fetch.remove(hash)
+        try: del self.root.client.meta_data[hash]
+        except KeyError: pass
+
+    def _metadata_written(self, hash):
+        """Called by root.torrent_writer once the metadata of `hash` is on disk"""
+        self.root.hash_to_ignore.add(hash)
+        if hash in self.fetch:
+            self.fetch.call(self._fetch_done, hash)
+
+    def _metadata_write_failed(self, hash):
+        """Called by root.torrent_writer if the metadata of `hash` could not be written, fetch it again"""
+        self.root.client.meta_data.pop(hash, None)
+        if hash in self.fetch:
+            self.fetch.schedule(hash, time.time() + 10)
+
+    def _fetch_attempt(self, state):
+        if state is None:
+            return
+        hash = state.hash
+        if hash.encode("hex") in self.root.torrents_dir:
+            self.root.hash_to_ignore.add(hash)
+            self._fetch_done(hash)
+            return
+        if hash in self.root.client.meta_data:
+            # the client handed the metadata to root.torrent_writer, wait for
+            # _metadata_written or _metadata_write_failed
+            return
+        if state.has_peers() and self.root.client.peers_count(hash) >= self.root.client.max_peers_per_hash:
+            # enough peers are downloading the metadata, wait for some to complete or fail
+            self.fetch.schedule(hash, time.time() + 1)
+            return
+        try:
+            ((ip, port), priority) = self.fetch.pop_peer(state, self.root.reputation)
+            self.root.client.add(ip, port, hash, priority)
+            # other due hashs are scheduled before this one
+            self.fetch.schedule(hash, time.time())
+        except KeyError:
+            state.last_fail = time.time()
+            state.failed_count += 1
+            if state.failed_count >= 18:
+                self.root.good_info_hash[hash]=time.time()
+                self.debug(1, "%s failed" % hash.encode("hex"))
+                self._fetch_done(hash)
+            else:
+                self.get_peers(hash, block=False, limit=1000)
+                self.fetch.schedule(hash, state.last_fail + 10)
+
     def clean(self):
         if self.master:
             now = time.time()
             if now - self.root.last_update_hash > 60:
                 self.update_hash(None, None)
                 self.root.last_update_hash = now
+            if now - self.root.last_reload_index > 60:
+                if self.root.hash_to_ignore.reload_index():
+                    self.debug(0, "Known hashs index reloaded: %s hashs" % len(self.root.hash_to_ignore.index))
+                self.root.last_reload_index = now
+            self.schedule_load_filter()
+
+    def schedule_load_filter(self):
+        """Load the known hashs filter in a thread if it is missing or older than hash_filter_rebuild_interval
+
+        The filter only learns the hashs fetched by this process, rebuilding it
+        from the db picks up the ones added by others crawlers or by feed.py.
+        """
+        if config.hash_filter_capacity <= 0:
+            return
+        if self.root.load_filter_thread is not None and self.root.load_filter_thread.is_alive():
+            return
+        if HashToIgnore.filter is None or time.time() - HashToIgnore.filter_built > config.hash_filter_rebuild_interval:
+            t = Thread(target=self.root.hash_to_ignore.load_filter, args=(lambda msg:self.debug(0, msg),))
+            t.setName("%s:load_filter" % self.prefix)
+            t.daemon = True
+            t.start()
+            self.root.load_filter_thread = t
 
     def clean_long(self):
         if self.master:
@@ -206,6 +504,13 @@ class Crawler(DHT):
                 except KeyError:
                     pass
 
+            self.debug(0, "Hash update writer: %(pending)s pending, %(rows_written)s written, %(rows_dropped)s dropped, %(chunks_retried)s retried, %(rows_per_sec).1f rows/s, %(flush_latency).3fs last flush" % self.root.hash_writer.stats())
+            self.debug(0, "Hash lookup: %s pending, %s dropped" % (self.root.hash_to_ignore.lookup.pending(), self.root.hash_to_ignore.lookup.lookups_dropped))
+            self.debug(0, "Negative hash cache: %(size)s hashs, %(hits)s hits, %(misses)s misses, %(evictions)s evictions, %(expired)s expired" % self.root.hash_to_ignore.hash_not_to_ignore.stats())
+            self.debug(0, "Torrent writer: %(pending)s pending, %(max_queue_depth)s max queued, %(written)s written, %(failed)s failed, %(batches)s batches, %(batch_latency).3fs last batch, %(write_latency).3fs last write latency" % self.root.torrent_writer.stats())
+            self.debug(0, "Metadata client: %s" % ", ".join("%s %s" % item for item in sorted(self.root.client.stats().items())))
+            self.debug(0, "Peer reputation: %(peers)s peers, %(good)s good, %(bad)s bad, %(skipped)s skipped" % self.root.reputation.stats())
+
             # Actualising hash to ignore
             #self.root.hash_to_ignore = self.get_hash_to_ignore()
             self.save(max_node=4000)
@@ -215,36 +520,63 @@ class Crawler(DHT):
         if response.get("values"):
             info_hash = query.get("info_hash")
             if info_hash:
-                if not info_hash in self.hash_to_fetch and not info_hash in self.root.hash_to_ignore:
-                    self.hash_to_fetch[info_hash]=time.time()
-                    #self.root.good_info_hash[info_hash]=time.time()
-                    try: del self.root.bad_info_hash[info_hash]
-                    except KeyError: pass
-                self.update_hash(info_hash, get=False)
-                if info_hash in self.hash_to_fetch:
-                    for ipport in response.get("values", []):
-                        (ip, port) = struct.unpack("!4sH", ipport)
-                        ip = socket.inet_ntoa(ip)
-                        if not (ip, port) in self.hash_to_fetch_tried[info_hash]:
-                            self.hash_to_fetch_totry[info_hash].add((ip, port))
+                if info_hash in self.fetch:
+                    self._on_get_peers_response(info_hash, response, False)
+                else:
+                    self.root.hash_to_ignore.check(info_hash, lambda known: self._on_get_peers_response(info_hash, response, known), self.fetch.call)
+
+    def _on_get_peers_response(self, info_hash, response, known):
+        if known:
+            return
+        if self.fetch.add(info_hash):
+            #self.root.good_info_hash[info_hash]=time.time()
+            try: del self.root.bad_info_hash[info_hash]
+            except KeyError: pass
+        self.update_hash(info_hash, get=False)
+        peers = []
+        for ipport in response.get("values", []):
+            (ip, port) = struct.unpack("!4sH", ipport)
+            peers.append((socket.inet_ntoa(ip), port))
+        self.fetch.add_peers(info_hash, peers)
 
     def on_get_peers_query(self, query):
         info_hash = query.get("info_hash")
         if info_hash:
-            if info_hash in self.root.good_info_hash and not info_hash in self.root.hash_to_ignore:
-                self.update_hash(info_hash, get=True)
-            elif not info_hash in self.root.bad_info_hash and not info_hash in self.root.good_info_hash and not info_hash in self.root.hash_to_ignore and not info_hash in self.hash_to_fetch:
-                self.determine_info_hash(info_hash)
+            if not info_hash in self.root.good_info_hash and (info_hash in self.root.bad_info_hash or info_hash in self.fetch):
+                return
+            self.root.hash_to_ignore.check(info_hash, lambda known: self._on_get_peers_query(info_hash, known), self.fetch.call)
+
+    def _on_get_peers_query(self, info_hash, known):
+        if known:
+            return
+        if info_hash in self.root.good_info_hash:
+            self.update_hash(info_hash, get=True)
+        elif not info_hash in self.root.bad_info_hash and not info_hash in self.fetch:
+            self.determine_info_hash(info_hash)
 
     def on_announce_peer_query(self, query):
         info_hash = query.get("info_hash")
         if info_hash:
-            if info_hash not in self.root.hash_to_ignore:
-                self.hash_to_fetch[info_hash]=time.time()
             self.root.good_info_hash[info_hash]=time.time()
             try: del self.root.bad_info_hash[info_hash]
             except KeyError: pass
-            self.update_hash(info_hash, get=False)
+            # the announcing peer has the torrent, it is the best one to ask for the metadata
+            try:
+                (ip, port) = query.addr
+                if not query.get("implied_port", 0):
+                    port = query["port"]
+                peer = (ip, port)
+            except (AttributeError, KeyError, TypeError, ValueError):
+                peer = None
+            self.root.hash_to_ignore.check(info_hash, lambda known: self._on_announce_peer_query(info_hash, known, peer), self.fetch.call)
+
+    def _on_announce_peer_query(self, info_hash, known, peer=None):
+        if known:
+            return
+        self.fetch.add(info_hash)
+        if peer is not None:
+            self.fetch.add_peers(info_hash, [peer], announced=True)
+        self.update_hash(info_hash, get=False)
 
     def get_hash_to_ignore(self, errornb=0):
         db = MySQLdb.connect(**config.mysql)
@@ -268,8 +600,8 @@ class Crawler(DHT):
             return self.get_hash_to_ignore(errornb=1+errornb)
         
 
-    def update_hash(self, info_hash, get, errornb=0):
-        if info_hash is not None and info_hash in self.root.hash_to_ignore:
+    def update_hash(self, info_hash, get):
+        if info_hash is not None and self.root.hash_to_ignore.known(info_hash):
             return
         with self.root.update_hash_lock:
             # Try update a hash at most once every 5 minutes
@@ -280,26 +612,10 @@ class Crawler(DHT):
                 hashs_get = [h for h,g in self.root.update_hash if g]
                 hashs_announce = [h for h,g in self.root.update_hash if not g]
                 self.root.update_hash = set()
-        query_get = "INSERT INTO torrents (hash, visible_status, dht_last_get) VALUES %s ON DUPLICATE KEY UPDATE dht_last_get=NOW();" % ", ".join("(LOWER(%s),2,NOW())" for h in hashs_get if h)
-        query_announce = "INSERT INTO torrents (hash, visible_status, dht_last_announce) VALUES %s ON DUPLICATE KEY UPDATE dht_last_announce=NOW();" % ", ".join("(LOWER(%s),2,NOW())" for h in hashs_announce if h)
-        db = MySQLdb.connect(**config.mysql)
-        try:
-            cur = db.cursor()
-            if hashs_get:
-                cur.execute(query_get, [h.encode("hex") for h in hashs_get if h])
-            if hashs_announce:
-                cur.execute(query_announce, [h.encode("hex") for h in hashs_announce if h])
-            db.commit()
-            cur.close()
-            db.close()
-        except (MySQLdb.Error, ) as e:
-            try:cur.close()
-            except:pass
-            try:db.commit()
-            except:pass
-            try:db.close()
-            except:pass
-            self.debug(0, "MYSQLERROR: %r, %s" % (e, errornb))
+        if hashs_get:
+            self.root.hash_writer.put("get", hashs_get)
+        if hashs_announce:
+            self.root.hash_writer.put("announce", hashs_announce)
 
     def determine_info_hash(self, hash):
         def callback(peers):
@@ -312,6 +628,41 @@ class Crawler(DHT):
 
 
 
+_index_rebuild = {'last': 0, 'thread': None}
+def rebuild_hash_index():
+    """Rebuild the shared known hashs index from the torrents table"""
+    try:
+        count = hashindex.build_hash_index(config.mysql, config.hash_index_file)
+        print("known hashs index rebuilt: %s hashs" % count)
+    except (MySQLdb.Error, IOError, OSError) as e:
+        print("%r" % e)
+
+def schedule_hash_index_rebuild():
+    """Rebuild the known hashs index in a thread every hash_index_rebuild_interval seconds"""
+    if not config.hash_index_file:
+        return
+    if _index_rebuild['thread'] is not None and _index_rebuild['thread'].is_alive():
+        return
+    if time.time() - _index_rebuild['last'] > config.hash_index_rebuild_interval:
+        t = Thread(target=rebuild_hash_index)
+        t.setName("rebuild_hash_index")
+        t.daemon = True
+        t.start()
+        _index_rebuild['thread'] = t
+        _index_rebuild['last'] = time.time()
+
+def init_hash_index():
+    """Build the known hashs index in a thread if its file is missing
+
+    The crawlers query the db until the index file exists, see HashToIgnore.reload_index
+    """
+    if not config.hash_index_file:
+        return
+    if os.path.isfile(config.hash_index_file):
+        _index_rebuild['last'] = time.time()
+    else:
+        schedule_hash_index_rebuild()
+
 def get_id(id_file):
     try:
         with open(id_file) as f:
@@ -343,6 +694,10 @@ def lauch(debug, id_file="crawler1.id", lprefix="", worker_alive=None):
     with open(pidfile, 'w') as f:
         f.write(str(pid))
 
+    # if not run by worker, we are in charge of the known hashs index
+    if worker_alive is None:
+        init_hash_index()
+
     port_base = config.crawler_base_port
     prefix=1
     routing_table = RoutingTable(debuglvl=debug)
@@ -376,6 +731,8 @@ def lauch(debug, id_file="crawler1.id", lprefix="", worker_alive=None):
                     liv.start()
             if worker_alive is not None and (time.time() - worker_alive.value) > 15:
                 raise Exception("Manager worker exited")
+            if worker_alive is None:
+                schedule_hash_index_rebuild()
             time.sleep(10)
     except (KeyboardInterrupt, Exception) as e:
         print("%r" % e)
@@ -401,6 +758,7 @@ def stop(liveness):
 
 def worker(debug):
     jobs = {}
+    init_hash_index()
     try:
         worker_alive = multiprocessing.Value('i', int(time.time()))
         for i in range(1, config.crawler_worker + 1):
@@ -411,6 +769,7 @@ def worker(debug):
         mem={}
         while True:
             worker_alive.value = int(time.time())
+            schedule_hash_index_rebuild()
             for i, p in jobs.items():
 
                 # watch if the process has done some io
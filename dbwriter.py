@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+import time
+import tempfile
+import threading
+import collections
+from threading import Thread, Lock
+
+import MySQLdb
+
+
+class BatchWriter(object):
+    """Base class of the writers of rows to the db by bounded chunks, from a dedicated thread
+
+    Subclasses implement `write(cur, kind, rows)`, which executes the
+    statements writing one chunk of `rows` with the cursor `cur`, the commit
+    being done by the writer thread. Rows are queued by `put` and written by
+    `write` in chunks of at most `chunk_size` rows, using one long lived
+    connection. A chunk failing on a MySQLdb.OperationalError (lost
+    connection, lock timeout, ...) is retried with an exponential backoff,
+    other errors are retried `max_retry` times. At most `max_pending` rows
+    are queued, the oldest are dropped past it.
+    """
+    name = "BatchWriter"
+
+    def __init__(self, mysql, chunk_size=5000, max_retry=5, max_pending=1000000, debug=None):
+        self.mysql = mysql
+        self.chunk_size = chunk_size
+        self.max_retry = max_retry
+        self.max_pending = max_pending
+        self.debug = debug
+        self.db = None
+        self._queue = collections.deque() # (kind, rows, tries)
+        self._pending = 0 # number of rows in _queue
+        self._event = threading.Event()
+        self._lock = Lock()
+        self.stoped = True
+        self.threads = []
+
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.chunks_retried = 0
+        self.last_flush_latency = 0
+        self._rate = (time.time(), 0)
+
+    def start(self):
+        self.stoped = False
+        t = Thread(target=self._loop)
+        t.setName("%s:loop" % self.name)
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
+
+    def stop(self, timeout=30):
+        """Stop the writer thread once the queued rows are written or after `timeout` seconds"""
+        self.stoped = True
+        self._event.set()
+        for t in self.threads:
+            t.join(timeout)
+
+    def put(self, kind, rows):
+        """Queue `rows` to be written by `write(cur, kind, chunk)`"""
+        rows = list(rows)
+        with self._lock:
+            for i in range(0, len(rows), self.chunk_size):
+                self._queue.append((kind, rows[i:i+self.chunk_size], 0))
+            self._pending += len(rows)
+            # the db is lagging or down, do not grow without bound
+            while self._pending > self.max_pending and self._queue:
+                (_, dropped, _) = self._queue.popleft()
+                self._pending -= len(dropped)
+                self.rows_dropped += len(dropped)
+        self._event.set()
+
+    def pending(self):
+        return self._pending
+
+    def stats(self):
+        """Return the writer statistics, rows_per_sec is computed since the last call"""
+        now = time.time()
+        last, written = self._rate
+        self._rate = (now, self.rows_written)
+        return {
+            'pending': self.pending(),
+            'rows_written': self.rows_written,
+            'rows_dropped': self.rows_dropped,
+            'chunks_retried': self.chunks_retried,
+            'rows_per_sec': (self.rows_written - written) / max(now - last, 0.001),
+            'flush_latency': self.last_flush_latency,
+        }
+
+    def connect(self):
+        return MySQLdb.connect(**self.mysql)
+
+    def close(self):
+        try:self.db.close()
+        except:pass
+        self.db = None
+
+    def idle(self):
+        """Called by the writer thread at least every second"""
+        pass
+
+    def _loop(self):
+        errno = 0
+        while True:
+            self._event.wait(1)
+            try:
+                self.idle()
+            except (MySQLdb.Error, ) as e:
+                self.close()
+                if self.debug:
+                    self.debug("%s: %r" % (self.name, e))
+            with self._lock:
+                if not self._queue:
+                    self._event.clear()
+                    if self.stoped:
+                        self.close()
+                        return
+                    continue
+                (kind, rows, tries) = self._queue.popleft()
+                self._pending -= len(rows)
+            start = time.time()
+            try:
+                if self.db is None:
+                    self.db = self.connect()
+                cur = self.db.cursor()
+                try:
+                    self.write(cur, kind, rows)
+                finally:
+                    cur.close()
+                self.db.commit()
+                self.rows_written += len(rows)
+                self.last_flush_latency = time.time() - start
+                errno = 0
+            except (MySQLdb.Error, ) as e:
+                self.close()
+                if self.debug:
+                    self.debug("%s: %r, %s" % (self.name, e, tries))
+                if isinstance(e, MySQLdb.OperationalError) or tries < self.max_retry:
+                    self.chunks_retried += 1
+                    with self._lock:
+                        self._queue.appendleft((kind, rows, tries + 1))
+                        self._pending += len(rows)
+                    errno += 1
+                    # do not retry forever on shutdown
+                    if self.stoped and errno > self.max_retry:
+                        with self._lock:
+                            self.rows_dropped += self._pending
+                            self._pending = 0
+                            self._queue.clear()
+                    else:
+                        time.sleep(min(0.1 * 2 ** errno, 60))
+                else:
+                    self.rows_dropped += len(rows)
+
+
+class HashUpdateWriter(BatchWriter):
+    """Write the crawler dht_last_get and dht_last_announce updates
+
+    `kind` is "get" or "announce", rows are info_hashes
+    """
+    name = "HashUpdateWriter"
+    table = "torrents"
+
+    queries = {
+        "get": "INSERT INTO %s (hash, visible_status, dht_last_get) VALUES %s ON DUPLICATE KEY UPDATE dht_last_get=NOW();",
+        "announce": "INSERT INTO %s (hash, visible_status, dht_last_announce) VALUES %s ON DUPLICATE KEY UPDATE dht_last_announce=NOW();",
+    }
+
+    def write(self, cur, kind, hashs):
+        hashs = [h.encode("hex") for h in hashs if h]
+        if hashs:
+            cur.execute(self.queries[kind] % (self.table, ", ".join("(LOWER(%s),2,NOW())" for h in hashs)), hashs)
+
+
+class HashStagingWriter(HashUpdateWriter):
+    """Append the crawler get/announce updates to the staging table
+
+    The rows are periodically merged into the torrents table by a single
+    set based statement (see merge), so the MyISAM torrents table is locked
+    a few times by minute instead of at every flush.
+    """
+    name = "HashStagingWriter"
+    staging_table = "torrents_dht_staging"
+    kinds = {"announce": 0, "get": 1}
+
+    def __init__(self, mysql, merge_interval=20, **kwargs):
+        super(HashStagingWriter, self).__init__(mysql, **kwargs)
+        self.merge_interval = merge_interval
+        self.last_merge = time.time()
+        self.rows_merged = 0
+        self.last_merge_latency = 0
+
+    def write(self, cur, kind, hashs):
+        hashs = [h.encode("hex").lower() for h in hashs if h]
+        if hashs:
+            cur.execute("INSERT INTO %s (hash, kind) VALUES %s" % (self.staging_table, ", ".join("(%%s,%s)" % self.kinds[kind] for h in hashs)), hashs)
+
+    def idle(self):
+        if time.time() - self.last_merge > self.merge_interval:
+            self.last_merge = time.time()
+            if self.db is None:
+                self.db = self.connect()
+            self.merge(self.db)
+
+    def merge(self, db):
+        """Fold the staging table rows into the torrents table
+
+        Concurrent merges from others crawlers are serialized with a named
+        lock. Return the number of staging rows merged.
+        """
+        start = time.time()
+        cur = db.cursor()
+        try:
+            cur.execute("SELECT GET_LOCK(%s, 0)", ("%s_merge" % self.staging_table,))
+            if not cur.fetchone()[0]:
+                return 0
+            try:
+                cur.execute("SELECT MIN(id), MAX(id) FROM %s" % self.staging_table)
+                (min_id, max_id) = cur.fetchone()
+                if max_id is None:
+                    return 0
+                cur.execute(
+                    "INSERT INTO %s (hash, visible_status, dht_last_get, dht_last_announce) "
+                    "SELECT hash, 2, MAX(IF(kind=1, ts, NULL)), MAX(IF(kind=0, ts, NULL)) FROM %s WHERE id <= %%s GROUP BY hash "
+                    "ON DUPLICATE KEY UPDATE "
+                    "dht_last_get=IF(VALUES(dht_last_get) IS NULL OR VALUES(dht_last_get) < dht_last_get, dht_last_get, VALUES(dht_last_get)), "
+                    "dht_last_announce=IF(VALUES(dht_last_announce) IS NULL OR VALUES(dht_last_announce) < dht_last_announce, dht_last_announce, VALUES(dht_last_announce))"
+                    % (self.table, self.staging_table), (max_id,)
+                )
+                cur.execute("DELETE FROM %s WHERE id <= %%s" % self.staging_table, (max_id,))
+                db.commit()
+                self.rows_merged += max_id - min_id + 1
+                self.last_merge_latency = time.time() - start
+                return max_id - min_id + 1
+            finally:
+                cur.execute("SELECT RELEASE_LOCK(%s)", ("%s_merge" % self.staging_table,))
+        finally:
+            cur.close()
+
+    def stats(self):
+        stats = super(HashStagingWriter, self).stats()
+        stats['rows_merged'] = self.rows_merged
+        stats['merge_latency'] = self.last_merge_latency
+        return stats
+
+
+class HashInfileWriter(HashStagingWriter):
+    """Load the crawler get/announce updates in the staging table with LOAD DATA LOCAL INFILE"""
+    name = "HashInfileWriter"
+
+    def connect(self):
+        return MySQLdb.connect(local_infile=1, **self.mysql)
+
+    def write(self, cur, kind, hashs):
+        hashs = [h.encode("hex").lower() for h in hashs if h]
+        if not hashs:
+            return
+        with tempfile.NamedTemporaryFile(prefix="%s-" % self.staging_table, suffix=".tsv") as f:
+            kind = self.kinds[kind]
+            for h in hashs:
+                f.write("%s\t%s\n" % (h, kind))
+            f.flush()
+            cur.execute("LOAD DATA LOCAL INFILE %%s INTO TABLE %s (hash, kind)" % self.staging_table, (f.name,))
+
+
+class ScrapeResultWriter(BatchWriter):
+    """Write the trackers scrape results to the torrents table
+
+    `kind` is "scrape", rows are (hash, seeders, leechers, downloads_count).
+    Rows are buffered until `chunk_size` rows are there or for at most
+    `flush_interval` seconds, then loaded in a temporary table by one
+    multi-row INSERT and copied to the torrents table by one join UPDATE,
+    so that the hashs not in the torrents table are not inserted.
+    """
+    name = "ScrapeResultWriter"
+    table = "torrents"
+    # per connection, created again after a reconnection
+    tmp_table = "torrents_scrape_tmp"
+    # seeders, leechers and downloads_count are unsigned mediumint
+    max_value = 16777215
+
+    def __init__(self, mysql, flush_interval=5, **kwargs):
+        super(ScrapeResultWriter, self).__init__(mysql, **kwargs)
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._buffer_since = None
+
+    def put(self, kind, rows):
+        with self._lock:
+            if not self._buffer:
+                self._buffer_since = time.time()
+            self._buffer.extend(rows)
+            if len(self._buffer) < self.chunk_size:
+                return
+            (rows, self._buffer) = (self._buffer, [])
+        super(ScrapeResultWriter, self).put(kind, rows)
+
+    def flush(self):
+        """Queue the buffered rows to be written"""
+        with self._lock:
+            (rows, self._buffer) = (self._buffer, [])
+        if rows:
+            super(ScrapeResultWriter, self).put("scrape", rows)
+
+    def idle(self):
+        if self._buffer and time.time() - self._buffer_since > self.flush_interval:
+            self.flush()
+
+    def stop(self, timeout=30):
+        self.flush()
+        super(ScrapeResultWriter, self).stop(timeout)
+
+    def pending(self):
+        return super(ScrapeResultWriter, self).pending() + len(self._buffer)
+
+    def write(self, cur, kind, rows):
+        values = []
+        for (hash, seeders, leechers, downloads_count) in rows:
+            values.extend([hash.lower()] + [max(0, min(int(v), self.max_value)) for v in (seeders, leechers, downloads_count)])
+        cur.execute(
+            "CREATE TEMPORARY TABLE IF NOT EXISTS %s ("
+            "hash varchar(40) CHARACTER SET ascii NOT NULL PRIMARY KEY, "
+            "seeders mediumint(8) unsigned NOT NULL, leechers mediumint(8) unsigned NOT NULL, downloads_count mediumint(8) unsigned NOT NULL"
+            ") ENGINE=MEMORY" % self.tmp_table
+        )
+        cur.execute("DELETE FROM %s" % self.tmp_table)
+        cur.execute(
+            "INSERT INTO %s (hash, seeders, leechers, downloads_count) VALUES %s "
+            "ON DUPLICATE KEY UPDATE seeders=VALUES(seeders), leechers=VALUES(leechers), downloads_count=VALUES(downloads_count)"
+            % (self.tmp_table, ", ".join("(%s,%s,%s,%s)" for row in rows)),
+            values
+        )
+        cur.execute(
+            "UPDATE %s t JOIN %s s ON t.hash = s.hash "
+            "SET t.scrape_date=NOW(), t.seeders=s.seeders, t.leechers=s.leechers, t.downloads_count=s.downloads_count"
+            % (self.table, self.tmp_table)
+        )
+
+
+def hash_update_writer(mode, mysql, merge_interval=20, **kwargs):
+    """Return the update_hash writer for `mode`, one of upsert, staging or infile"""
+    if mode == "upsert":
+        return HashUpdateWriter(mysql, **kwargs)
+    elif mode == "staging":
+        return HashStagingWriter(mysql, merge_interval=merge_interval, **kwargs)
+    elif mode == "infile":
+        return HashInfileWriter(mysql, merge_interval=merge_interval, **kwargs)
+    else:
+        raise ValueError("Unknown update_hash_mode %r" % mode)
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import errno
+import threading
+import collections
+from threading import Thread, Lock
+
+
+def torrent_path(base_path, hash, sharded=False, create=False):
+    """Return the path of the .torrent file of `hash` in `base_path`
+
+    With the sharded layout, files are stored in two levels of directories
+    named after the first 4 hex digits of the hash: `ab/cd/abcd....torrent`.
+    If `create` is True, the shard directories are created if needed.
+    """
+    if not sharded:
+        return "%s/%s.torrent" % (base_path, hash)
+    shard = os.path.join(base_path, hash[0:2].lower(), hash[2:4].lower())
+    if create:
+        try:
+            os.makedirs(shard)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    return os.path.join(shard, "%s.torrent" % hash)
+
+
+def list_torrents(base_path, sharded=False):
+    """Return the list of the hashs of the .torrent files in `base_path`"""
+    if not sharded:
+        return [f[:-8] for f in os.listdir(base_path) if f.endswith(".torrent")]
+    hashs = []
+    for d1 in os.listdir(base_path):
+        if len(d1) != 2:
+            continue
+        try:
+            level1 = os.listdir(os.path.join(base_path, d1))
+        except OSError:
+            continue
+        for d2 in level1:
+            if len(d2) != 2:
+                continue
+            try:
+                files = os.listdir(os.path.join(base_path, d1, d2))
+            except OSError:
+                continue
+            hashs.extend(f[:-8] for f in files if f.endswith(".torrent"))
+    return hashs
+
+
+class TorrentsDir(object):
+    """In memory index of the `<hex>.torrent` files of a directory
+
+    The index is populated by listing the directory, then kept current by
+    `add` and `discard` for the files written or removed by this process and
+    by listing the directory again every `refresh_interval` seconds for the
+    others. Hashs are hex strings, as in the file names.
+    """
+
+    def __init__(self, path, refresh_interval=60, sharded=False):
+        self.path = path
+        self.sharded = sharded
+        self.refresh_interval = refresh_interval
+        self.last_refresh = 0
+        self._hashs = set()
+        # changes made while a refresh is listing the directory
+        self._added = None
+        self._removed = None
+        self._lock = Lock()
+        self.stoped = True
+        self.threads = []
+
+    def refresh(self):
+        """List the directory and replace the index with its content"""
+        with self._lock:
+            self._added = set()
+            self._removed = set()
+        hashs = None
+        try:
+            hashs = set(list_torrents(self.path, self.sharded))
+        finally:
+            with self._lock:
+                if hashs is not None:
+                    hashs.difference_update(self._removed)
+                    hashs.update(self._added)
+                    self._hashs = hashs
+                self._added = None
+                self._removed = None
+        self.last_refresh = time.time()
+
+    def start(self):
+        self.stoped = False
+        t = Thread(target=self._loop)
+        t.setName("TorrentsDir:%s" % self.path)
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
+
+    def stop(self):
+        self.stoped = True
+
+    def _loop(self):
+        while not self.stoped:
+            if time.time() - self.last_refresh > self.refresh_interval:
+                try:
+                    self.refresh()
+                except OSError as e:
+                    print("%r" % e)
+                    self.last_refresh = time.time()
+            time.sleep(1)
+
+    def path_of(self, hash, create=False):
+        """Return the path of the .torrent file of `hash` in the directory"""
+        return torrent_path(self.path, hash, self.sharded, create)
+
+    def add(self, hash):
+        with self._lock:
+            self._hashs.add(hash)
+            if self._added is not None:
+                self._added.add(hash)
+                self._removed.discard(hash)
+
+    def discard(self, hash):
+        with self._lock:
+            self._hashs.discard(hash)
+            if self._removed is not None:
+                self._removed.add(hash)
+                self._added.discard(hash)
+
+    def __contains__(self, hash):
+        return hash in self._hashs
+
+    def __len__(self):
+        return len(self._hashs)
+
+    def hashs(self):
+        """Return the list of the indexed hashs"""
+        return list(self._hashs)
+
+
+class TorrentWriter(object):
+    """Write the downloaded metadata as .torrent files of a TorrentsDir, from a dedicated thread
+
+    Metadata are queued by `put` and written by batches of at most
+    `batch_size` files: every file of a batch is written to `<path>.new` and
+    fsynced, then renamed in place, then each directory touched by the batch
+    is fsynced once. Written hashs are added to the TorrentsDir index and
+    passed to the `on_written` callbacks, the others to the `on_failed`
+    callbacks. Hashs are 20 bytes strings.
+    """
+
+    def __init__(self, torrents_dir, batch_size=100, batch_delay=0.1, debug=None):
+        self.torrents_dir = torrents_dir
+        self.batch_size = batch_size
+        # wait batch_delay seconds after the first queued metadata for others
+        self.batch_delay = batch_delay
+        self.debug = debug
+        self.on_written = []
+        self.on_failed = []
+        self._queue = collections.deque() # (hash, metadata, queued time)
+        self._event = threading.Event()
+        self.stoped = True
+        self.threads = []
+
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.last_batch_latency = 0
+        self.last_write_latency = 0
+        self.max_queue_depth = 0
+
+    def start(self):
+        self.stoped = False
+        t = Thread(target=self._loop)
+        t.setName("TorrentWriter:%s" % self.torrents_dir.path)
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
+
+    def stop(self, timeout=30):
+        """Stop the writer thread once the queued metadata are written or after `timeout` seconds"""
+        self.stoped = True
+        self._event.set()
+        for t in self.threads:
+            t.join(timeout)
+
+    def put(self, hash, metadata):
+        """Queue the `metadata` of `hash` to be written"""
+        self._queue.append((hash, metadata, time.time()))
+        self.max_queue_depth = max(self.max_queue_depth, len(self._queue))
+        self._event.set()
+
+    def pending(self):
+        return len(self._queue)
+
+    def stats(self):
+        """Return the writer statistics, max_queue_depth is reset on each call"""
+        stats = {
+            'pending': self.pending(),
+            'max_queue_depth': self.max_queue_depth,
+            'written': self.written,
+            'failed': self.failed,
+            'batches': self.batches,
+            'batch_latency': self.last_batch_latency,
+            'write_latency': self.last_write_latency,
+        }
+        self.max_queue_depth = self.pending()
+        return stats
+
+    def write(self, batch):
+        """Write the (hash, metadata, queued time) of `batch`, return the written hashs"""
+        files = []
+        for (hash, metadata, queued) in batch:
+            try:
+                path = self.torrents_dir.path_of(hash.encode("hex"), create=True)
+                with open("%s.new" % path, 'wb') as f:
+                    f.write("d4:info%se" % metadata)
+                    f.flush()
+                    os.fsync(f.fileno())
+                files.append((hash, path))
+            except (IOError, OSError) as e:
+                self.failed += 1
+                if self.debug:
+                    self.debug("TorrentWriter: %s %r" % (hash.encode("hex"), e))
+        written = []
+        dirs = set()
+        for (hash, path) in files:
+            try:
+                os.rename("%s.new" % path, path)
+                written.append(hash)
+                dirs.add(os.path.dirname(path) or ".")
+            except OSError as e:
+                self.failed += 1
+                if self.debug:
+                    self.debug("TorrentWriter: %s %r" % (hash.encode("hex"), e))
+        # make the renames durable, once by directory for the whole batch
+        for path in dirs:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                if self.debug:
+                    self.debug("TorrentWriter: %s %r" % (path, e))
+        return written
+
+    def _loop(self):
+        while True:
+            self._event.wait(1)
+            if not self._queue:
+                self._event.clear()
+                # put may have queued between the test and the clear
+                if self._queue:
+                    continue
+                if self.stoped:
+                    return
+                continue
+            if not self.stoped and len(self._queue) < self.batch_size:
+                time.sleep(self.batch_delay)
+            batch = []
+            while self._queue and len(batch) < self.batch_size:
+                batch.append(self._queue.popleft())
+            start = time.time()
+            written = self.write(batch)
+            now = time.time()
+            self.batches += 1
+            self.written += len(written)
+            self.last_batch_latency = now - start
+            self.last_write_latency = now - batch[0][2]
+            for hash in written:
+                self.torrents_dir.add(hash.encode("hex"))
+            done = set(written)
+            failed = [hash for (hash, _, _) in batch if not hash in done]
+            for (hashs, callbacks) in [(written, self.on_written), (failed, self.on_failed)]:
+                for hash in hashs:
+                    for callback in callbacks:
+                        try:
+                            callback(hash)
+                        except Exception as e:
+                            if self.debug:
+                                self.debug("TorrentWriter: %r" % e)
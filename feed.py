@@ -20,12 +20,20 @@ import collections
 from threading import Thread
 import Queue as queue
 
+import pack
 import scraper
+import dbwriter
+import dirindex
 from btdht import utils
 from replication import Replicator
 
 from crawler import get_id, HashToIgnore
 hash_to_ignore = HashToIgnore()
+# content of config.torrents_dir, refreshed at each loop
+torrents_dir = dirindex.TorrentsDir(config.torrents_dir, sharded=config.torrents_sharded)
+
+def torrent_path(base_path, hash, create=False):
+    return dirindex.torrent_path(base_path, hash, config.torrents_sharded, create)
 
 def on_torrent_announce(hash, url):
     global hash_to_ignore
@@ -94,109 +102,150 @@ def last_timestamp(self):
     global last_get
     return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(created))    
 
+def scrape_candidates(db, interval, limit=None, page_size=1000):
+    """Yield the hashs of the torrents to scrape, never scraped first then the oldest scraped
+
+    The candidates are read by pages of `page_size` rows, with a keyset
+    pagination on the (scrape_date, id) index: no page needs a sort or skips
+    rows with an offset. Torrents scraped during the pass have a scrape_date
+    after the pass start and are not yielded again.
+    """
+    cur = db.cursor()
+    try:
+        cur.execute("SELECT DATE_SUB(NOW(), INTERVAL %s MINUTE)", (interval,))
+        cutoff = cur.fetchone()[0]
+        count = 0
+        (last_date, last_id) = (None, 0)
+        never_scraped = True
+        while limit is None or count < limit:
+            size = page_size if limit is None else min(page_size, limit - count)
+            if never_scraped:
+                cur.execute("SELECT scrape_date, id, hash FROM torrents WHERE scrape_date IS NULL AND id > %s AND created_at IS NOT NULL ORDER BY scrape_date, id LIMIT %s", (last_id, size))
+            elif last_date is None:
+                cur.execute("SELECT scrape_date, id, hash FROM torrents WHERE scrape_date <= %s AND created_at IS NOT NULL ORDER BY scrape_date, id LIMIT %s", (cutoff, size))
+            else:
+                cur.execute(
+                    "SELECT scrape_date, id, hash FROM torrents WHERE scrape_date <= %s AND (scrape_date > %s OR (scrape_date = %s AND id > %s)) AND created_at IS NOT NULL ORDER BY scrape_date, id LIMIT %s",
+                    (cutoff, last_date, last_date, last_id, size)
+                )
+            rows = cur.fetchall()
+            for (last_date, last_id, hash) in rows:
+                yield hash
+            count += len(rows)
+            if len(rows) < size:
+                if not never_scraped:
+                    return
+                never_scraped = False
+                (last_date, last_id) = (None, 0)
+    finally:
+        cur.close()
+
 def scrape(db=None):
     if db is None:
         db = MySQLdb.connect(**config.mysql)
     if config.scrape_interval <= 0:
         return
-    cur = db.cursor()
-    query = "SELECT COUNT(id) FROM torrents WHERE created_at IS NOT NULL AND (scrape_date IS NULL OR scrape_date <= DATE_SUB(NOW(), INTERVAL %d MINUTE))" % config.scrape_interval
-    if config.scape_limit > 0:
-        query += " LIMIT %d" % config.scape_limit
-    cur.execute(query)
-    ret = [r[0] for r in cur]
-    if config.scape_limit > 0:
-        count=min(ret[0], config.scape_limit)
-    else:
-        count=ret[0]
-    qhashs = queue.Queue()
-    i=0
-    n_count = 0
-
-    if count <= 0:
-        return
-    query = "SELECT hash FROM torrents WHERE created_at IS NOT NULL AND (scrape_date IS NULL OR scrape_date <= DATE_SUB(NOW(), INTERVAL %d MINUTE))" % config.scrape_interval
-    if config.scape_limit > 0:
-        query += " ORDER BY scrape_date ASC LIMIT %d" % config.scape_limit
-    db2 = MySQLdb.connect(**config.mysql)
-    cur2 = db2.cursor()
-    cur2.execute(query)
-    l = []
-    i=0
-    for r in cur2:
-        l.append(r[0])
-        i+=1
-        if i >= 50:
-            qhashs.put(l)
-            l = []
-            i=0
-    qhashs.put(l)
-
-    pbar = progressbar.ProgressBar(widgets=widget("torrents scraped"), maxval=count).start()    
-    def scrape_thread(cur2, pbar, count, qhashs, nth, total, ips=["open.demonii.com"]):
-        db = MySQLdb.connect(**config.mysql)
+    limit = config.scape_limit if config.scape_limit > 0 else None
+    if limit is None:
         cur = db.cursor()
-        last_commit = time.time()
-        errno=0
-        nip = len(ips)
-        banip=collections.defaultdict(int)
-        i = nth
+        cur.execute("SELECT COUNT(id) FROM torrents WHERE created_at IS NOT NULL AND (scrape_date IS NULL OR scrape_date <= DATE_SUB(NOW(), INTERVAL %d MINUTE))" % config.scrape_interval)
+        count = cur.fetchone()[0]
+        cur.close()
+        if count <= 0:
+            return
+    else:
+        count = limit
+
+    # batchs of hashs read by the producer thread, at most scrape_queue_size
+    # batchs are queued or being scraped at once
+    qhashs = queue.Queue(maxsize=config.scrape_queue_size)
+    stoped = []
+    def put(l):
+        while not stoped:
+            try:
+                qhashs.put(l, timeout=1)
+                return
+            except queue.Full:
+                pass
+    def producer():
+        db2 = MySQLdb.connect(**config.mysql)
         try:
-            l = qhashs.get(timeout=0)
-            while True:
-                try:
-                    ip = ips[i%len(ips)]
-                    i+=1
-                    for hash, info in scraper.scrape("udp://%s:1337/announce" % ip, l).items():
-                        cur.execute("UPDATE torrents SET scrape_date=NOW(), seeders=%s, leechers=%s, downloads_count=%s WHERE hash=%s", (info['seeds'], info['peers'], info['complete'], hash))
-                    if time.time() - last_commit > 30:
-                        db.commit()
-                        last_commit = time.time()
-                    pbar.update(min(pbar.currval + len(l), count))
-                    l = qhashs.get(timeout=0)
-                    errno=0
-                except (socket.timeout, socket.gaierror, socket.error):
-                    db.commit()
-                    banip[ip]+=1
-                    if banip[ip]>3:
-                        try:ips.remove(ip)
-                        except ValueError:
-                            pass
-                    if not ips:
-                        raise ValueError("all ips failed")
-                    time.sleep(0.1 * errno + 0.1)
-                    errno+=1
-                    if errno > nip*3:
-                        raise
-        except (queue.Empty, ZeroDivisionError):
-            pass
-        except (socket.timeout, socket.gaierror, socket.error):
-            qhashs.put(l)
-        except (ValueError, RuntimeError) as e:
-            print e
+            l = []
+            for hash in scrape_candidates(db2, config.scrape_interval, limit):
+                if stoped:
+                    return
+                l.append(hash)
+                if len(l) >= 50:
+                    put(l)
+                    l = []
+            if l:
+                put(l)
+        except MySQLdb.Error as e:
+            print("%r" % e)
         finally:
-            db.commit()
-            cur.close()
-            db.close()
-
+            put(None)
+            db2.close()
+    t = Thread(target=producer)
+    t.setName("scrape-producer")
+    t.daemon = True
+
+    pbar = progressbar.ProgressBar(widgets=widget("torrents scraped"), maxval=count).start()
+    trackers = scraper.TrackerPool(
+        config.scrape_trackers,
+        fanout=config.scrape_tracker_fanout,
+        rate=config.scrape_tracker_rate,
+        in_flight=config.scrape_tracker_in_flight,
+        timeout=config.scrape_udp_timeout
+    )
+    def debug(msg):
+        print(msg)
+    # one connection writing the results by chunks of scrape_write_chunk_size rows
+    writer = dbwriter.ScrapeResultWriter(config.mysql, chunk_size=config.scrape_write_chunk_size, debug=debug)
+    results = queue.Queue()
     try:
-        threads = []
-        total = 30
-        ip = [ s[4][0] for s in socket.getaddrinfo("open.demonii.com", 0, socket.AF_INET, socket.SOCK_DGRAM)]
-        mod = len(ip)
-        for i in range(0, total):
-            t = Thread(target=scrape_thread, args=(cur2, pbar, count, qhashs, i,total, ip))
-            t.daemon = True
-            t.setName("scrape-%02d" % i)
-            t.start()
-            threads.append(t)
-        join(threads)
+        writer.start()
+        trackers.start()
+        t.start()
+        failed = 0
+        submitted = 0
+        produced = False
+        while True:
+            while not produced and submitted < config.scrape_queue_size:
+                try:
+                    l = qhashs.get(timeout=0 if submitted else 1)
+                except queue.Empty:
+                    break
+                if l is None:
+                    produced = True
+                    break
+                trackers.submit(l, lambda hashes, ret, error: results.put((hashes, ret, error)))
+                submitted += 1
+            if submitted == 0:
+                if produced:
+                    break
+                continue
+            try:
+                (hashes, ret, error) = results.get(timeout=1)
+            except queue.Empty:
+                if not trackers.alive():
+                    raise RuntimeError("scraper threads died")
+                continue
+            submitted -= 1
+            failed += len(hashes) - len(ret)
+            writer.put("scrape", [(hash, info['seeds'], info['peers'], info['complete']) for hash, info in ret.items()])
+            pbar.update(min(pbar.currval + len(hashes), count))
         pbar.finish()
+        if failed:
+            print("%s torrents not scraped" % failed)
+        for url, stats in sorted(trackers.stats().items()):
+            print("%s: %s requests, %s scraped, %s failed, %.3fs latency, %.2f error rate" % (url, stats['requests'], stats['scraped'], stats['failed'], stats['latency'], stats['error_rate']))
+    except RuntimeError as e:
+        print e
     finally:
-        cur2.close()
-        db2.close()
-        db.commit()
-        cur.close()
+        stoped.append(True)
+        trackers.stop()
+        writer.stop()
+        print("Scrape writer: %(rows_written)s written, %(rows_dropped)s dropped, %(rows_per_sec).1f rows/s" % writer.stats())
 
 def update_torrent_file(db=None):
     if db is None:
@@ -233,7 +282,8 @@ def get_new_torrent():
             torrent = utils.bdecode(open(f, 'rb').read())    
             real_hash = hashlib.sha1(utils.bencode(torrent[b'info'])).hexdigest()
             hash_to_ignore.add(real_hash.decode("hex"))
-            os.rename(f, "%s/%s.torrent" % (config.torrents_dir, real_hash))
+            os.rename(f, torrent_path(config.torrents_dir, real_hash, create=True))
+            torrents_dir.add(real_hash)
         except utils.BcodeError as e:
             pass
 
@@ -241,8 +291,7 @@ def get_hash(db=None, insert_new=False, dir_only=False, name_null=False):
     if db is None:
         db = MySQLdb.connect(**config.mysql)          
     cur = db.cursor()
-    files = os.listdir(config.torrents_dir)
-    hashs = [h[:-8] for h in files if h.endswith(".torrent")]
+    hashs = torrents_dir.hashs()
     if insert_new:
         khashs = set()
         i=0
@@ -289,8 +338,7 @@ def get_hash(db=None, insert_new=False, dir_only=False, name_null=False):
 def get_dir(db=None):
     if db is None:
         db = MySQLdb.connect(**config.mysql)
-    files = os.listdir(config.torrents_dir)
-    hashs = [h[:-8] for h in files if h.endswith(".torrent")]
+    hashs = torrents_dir.hashs()
     cur = db.cursor()
     cur.execute("SELECT hash FROM torrents WHERE created_at IS NULL AND (%s)"  % " OR ".join("hash=%s" for hash in hashs), tuple(hashs))
     ret = [r[0] for r in cur]
@@ -342,7 +390,7 @@ def fetch_torrent(db):
     pbar = progressbar.ProgressBar(widgets=widget("torrents fetched"), maxval=count).start()
     counter = [0, 0, 0]
     def load_url(db, cur, hash, notfound, counter):
-        if os.path.isfile("%s/%s.torrent" % (config.torrents_dir, hash)):
+        if hash in torrents_dir:
             update_db(db, hashs=[hash], quiet=True)
             counter[2]+=1
         else:
@@ -389,19 +437,21 @@ def get_torrent(db, hash, base_path=config.torrents_dir):
     global downloading, failed
     if hash in failed:
         return None
-    if os.path.isfile("%s/%s.torrent" % (base_path, hash)):
-        torrent = open("%s/%s.torrent" % (base_path, hash), 'rb').read()
-        try:
-            torrent = utils.bdecode(torrent)
-            if not b'info' in torrent:
-                return {b'info':torrent}
-            else:
-                return torrent
-        except utils.BcodeError as e:
-            print("FAILED %s: %r" % (hash, e))
-            failed.add(hash)
-    else:
+    if base_path == config.torrents_dir and not hash in torrents_dir:
+        return
+    try:
+        torrent = open(torrent_path(base_path, hash), 'rb').read()
+    except IOError:
         return
+    try:
+        torrent = utils.bdecode(torrent)
+        if not b'info' in torrent:
+            return {b'info':torrent}
+        else:
+            return torrent
+    except utils.BcodeError as e:
+        print("FAILED %s: %r" % (hash, e))
+        failed.add(hash)
 
 
     
@@ -531,7 +581,9 @@ def update_db_torrent(db, cur, hash, torrent, id=None, torcache=None, quiet=Fals
             cur.execute("UPDATE torrents SET hash=%s WHERE hash=%s", (real_hash, hash))
         except MySQLdb.IntegrityError:
             cur.execute("DELETE FROM torrents WHERE hash=%s", (hash,))
-        os.rename("%s/%s.torrent" % (config.torrents_dir, hash), "%s/%s.torrent" % (config.torrents_dir, real_hash))
+        os.rename(torrent_path(config.torrents_dir, hash), torrent_path(config.torrents_dir, real_hash, create=True))
+        torrents_dir.discard(hash)
+        torrents_dir.add(real_hash)
 
 
 def update_db(db=None, hashs=None, torcache=None, quiet=False):
@@ -550,7 +602,7 @@ def update_db(db=None, hashs=None, torcache=None, quiet=False):
         print("Update db")
     try:
         for hash in hashs:
-            if os.path.isfile("%s/%s.torrent" % (config.torrents_dir, hash)) and not hash in failed:
+            if hash in torrents_dir and not hash in failed:
                 t = get_torrent(db, hash)
                 if t is None:
                     continue
@@ -562,8 +614,7 @@ def update_db(db=None, hashs=None, torcache=None, quiet=False):
 def clean_files(db=None):
     if db is None:
         db = MySQLdb.connect(**config.mysql)
-    files = os.listdir(config.torrents_dir)
-    hashs = [h[:-8] for h in files if h.endswith(".torrent")]
+    hashs = torrents_dir.hashs()
     cur = db.cursor()
     i=0
     step = 500
@@ -579,7 +630,8 @@ def clean_files(db=None):
         for hash, torcache in db_hashs:
             if torcache == 1:
                 announce(hash)
-            os.rename("%s/%s.torrent" % (config.torrents_dir, hash), "%s/%s.torrent" % (config.torrents_done, hash))
+            os.rename(torrent_path(config.torrents_dir, hash), torrent_path(config.torrents_done, hash, create=True))
+            torrents_dir.discard(hash)
             c+=1
             pbar.update(c)
         i=min(i + step, count)
@@ -591,40 +643,66 @@ def compact_torrent(db=None):
     """SUpprime les info des block du torrent"""
     if db is None:
         db = MySQLdb.connect(**config.mysql)
-    files = os.listdir(config.torrents_done)
-    hashs = [h[:-8] for h in files if h.endswith(".torrent")]
+    hashs = dirindex.list_torrents(config.torrents_done, config.torrents_sharded)
     cur = db.cursor()
     i=0
     step=500
-    archive_path = "%s/%s/" % (config.torrents_archive, time.strftime("%Y-%m-%d"))
-    try: os.mkdir(archive_path)
-    except OSError as e:
-        if e.errno != 17: # file exist
-            raise
+    archive = None
+    if config.torrents_archive_packed:
+        archive = pack.PackWriter("%s/%s" % (config.torrents_archive, time.strftime("%Y-%m-%d")), compression=config.torrents_archive_compression)
+    else:
+        archive_path = "%s/%s/" % (config.torrents_archive, time.strftime("%Y-%m-%d"))
+        try: os.mkdir(archive_path)
+        except OSError as e:
+            if e.errno != 17: # file exist
+                raise
     count = len(hashs)
     if count <= 0:
+        if archive is not None:
+            archive.close()
         return
     pbar = progressbar.ProgressBar(widgets=widget("files archived"), maxval=count).start()
-    while hashs[i:i+step]:
-        query = "SELECT hash, torcache FROM torrents WHERE created_at IS NOT NULL AND (%s)" % " OR ".join("hash=%s" for hash in hashs[i:i+step])
-        cur.execute(query, tuple(hashs[i:i+step]))
-        db_hashs = dict((r[0], r[1]) for r in cur)
-        c=i
-        for hash, torcache in db_hashs.items():
-            if config.compact_archived_torrents and torcache == 1:
-                torrent = get_torrent(db, hash, base_path=config.torrents_done)
-                torrent[b'info'][b'pieces'] = b''
-                with open("%s%s.torrent" % (archive_path, hash), 'wb+') as f:
-                    f.write(utils.bencode(torrent))
-                os.remove("%s/%s.torrent" % (config.torrents_done, hash))
-            else:
-                os.rename("%s/%s.torrent" % (config.torrents_done, hash), "%s%s.torrent" % (archive_path, hash))
-            c+=1
-            pbar.update(c)
-        i=min(i + step, count)
-        pbar.update(i)
+    try:
+        while hashs[i:i+step]:
+            query = "SELECT hash, torcache FROM torrents WHERE created_at IS NOT NULL AND (%s)" % " OR ".join("hash=%s" for hash in hashs[i:i+step])
+            cur.execute(query, tuple(hashs[i:i+step]))
+            db_hashs = dict((r[0], r[1]) for r in cur)
+            c=i
+            archived = []
+            for hash, torcache in db_hashs.items():
+                data = None
+                if config.compact_archived_torrents and torcache == 1:
+                    torrent = get_torrent(db, hash, base_path=config.torrents_done)
+                    if torrent is None:
+                        continue
+                    torrent[b'info'][b'pieces'] = b''
+                    data = utils.bencode(torrent)
+                if archive is not None:
+                    if data is None:
+                        with open(torrent_path(config.torrents_done, hash), 'rb') as f:
+                            data = f.read()
+                    archive.add(hash.lower().decode("hex"), data)
+                    archived.append(hash)
+                elif data is not None:
+                    with open(torrent_path(archive_path, hash, create=True), 'wb+') as f:
+                        f.write(data)
+                    os.remove(torrent_path(config.torrents_done, hash))
+                else:
+                    os.rename(torrent_path(config.torrents_done, hash), torrent_path(archive_path, hash, create=True))
+                c+=1
+                pbar.update(c)
+            # remove the archived files once the pack is on disk
+            if archive is not None:
+                archive.flush()
+                for hash in archived:
+                    os.remove(torrent_path(config.torrents_done, hash))
+            i=min(i + step, count)
+            pbar.update(i)
+    finally:
+        if archive is not None:
+            archive.close()
     pbar.finish()
-    
+
 def loop():
     last_clean = time.time()
     sql_error = False
@@ -638,6 +716,7 @@ def loop():
             try:
                 last_loop = time.time()
                 print("\n\n\nNEW LOOP")
+                torrents_dir.refresh()
                 get_new_torrent()
                 db = MySQLdb.connect(**config.mysql)
                 update_torrent_file(db)
@@ -678,7 +757,7 @@ def loop():
         print("exiting")
 def upload_to_torcache(db, hash, quiet=False):
     return False
-    files = {'torrent': open("%s/%s.torrent" % (config.torrents_dir, hash), 'rb')}
+    files = {'torrent': open(torrent_path(config.torrents_dir, hash), 'rb')}
     r = requests.post('http://torcache.net/autoupload.php', files=files)
     cur = db.cursor()
     try:
@@ -718,7 +797,7 @@ def feed_torcache(db, hashs=None):
             while True:
                 hash = hashsq.get(timeout=0)
                 tc = is_torcache(hash)
-                if not tc and os.path.isfile("%s/%s.torrent" % (config.torrents_dir, hash)):
+                if not tc and hash in torrents_dir:
                     try:
                         upload_to_torcache(db, hash, quiet=True)
                         counter[2]+=1
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+import os
+import math
+import time
+import mmap
+import struct
+from threading import Lock
+
+import MySQLdb
+import MySQLdb.cursors
+
+
+class BloomFilter(object):
+    """A fixed size bloom filter of 20 bytes info_hashes
+
+    info_hashes are already sha1 digests, so they are not hashed again: the
+    k bit positions are derived from the first 16 bytes of the info_hash
+    by double hashing.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(1, int(capacity))
+        self.m = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.k = max(1, int(round(self.m * math.log(2) / capacity)))
+        self.bits = bytearray((self.m + 7) // 8)
+        self.count = 0
+        self._lock = Lock()
+
+    def _positions(self, item):
+        h1, h2 = struct.unpack_from("!QQ", item)
+        h2 |= 1
+        m = self.m
+        return [(h1 + i * h2) % m for i in range(self.k)]
+
+    def add(self, item):
+        with self._lock:
+            bits = self.bits
+            for p in self._positions(item):
+                bits[p >> 3] |= 1 << (p & 7)
+            self.count += 1
+
+    def __contains__(self, item):
+        bits = self.bits
+        for p in self._positions(item):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def size(self):
+        """memory used by the bit array in bytes"""
+        return len(self.bits)
+
+
+class NegativeCache(object):
+    """A bounded set of recently seen hashs, each remembered for `ttl` seconds
+
+    Hashs are stored in generations, one set per `ttl/generations` seconds.
+    A whole generation is dropped when its most recent hash is older than `ttl`
+    (so hashs are remembered at most `ttl + ttl/generations` seconds), or
+    early when the cache reach its capacity. Eviction never scan the hashs.
+    """
+
+    def __init__(self, capacity, ttl=600, generations=4):
+        self.ttl = ttl
+        # one more generation than needed to cover ttl: the oldest one is
+        # dropped when its most recent hash is older than ttl
+        self.generations = generations + 1
+        self.generation_capacity = max(1, capacity // self.generations)
+        self.generation_ttl = float(ttl) / generations
+        # [(start time, set of hashs)], the newest generation first
+        self._gens = [(time.time(), set())]
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def _rotate(self):
+        now = time.time()
+        start, gen = self._gens[0]
+        if now - start < self.generation_ttl and len(gen) < self.generation_capacity:
+            return
+        with self._lock:
+            start, gen = self._gens[0]
+            if now - start < self.generation_ttl and len(gen) < self.generation_capacity:
+                return
+            self._gens.insert(0, (now, set()))
+            # hashs are only added to a generation during its generation_ttl
+            # first seconds
+            while now - self._gens[-1][0] - self.generation_ttl > self.ttl:
+                self.expired += len(self._gens.pop()[1])
+            while len(self._gens) > self.generations:
+                self.evictions += len(self._gens.pop()[1])
+
+    def add(self, item):
+        self._rotate()
+        self._gens[0][1].add(item)
+
+    def discard(self, item):
+        for _, gen in self._gens:
+            gen.discard(item)
+
+    def __contains__(self, item):
+        self._rotate()
+        for _, gen in self._gens:
+            if item in gen:
+                self.hits += 1
+                return True
+        self.misses += 1
+        return False
+
+    def __len__(self):
+        return sum(len(gen) for _, gen in self._gens)
+
+    def stats(self):
+        return {
+            'size': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expired': self.expired,
+        }
+
+
+def load_bloom_filter(mysql, capacity, error_rate=0.001, errornb=0):
+    """Return a BloomFilter of every hash with `created_at IS NOT NULL`
+
+    The rows are streamed with a server side cursor, so the full result set is
+    never held in memory.
+    """
+    bloom = BloomFilter(capacity, error_rate)
+    db = MySQLdb.connect(cursorclass=MySQLdb.cursors.SSCursor, **mysql)
+    try:
+        cur = db.cursor()
+        cur.execute("SELECT UNHEX(hash) FROM torrents WHERE created_at IS NOT NULL")
+        for r in cur:
+            if r[0] and len(r[0]) == 20:
+                bloom.add(r[0])
+        cur.close()
+        return bloom
+    except (MySQLdb.Error, ) as e:
+        if errornb > 10:
+            raise
+        return load_bloom_filter(mysql, capacity, error_rate, errornb=errornb+1)
+    finally:
+        try:db.close()
+        except:pass
+
+
+class HashIndex(object):
+    """A read only, memory mapped, sorted file of 20 bytes info_hashes
+
+    Every process mapping the same file share the same page cache copy. The
+    file is replaced atomically by build_hash_index, call reload to map the
+    new file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._inode = None
+        # (mmap, number of hashs), replaced at once by reload
+        self._map = (None, 0)
+        self.reload()
+
+    def reload(self):
+        """Map the file if it has been replaced since the last call. Return True if remapped"""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        if (st.st_ino, st.st_mtime) == self._inode:
+            return False
+        with open(self.path, 'rb') as f:
+            if st.st_size >= 20:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                mm = None
+        # the old map is not closed as other threads may still be reading it,
+        # it will be unmapped then garbage collected
+        self._map = (mm, st.st_size // 20)
+        self._inode = (st.st_ino, st.st_mtime)
+        return True
+
+    @property
+    def loaded(self):
+        return self._inode is not None
+
+    def __len__(self):
+        return self._map[1]
+
+    def __contains__(self, item):
+        mm, count = self._map
+        if mm is None:
+            return False
+        lo = 0
+        hi = count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            h = mm[mid * 20:mid * 20 + 20]
+            if h < item:
+                lo = mid + 1
+            elif h > item:
+                hi = mid
+            else:
+                return True
+        return False
+
+
+def build_hash_index(mysql, path):
+    """Write the sorted index of hashs with `created_at IS NOT NULL` in `path`
+
+    The index is written in a temporary file then renamed to `path` so that
+    processes mapping it always see a complete file. Return the number of hashs.
+    """
+    tmp_path = "%s.tmp.%s" % (path, os.getpid())
+    db = MySQLdb.connect(cursorclass=MySQLdb.cursors.SSCursor, **mysql)
+    try:
+        cur = db.cursor()
+        # hash is an ascii case insensitive column: its index order is the
+        # binary order of the unhexed hashs
+        cur.execute("SELECT UNHEX(hash) FROM torrents WHERE created_at IS NOT NULL ORDER BY hash")
+        count = 0
+        last = ""
+        is_sorted = True
+        with open(tmp_path, 'wb') as f:
+            for r in cur:
+                if not r[0] or len(r[0]) != 20 or r[0] == last:
+                    continue
+                if r[0] < last:
+                    is_sorted = False
+                f.write(r[0])
+                last = r[0]
+                count += 1
+            cur.close()
+            if not is_sorted:
+                f.flush()
+                hashs = set()
+                with open(tmp_path, 'rb') as fr:
+                    h = fr.read(20)
+                    while h:
+                        hashs.add(h)
+                        h = fr.read(20)
+                hashs = sorted(hashs)
+                f.seek(0)
+                f.truncate()
+                f.write("".join(hashs))
+                count = len(hashs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+        return count
+    finally:
+        try:db.close()
+        except:pass
+        try:os.remove(tmp_path)
+        except OSError:pass
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Move the .torrent files of torrents_dir, torrents_done and the daily
+archive directories to the layout set by torrents_sharded in config.py
+
+usage: ./migrate_layout.py [--flat|--sharded] [directory ...]
+
+Without directory, torrents_dir, torrents_done and every directory of
+torrents_archive are migrated. Stop crawler.py and feed.py before running it.
+"""
+import os
+import sys
+import progressbar
+
+import config
+import dirindex
+
+
+def archive_dirs(archive):
+    """Return the daily archive directories of `archive`, pack files are not migrated"""
+    try:
+        names = sorted(os.listdir(archive))
+    except OSError:
+        return []
+    return [os.path.join(archive, name) for name in names if os.path.isdir(os.path.join(archive, name))]
+
+
+def migrate(path, sharded):
+    """Move the .torrent files of `path` to the sharded (or flat) layout"""
+    hashs = dirindex.list_torrents(path, not sharded)
+    if not hashs:
+        return 0
+    progress = progressbar.ProgressBar(widgets=[progressbar.ETA(), ' ', progressbar.Bar('='), ' ', progressbar.SimpleProgress(), ' ', path])
+    for hash in progress(hashs):
+        os.rename(dirindex.torrent_path(path, hash, not sharded), dirindex.torrent_path(path, hash, sharded, create=True))
+    if not sharded:
+        # remove the now empty shard directories
+        for d1 in os.listdir(path):
+            if len(d1) != 2 or not os.path.isdir(os.path.join(path, d1)):
+                continue
+            for d2 in os.listdir(os.path.join(path, d1)):
+                try: os.rmdir(os.path.join(path, d1, d2))
+                except OSError: pass
+            try: os.rmdir(os.path.join(path, d1))
+            except OSError: pass
+    return len(hashs)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    sharded = config.torrents_sharded
+    if "--flat" in args:
+        sharded = False
+        args.remove("--flat")
+    if "--sharded" in args:
+        sharded = True
+        args.remove("--sharded")
+    for path in (args or [config.torrents_dir, config.torrents_done] + archive_dirs(config.torrents_archive)):
+        print("%s: %s files moved" % (path, migrate(path, sharded)))
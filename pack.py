@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""Append only archive of torrents, one pack file by day
+
+A pack is made of two files:
+ * `<name>.pack`: the records, each one a 25 bytes header (info_hash,
+   compression, length) followed by the, possibly compressed, torrent.
+ * `<name>.idx`: the sorted index of the pack, 33 bytes by record
+   (info_hash, offset of the data, length, compression). It is rewritten
+   once when the writer is closed, the records appended since are found by
+   reading the pack past its indexed end.
+"""
+import os
+import mmap
+import zlib
+import struct
+
+try:
+    import zstd
+except ImportError:
+    zstd = None
+
+HEADER = struct.Struct("!20sBI")
+ENTRY = struct.Struct("!20sQIB")
+
+NONE = 0
+ZLIB = 1
+ZSTD = 2
+COMPRESSIONS = {None: NONE, "zlib": ZLIB, "zstd": ZSTD}
+
+
+def compress(data, compression):
+    if compression == ZLIB:
+        return zlib.compress(data, 6)
+    elif compression == ZSTD:
+        return zstd.compress(data)
+    return data
+
+
+def decompress(data, compression):
+    if compression == ZLIB:
+        return zlib.decompress(data)
+    elif compression == ZSTD:
+        if zstd is None:
+            raise ValueError("zstd compressed record but the zstd module is not installed")
+        return zstd.decompress(data)
+    return data
+
+
+def read_index(path):
+    """Return the {info_hash: (offset, length, compression)} of an index file"""
+    entries = {}
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return entries
+    for i in range(0, len(data) - ENTRY.size + 1, ENTRY.size):
+        (hash, offset, length, compression) = ENTRY.unpack_from(data, i)
+        entries[hash] = (offset, length, compression)
+    return entries
+
+
+class PackWriter(object):
+    """Append torrents to the pack `path` (without extension)"""
+
+    def __init__(self, path, compression="zlib"):
+        if compression not in COMPRESSIONS:
+            raise ValueError("Unknown compression %r" % compression)
+        if compression == "zstd" and zstd is None:
+            raise ValueError("zstd compression needs the zstd module")
+        self.path = path
+        self.compression = COMPRESSIONS[compression]
+        self.entries = read_index("%s.idx" % path)
+        self._file = open("%s.pack" % path, 'ab+')
+        self._dirty = False
+        self._recover()
+
+    def _recover(self):
+        """Index the records appended after the last index write, drop a truncated last record"""
+        end = max([offset + length for (offset, length, _) in self.entries.values()] or [0])
+        self._file.seek(0, os.SEEK_END)
+        size = self._file.tell()
+        while end < size:
+            self._file.seek(end)
+            header = self._file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                break
+            (hash, compression, length) = HEADER.unpack(header)
+            if end + HEADER.size + length > size:
+                break
+            self.entries[hash] = (end + HEADER.size, length, compression)
+            end += HEADER.size + length
+            self._dirty = True
+        if end < size:
+            self._file.truncate(end)
+        self._file.seek(0, os.SEEK_END)
+
+    def __contains__(self, hash):
+        return hash in self.entries
+
+    def add(self, hash, data):
+        """Append the torrent `data` of the 20 bytes `hash`"""
+        data = compress(data, self.compression)
+        offset = self._file.tell()
+        self._file.write(HEADER.pack(hash, self.compression, len(data)))
+        self._file.write(data)
+        self.entries[hash] = (offset + HEADER.size, len(data), self.compression)
+        self._dirty = True
+
+    def flush(self):
+        """Sync the pack on disk, its records are then readable without the index"""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def write_index(self):
+        """Rewrite the sorted index of the pack"""
+        if not self._dirty:
+            return
+        tmp_path = "%s.idx.tmp" % self.path
+        with open(tmp_path, 'wb') as f:
+            for hash in sorted(self.entries):
+                (offset, length, compression) = self.entries[hash]
+                f.write(ENTRY.pack(hash, offset, length, compression))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, "%s.idx" % self.path)
+        self._dirty = False
+
+    def close(self):
+        self.flush()
+        self.write_index()
+        self._file.close()
+
+
+class PackReader(object):
+    """Random access to the torrents of the pack `path` (without extension) by info_hash"""
+
+    def __init__(self, path):
+        self.path = path
+        self._index = None
+        self._pack = None
+        try:
+            with open("%s.idx" % path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size >= ENTRY.size:
+                    self._index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except IOError:
+            pass # not written yet, every record is in the tail
+        with open("%s.pack" % path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size > 0:
+                self._pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.count = len(self._index) // ENTRY.size if self._index is not None else 0
+        # records appended after the index was written, as PackWriter._recover
+        self._tail = {} # info_hash -> (hash, offset, length, compression)
+        self._read_tail()
+
+    def _read_tail(self):
+        if self._pack is None:
+            return
+        end = 0
+        for i in range(self.count):
+            (_, offset, length, _) = self._entry(i)
+            end = max(end, offset + length)
+        size = len(self._pack)
+        while end + HEADER.size <= size:
+            (hash, compression, length) = HEADER.unpack_from(self._pack, end)
+            if end + HEADER.size + length > size:
+                break
+            self._tail[hash] = (hash, end + HEADER.size, length, compression)
+            end += HEADER.size + length
+
+    def _entry(self, i):
+        return ENTRY.unpack_from(self._index, i * ENTRY.size)
+
+    def _find(self, hash):
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = self._entry(mid)
+            if entry[0] < hash:
+                lo = mid + 1
+            elif entry[0] > hash:
+                hi = mid
+            else:
+                return entry
+        return self._tail.get(hash)
+
+    def __contains__(self, hash):
+        return self._find(hash) is not None
+
+    def __len__(self):
+        return self.count + len(self._tail)
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self._entry(i)[0]
+        for hash in self._tail:
+            yield hash
+
+    def get(self, hash):
+        """Return the torrent of the 20 bytes `hash`, or None if it is not in the pack"""
+        entry = self._find(hash)
+        if entry is None:
+            return None
+        (_, offset, length, compression) = entry
+        return decompress(self._pack[offset:offset + length], compression)
+
+    def close(self):
+        for m in [self._index, self._pack]:
+            if m is not None:
+                m.close()
+
+
+# path -> (stat of the pack and its index, PackReader) of the packs opened by find
+_readers = {}
+
+def reader(path):
+    """Return a PackReader of `path`, reused until the pack or its index change"""
+    key = []
+    for name in ["%s.pack" % path, "%s.idx" % path]:
+        try:
+            st = os.stat(name)
+            key.append((st.st_ino, st.st_mtime, st.st_size))
+        except OSError:
+            key.append(None)
+    cached = _readers.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    pack = PackReader(path)
+    _readers[path] = (key, pack)
+    if cached is not None:
+        cached[1].close()
+    return pack
+
+
+def find(archive_dir, hash):
+    """Look for the 20 bytes `hash` in every pack of `archive_dir`, newest first"""
+    names = sorted((f[:-5] for f in os.listdir(archive_dir) if f.endswith(".pack")), reverse=True)
+    for name in names:
+        data = reader(os.path.join(archive_dir, name)).get(hash)
+        if data is not None:
+            return data
+    return None
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+import time
+import heapq
+import itertools
+import collections
+import threading
+
+
+# peers priorities, lower first
+ANNOUNCED = 0 # the peer sent an announce_peer for the hash
+FOUND = 1 # the peer was in a get_peers response
+
+
+class FetchState(object):
+    """Metadata fetch state of one info_hash"""
+    __slots__ = ('hash', 'tried', 'totry', 'unscored', 'scored', 'seq', 'announced', 'failed_count', 'last_fail', 'next_attempt', 'added')
+
+    def __init__(self, hash):
+        self.hash = hash
+        self.tried = set() # (ip, port) already given to the client
+        self.totry = set() # (ip, port) to give to the client
+        self.unscored = [] # (ip, port) added to totry and not in scored yet
+        self.scored = [] # heap of (score, seq, (ip, port)), may hold peers no longer in totry
+        self.seq = itertools.count()
+        self.announced = [] # (ip, port) to give to the client first, the last announced first
+        self.failed_count = 0 # attempts without any peer to try
+        self.last_fail = 0
+        self.next_attempt = 0
+        self.added = time.time()
+
+    def has_peers(self):
+        return bool(self.announced or self.totry)
+
+    def add_peer(self, peer):
+        self.totry.add(peer)
+        self.unscored.append(peer)
+
+    def pop_peer(self, reputation=None):
+        """Return ((ip, port), priority) of the most promising peer to try, raise KeyError if none
+
+        With a PeerReputation, known bad peers are skipped and, after the
+        announced ones, the peers which already sent metadata are tried first.
+        """
+        while self.announced:
+            peer = self.announced.pop()
+            if not peer in self.tried:
+                self.tried.add(peer)
+                if reputation is not None and reputation.is_bad(peer):
+                    continue
+                return (peer, ANNOUNCED)
+        if reputation is None:
+            peer = self.totry.pop()
+            self.tried.add(peer)
+            return (peer, FOUND)
+        # each peer is scored once when first needed, then kept in a heap
+        for peer in self.unscored:
+            if peer in self.totry:
+                heapq.heappush(self.scored, (reputation.score(peer), next(self.seq), peer))
+        self.unscored = []
+        while self.scored:
+            (score, _, peer) = heapq.heappop(self.scored)
+            if not peer in self.totry:
+                continue
+            # the reputation may have changed since the peer was scored
+            current = reputation.score(peer)
+            if current is None:
+                self.totry.discard(peer)
+                self.tried.add(peer)
+                continue
+            if score is None or current > score:
+                heapq.heappush(self.scored, (current, next(self.seq), peer))
+                continue
+            self.totry.discard(peer)
+            self.tried.add(peer)
+            return (peer, FOUND)
+        raise KeyError("no peer to try")
+
+
+class PeerRecord(object):
+    __slots__ = ('connect_failed', 'not_extended', 'no_metadata', 'metadata_sent', 'latency', 'bad_until')
+
+    def __init__(self):
+        self.connect_failed = 0
+        self.not_extended = 0 # no BEP 10 extension protocol
+        self.no_metadata = 0 # no ut_metadata or no piece sent
+        self.metadata_sent = 0
+        self.latency = None # seconds from connect to the first metadata piece
+        self.bad_until = 0
+
+
+class PeerReputation(object):
+    """Bounded LRU of the metadata download outcomes of the peers, keyed by (ip, port)
+
+    A peer failing is considered bad, and skipped, for `ttl` seconds unless
+    it sends metadata in between. The least recently updated peers are
+    forgotten past `size` peers.
+    """
+    # score of the peers without any outcome recorded, lower is better
+    UNKNOWN = 1000
+
+    def __init__(self, size=200000, ttl=3600):
+        self.size = size
+        self.ttl = ttl
+        self._peers = collections.OrderedDict() # (ip, port) -> PeerRecord
+        self._lock = threading.Lock()
+        self.skipped = 0
+
+    def __len__(self):
+        return len(self._peers)
+
+    def _record(self, peer):
+        """Return the PeerRecord of peer, as the most recently used"""
+        record = self._peers.pop(peer, None)
+        if record is None:
+            record = PeerRecord()
+            if len(self._peers) >= self.size:
+                self._peers.popitem(last=False)
+        self._peers[peer] = record
+        return record
+
+    def _failed(self, peer, field):
+        with self._lock:
+            record = self._record(peer)
+            setattr(record, field, getattr(record, field) + 1)
+            record.bad_until = time.time() + self.ttl
+
+    def connect_failed(self, peer):
+        self._failed(peer, 'connect_failed')
+
+    def not_extended(self, peer):
+        self._failed(peer, 'not_extended')
+
+    def no_metadata(self, peer):
+        self._failed(peer, 'no_metadata')
+
+    def metadata_sent(self, peer, latency):
+        with self._lock:
+            record = self._record(peer)
+            record.metadata_sent += 1
+            record.latency = latency if record.latency is None else (record.latency + latency) / 2.0
+            record.bad_until = 0
+
+    def is_bad(self, peer):
+        record = self._peers.get(peer)
+        if record is not None and record.bad_until > time.time():
+            self.skipped += 1
+            return True
+        return False
+
+    def score(self, peer):
+        """Return None for a bad peer, else a score, lower is better"""
+        record = self._peers.get(peer)
+        if record is None:
+            return self.UNKNOWN
+        if record.bad_until > time.time():
+            self.skipped += 1
+            return None
+        if record.metadata_sent:
+            return min(record.latency, self.UNKNOWN - 1)
+        # failed more than ttl seconds ago
+        return self.UNKNOWN + 1
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            records = list(self._peers.values())
+        return {
+            'peers': len(records),
+            'bad': sum(1 for record in records if record.bad_until > now),
+            'good': sum(1 for record in records if record.metadata_sent),
+            'skipped': self.skipped,
+        }
+
+
+class FetchScheduler(object):
+    """Schedule the metadata fetch attempts of the info_hashes to fetch
+
+    Hashs are kept in a heap ordered by their next attempt time, `pop` block
+    until an attempt is due. New peers and completed metadata wake the hash
+    immediately, completions being returned first. `call` queues a function
+    to be run by the thread calling `pop`.
+    """
+
+    def __init__(self):
+        self._states = {} # hash -> FetchState
+        self._heap = [] # (next_attempt, seq, hash)
+        self._seq = itertools.count()
+        self._completed = collections.deque()
+        self._calls = collections.deque() # (function, args)
+        self._cond = threading.Condition()
+
+    def __contains__(self, hash):
+        return hash in self._states
+
+    def __len__(self):
+        return len(self._states)
+
+    def get(self, hash):
+        return self._states.get(hash)
+
+    def _schedule(self, state, when):
+        state.next_attempt = when
+        heapq.heappush(self._heap, (when, next(self._seq), state.hash))
+
+    def schedule(self, hash, when):
+        """Schedule the next attempt of `hash` at `when`"""
+        with self._cond:
+            state = self._states.get(hash)
+            if state is not None:
+                self._schedule(state, when)
+                self._cond.notify()
+
+    def add(self, hash):
+        """Start fetching `hash`, return False if it was already fetched"""
+        with self._cond:
+            if hash in self._states:
+                return False
+            state = FetchState(hash)
+            self._states[hash] = state
+            self._schedule(state, time.time())
+            self._cond.notify()
+            return True
+
+    def add_peers(self, hash, peers, announced=False):
+        """Add peers to try for `hash` and wake it if some are new"""
+        with self._cond:
+            state = self._states.get(hash)
+            if state is None:
+                return
+            new = False
+            for peer in peers:
+                if announced and not peer in state.tried:
+                    state.totry.discard(peer)
+                    state.announced.append(peer)
+                    new = True
+                elif not peer in state.tried and not peer in state.totry:
+                    state.add_peer(peer)
+                    new = True
+            if new and state.next_attempt > time.time():
+                self._schedule(state, time.time())
+                self._cond.notify()
+
+    def complete(self, hash):
+        """Called when the metadata of `hash` has been downloaded"""
+        with self._cond:
+            if hash in self._states:
+                self._completed.append(hash)
+                self._cond.notify()
+
+    def call(self, function, *args):
+        """Have `pop` return ("call", (function, args)) so function(*args) is run by its caller"""
+        with self._cond:
+            self._calls.append((function, args))
+            self._cond.notify()
+
+    def pop_peer(self, state, reputation=None):
+        """FetchState.pop_peer of state, safe against concurrent add_peers"""
+        with self._cond:
+            return state.pop_peer(reputation)
+
+    def remove(self, hash):
+        with self._cond:
+            try: del self._states[hash]
+            except KeyError: pass
+
+    def pop(self, timeout=1):
+        """Return ("complete", hash), ("call", (function, args)), ("attempt", FetchState) or None after `timeout` seconds"""
+        end = time.time() + timeout
+        with self._cond:
+            while True:
+                if self._completed:
+                    return ("complete", self._completed.popleft())
+                if self._calls:
+                    return ("call", self._calls.popleft())
+                now = time.time()
+                while self._heap and self._heap[0][0] <= now:
+                    (when, _, hash) = heapq.heappop(self._heap)
+                    state = self._states.get(hash)
+                    # skip removed and rescheduled hashs
+                    if state is not None and state.next_attempt == when:
+                        state.next_attempt = float('inf')
+                        return ("attempt", state)
+                if now >= end:
+                    return None
+                wait = end - now
+                if self._heap:
+                    wait = min(wait, self._heap[0][0] - now)
+                self._cond.wait(wait)
@@ -1,17 +1,19 @@
-import binascii, urllib, socket, random, struct
+import binascii, urllib, urllib2, socket, random, struct, select, errno, time, collections
+from threading import Thread, Lock, Event
 from btdht.utils import bdecode
 try:
     from urllib.parse import urlparse, urlunsplit
 except ImportError:
     from urlparse import urlparse, urlunsplit
    
-def scrape(tracker, hashes):
+def scrape(tracker, hashes, timeout=None):
 	"""
 	Returns the list of seeds, peers and downloads a torrent info_hash has, according to the specified tracker
 
 	Args:
 		tracker (str): The announce url for a tracker, usually taken directly from the torrent metadata
 		hashes (list): A list of torrent info_hash's to query the tracker for
+		timeout (float): The http request timeout in seconds, None for no timeout
 
 	Returns:
 		A dict of dicts. The key is the torrent info_hash's from the 'hashes' parameter,
@@ -31,7 +33,7 @@ def scrape(tracker, hashes):
 		if "announce" not in tracker:
 			raise RuntimeError("%s doesnt support scrape" % tracker)
 		parsed = urlparse(tracker.replace("announce", "scrape"))		 
-		return scrape_http(parsed, hashes)
+		return scrape_http(parsed, hashes, timeout)
 
 	raise RuntimeError("Unknown tracker scheme: %s" % parsed.scheme)	
 
@@ -57,8 +59,8 @@ def scrape_udp(parsed_tracker, hashes):
 	buf = sock.recvfrom(2048)[0]
 	return udp_parse_scrape_response(buf, transaction_id, hashes)
 
-def scrape_http(parsed_tracker, hashes):
-	print("Scraping HTTP: %s for %s hashes" % (parsed_tracker.geturl(), len(hashes)))
+def scrape_http(parsed_tracker, hashes, timeout=None):
+	#print("Scraping HTTP: %s for %s hashes" % (parsed_tracker.geturl(), len(hashes)))
 	qs = []
 	for hash in hashes:
 		url_param = binascii.a2b_hex(hash)
@@ -66,7 +68,7 @@ def scrape_http(parsed_tracker, hashes):
 	qs = urllib.urlencode(qs)
 	pt = parsed_tracker	
 	url = urlunsplit((pt.scheme, pt.netloc, pt.path, qs, pt.fragment))
-	handle = urllib.urlopen(url);
+	handle = urllib2.urlopen(url, timeout=timeout) if timeout else urllib2.urlopen(url)
 	if handle.getcode() is not 200:
 		raise RuntimeError("%s status code returned" % handle.getcode())	
 	decoded = bdecode(handle.read())
@@ -79,70 +81,620 @@ def scrape_http(parsed_tracker, hashes):
 		ret[nice_hash] = { "seeds" : s, "peers" : p, "complete" : c}		
 	return ret
 
-def udp_create_connection_request():
+def udp_create_connection_request(transaction_id=None):
 	connection_id = 0x41727101980 #default connection id
 	action = 0x0 #action (0 = give me a new connection id)	
-	transaction_id = udp_get_transaction_id()
+	if transaction_id is None:
+		transaction_id = udp_get_transaction_id()
 	buf = struct.pack("!q", connection_id) #first 8 bytes is connection id
 	buf += struct.pack("!i", action) #next 4 bytes is action
-	buf += struct.pack("!i", transaction_id) #next 4 bytes is transaction id
+	buf += struct.pack("!I", transaction_id) #next 4 bytes is transaction id
 	return (buf, transaction_id)
 
 def udp_parse_connection_response(buf, sent_transaction_id):
-	if len(buf) < 16:
-		raise RuntimeError("Wrong response length getting connection id: %s" % len(buf))			
-	action = struct.unpack_from("!i", buf)[0] #first 4 bytes is action
-
-	res_transaction_id = struct.unpack_from("!i", buf, 4)[0] #next 4 bytes is transaction id
+	if len(buf) < 8:
+		raise RuntimeError("Wrong response length getting connection id: %s" % len(buf))
+	(action, res_transaction_id) = struct.unpack_from("!iI", buf) #action then transaction id, 4 bytes each
 	if res_transaction_id != sent_transaction_id:
 		raise RuntimeError("Transaction ID doesnt match in connection response! Expected %s, got %s"
 			% (sent_transaction_id, res_transaction_id))
 
 	if action == 0x0:
+		if len(buf) < 16:
+			raise RuntimeError("Wrong response length getting connection id: %s" % len(buf))
 		connection_id = struct.unpack_from("!q", buf, 8)[0] #unpack 8 bytes from byte 8, should be the connection_id
 		return connection_id
-	elif action == 0x3:		
-		error = struct.unpack_from("!s", buf, 8)
-		raise RuntimeError("Error while trying to get a connection response: %s" % error)
-	pass
+	elif action == 0x3:
+		raise RuntimeError("Error while trying to get a connection response: %s" % buf[8:])
+	raise RuntimeError("Unknown action getting connection id: %s" % action)
 
-def udp_create_scrape_request(connection_id, hashes):
+def udp_create_scrape_request(connection_id, hashes, transaction_id=None):
 	action = 0x2 #action (2 = scrape)
-	transaction_id = udp_get_transaction_id()
+	if transaction_id is None:
+		transaction_id = udp_get_transaction_id()
 	buf = struct.pack("!q", connection_id) #first 8 bytes is connection id
 	buf += struct.pack("!i", action) #next 4 bytes is action 
-	buf += struct.pack("!i", transaction_id) #followed by 4 byte transaction id
+	buf += struct.pack("!I", transaction_id) #followed by 4 byte transaction id
 	#from here on, there is a list of info_hashes. They are packed as char[]
 	for hash in hashes:		
 		hex_repr = binascii.a2b_hex(hash)
 		buf += struct.pack("!20s", hex_repr)
 	return (buf, transaction_id)
 
-def udp_parse_scrape_response(buf, sent_transaction_id, hashes):	
-	if len(buf) < 16:
-		raise RuntimeError("Wrong response length while scraping: %s" % len(buf))	
-	action = struct.unpack_from("!i", buf)[0] #first 4 bytes is action
-	res_transaction_id = struct.unpack_from("!i", buf, 4)[0] #next 4 bytes is transaction id	
+def udp_parse_scrape_response(buf, sent_transaction_id, hashes):
+	"""
+	Return the scrape result of the hashes of `hashes` present in `buf`
+
+	A truncated response only has the result of the first hashes, the
+	missing hashes are not in the returned dict.
+	"""
+	if len(buf) < 8:
+		raise RuntimeError("Wrong response length while scraping: %s" % len(buf))
+	(action, res_transaction_id) = struct.unpack_from("!iI", buf) #action then transaction id, 4 bytes each
 	if res_transaction_id != sent_transaction_id:
 		raise RuntimeError("Transaction ID doesnt match in scrape response! Expected %s, got %s"
 			% (sent_transaction_id, res_transaction_id))
 	if action == 0x2:
+		#data starts at byte 8, 12 bytes by hash in the request order
+		count = min((len(buf) - 8) // 12, len(hashes))
+		values = struct.unpack_from("!%di" % (3 * count), buf, 8)
 		ret = {}
-		offset = 8; #next 4 bytes after action is transaction_id, so data doesnt start till byte 8		
-		for hash in hashes:
-			seeds = struct.unpack_from("!i", buf, offset)[0]
-			offset += 4
-			complete = struct.unpack_from("!i", buf, offset)[0]
-			offset += 4
-			leeches = struct.unpack_from("!i", buf, offset)[0]
-			offset += 4			
-			ret[hash] = { "seeds" : seeds, "peers" : leeches, "complete" : complete }
+		for i in range(count):
+			(seeds, complete, leeches) = values[3*i:3*i+3]
+			ret[hashes[i]] = { "seeds" : seeds, "peers" : leeches, "complete" : complete }
 		return ret
 	elif action == 0x3:
-		#an error occured, try and extract the error string
-		error = struct.unpack_from("!s", buf, 8)
-		raise RuntimeError("Error while scraping: %s" % error)
+		#an error occured, the rest of the response is the error string
+		raise RuntimeError("Error while scraping: %s" % buf[8:])
+	raise RuntimeError("Unknown action while scraping: %s" % action)
 
 def udp_get_transaction_id():
-	return int(random.randrange(0, 255))
+	return random.getrandbits(32)
+
+
+
+def resolve(tracker):
+	"""Return the list of the (ip, port) of the udp `tracker` announce url"""
+	parsed = urlparse(tracker.lower())
+	if parsed.scheme != "udp":
+		raise RuntimeError("Not an udp tracker: %s" % tracker)
+	return [s[4] for s in socket.getaddrinfo(parsed.hostname, parsed.port, socket.AF_INET, socket.SOCK_DGRAM)]
+
+class UdpTransaction(object):
+	"""A connect or scrape request waiting for its response"""
+	__slots__ = ('transaction_id', 'addr', 'hashes', 'callback', 'request', 'tries', 'deadline')
+
+	def __init__(self, addr, hashes, callback):
+		self.transaction_id = None
+		self.addr = addr
+		self.hashes = hashes # None for a connect request
+		self.callback = callback
+		self.request = None
+		self.tries = 0
+		self.deadline = 0
+
+class UdpScraper(object):
+	"""
+	Scrape udp trackers through one socket with many transactions in flight
+
+	Batches of hashes are queued by `submit` and scraped by the scraper thread,
+	at most `max_in_flight` at once. Responses are matched to their request by
+	transaction id and the connection id of a tracker is reused during its
+	`connection_ttl` seconds lifetime (BEP 15). A request not answered is sent
+	again after `timeout` * 2 ** tries seconds, at most `max_retry` times.
+
+	`callback(hashes, result, error)` is called from the scraper thread with the
+	result of `scrape` or the exception which made the batch fail. The hashes
+	missing from a truncated response are scraped again and passed to another
+	call of `callback`.
+	"""
+
+	def __init__(self, max_in_flight=100, timeout=2, max_retry=4, connection_ttl=60):
+		self.max_in_flight = max_in_flight
+		self.timeout = timeout
+		self.max_retry = max_retry
+		self.connection_ttl = connection_ttl
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.setblocking(0)
+		self._queue = collections.deque() # UdpTransaction not sent yet
+		self._transactions = {} # transaction_id -> UdpTransaction
+		self._connections = {} # addr -> (connection_id, time)
+		self._connecting = {} # addr -> [UdpTransaction] waiting for a connection id
+		self._in_flight = 0
+		self.stoped = True
+		self.threads = []
+
+		self.scraped = 0
+		self.failed = 0
+		self.sent = 0
+		self.received = 0
+		self.retransmitted = 0
+		self.connects = 0
+		self.truncated = 0
+
+	def start(self):
+		self.stoped = False
+		t = Thread(target=self._loop)
+		t.setName("UdpScraper:loop")
+		t.daemon = True
+		t.start()
+		self.threads.append(t)
+
+	def stop(self):
+		self.stoped = True
+		for t in self.threads:
+			t.join()
+		self.sock.close()
+
+	def submit(self, addr, hashes, callback):
+		"""Queue the scrape of the hex `hashes` on the tracker at `addr` (ip, port)"""
+		if len(hashes) > 74:
+			raise RuntimeError("Only 74 hashes can be scraped on a UDP tracker due to UDP limitations")
+		self._queue.append(UdpTransaction(addr, hashes, callback))
+
+	def pending(self):
+		return len(self._queue) + self._in_flight
+
+	def stats(self):
+		return {
+			'pending': len(self._queue),
+			'in_flight': self._in_flight,
+			'scraped': self.scraped,
+			'failed': self.failed,
+			'sent': self.sent,
+			'received': self.received,
+			'retransmitted': self.retransmitted,
+			'connects': self.connects,
+			'truncated': self.truncated,
+		}
+
+	def _loop(self):
+		while not self.stoped:
+			while self._queue and self._in_flight < self.max_in_flight:
+				self._in_flight += 1
+				self._scrape(self._queue.popleft())
+			try:
+				(readable, _, _) = select.select([self.sock], [], [], 0.1)
+				if readable:
+					self._recv()
+				self._expire()
+			except select.error as e:
+				if e.args[0] != errno.EINTR:
+					print("UdpScraper: %r" % e)
+					time.sleep(0.1)
+			except Exception as e:
+				# pending transactions are failed or retried on their deadline
+				print("UdpScraper: %r" % e)
+				time.sleep(0.1)
+		# fail everything still pending
+		for transaction in list(self._transactions.values()) + list(self._queue):
+			if transaction.hashes is not None:
+				self._done(transaction, None, RuntimeError("scraper stopped"))
+			else:
+				for waiting in self._connecting.pop(transaction.addr, []):
+					self._done(waiting, None, RuntimeError("scraper stopped"))
+		self._transactions.clear()
+		self._queue.clear()
+
+	def _send(self, transaction, request, transaction_id):
+		transaction.transaction_id = transaction_id
+		transaction.request = request
+		transaction.deadline = time.time() + self.timeout * 2 ** transaction.tries
+		self._transactions[transaction_id] = transaction
+		try:
+			self.sock.sendto(request, transaction.addr)
+			self.sent += 1
+		except socket.error:
+			# retried on the deadline like a lost packet
+			pass
+
+	def _new_transaction_id(self):
+		transaction_id = udp_get_transaction_id()
+		while transaction_id in self._transactions:
+			transaction_id = udp_get_transaction_id()
+		return transaction_id
+
+	def _scrape(self, transaction):
+		"""Send the scrape request of `transaction`, getting a connection id first if needed"""
+		try:
+			connection = self._connections.get(transaction.addr)
+			if connection is not None and time.time() - connection[1] < self.connection_ttl:
+				transaction_id = self._new_transaction_id()
+				(request, transaction_id) = udp_create_scrape_request(connection[0], transaction.hashes, transaction_id)
+				self._send(transaction, request, transaction_id)
+			elif transaction.addr in self._connecting:
+				self._connecting[transaction.addr].append(transaction)
+			else:
+				self._connecting[transaction.addr] = [transaction]
+				self._connect(UdpTransaction(transaction.addr, None, None))
+		except Exception as e:
+			print("UdpScraper: %r" % e)
+			waiting = self._connecting.get(transaction.addr)
+			if waiting and transaction in waiting:
+				waiting.remove(transaction)
+			if self._transactions.get(transaction.transaction_id) is transaction:
+				del self._transactions[transaction.transaction_id]
+			self._done(transaction, None, e)
+
+	def _connect(self, transaction):
+		self.connects += 1
+		transaction_id = self._new_transaction_id()
+		(request, transaction_id) = udp_create_connection_request(transaction_id)
+		self._send(transaction, request, transaction_id)
+
+	def _done(self, transaction, result, error):
+		self._in_flight -= 1
+		if error is None:
+			self.scraped += len(transaction.hashes)
+		else:
+			self.failed += len(transaction.hashes)
+		try:
+			transaction.callback(transaction.hashes, result, error)
+		except Exception as e:
+			print("UdpScraper callback: %r" % e)
+
+	def _recv(self):
+		while True:
+			try:
+				(buf, addr) = self.sock.recvfrom(2048)
+			except socket.error as e:
+				if e.args[0] in [errno.EAGAIN, errno.EWOULDBLOCK]:
+					return
+				# icmp errors of a previous sendto, the request is retried on its deadline
+				if e.args[0] in [errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH]:
+					continue
+				raise
+			self.received += 1
+			try:
+				self._response(buf, addr)
+			except Exception as e:
+				print("UdpScraper: %r" % e)
+
+	def _response(self, buf, addr):
+		"""Handle the datagram `buf` received from `addr`"""
+		if len(buf) < 8:
+			return
+		transaction = self._transactions.get(struct.unpack_from("!I", buf, 4)[0])
+		if transaction is None or transaction.addr != addr:
+			return
+		del self._transactions[transaction.transaction_id]
+		try:
+			if transaction.hashes is None:
+				try:
+					connection_id = udp_parse_connection_response(buf, transaction.transaction_id)
+				except (RuntimeError, struct.error) as e:
+					self._fail(transaction, e)
+					return
+				self._connections[addr] = (connection_id, time.time())
+				for waiting in self._connecting.pop(addr, []):
+					self._scrape(waiting)
+			else:
+				try:
+					result = udp_parse_scrape_response(buf, transaction.transaction_id, transaction.hashes)
+				except (RuntimeError, struct.error) as e:
+					# the connection id may have expired on the tracker side
+					self._connections.pop(addr, None)
+					self._retry(transaction, e)
+					return
+				if len(result) < len(transaction.hashes):
+					# truncated response, scrape again the missing hashes only
+					missing = UdpTransaction(addr, [h for h in transaction.hashes if not h in result], transaction.callback)
+					missing.tries = transaction.tries + 1
+					self.truncated += 1
+					transaction.hashes = [h for h in transaction.hashes if h in result]
+					if missing.tries > self.max_retry:
+						self._in_flight += 1
+						self._done(missing, None, RuntimeError("Truncated scrape response from %s:%s" % addr))
+					else:
+						self._queue.appendleft(missing)
+				self._done(transaction, result, None)
+		except Exception as e:
+			self._fail(transaction, e)
+			raise
+
+	def _fail(self, transaction, error):
+		"""Fail the scrape `transaction`, or the ones waiting for the connect `transaction`"""
+		if transaction.hashes is None:
+			for waiting in self._connecting.pop(transaction.addr, []):
+				self._done(waiting, None, error)
+		else:
+			self._done(transaction, None, error)
+
+	def _retry(self, transaction, error):
+		if transaction.tries >= self.max_retry:
+			self._fail(transaction, error)
+			return
+		transaction.tries += 1
+		self.retransmitted += 1
+		if transaction.hashes is None:
+			self._connect(transaction)
+		else:
+			self._scrape(transaction)
+
+	def _expire(self):
+		now = time.time()
+		for transaction in [t for t in self._transactions.values() if t.deadline <= now]:
+			del self._transactions[transaction.transaction_id]
+			try:
+				self._retry(transaction, socket.timeout("no response from %s:%s" % transaction.addr))
+			except Exception as e:
+				print("UdpScraper: %r" % e)
+				self._fail(transaction, e)
+
+class TokenBucket(object):
+	"""Allow `rate` operations by second on average, with bursts of at most `burst`"""
+
+	def __init__(self, rate, burst=None):
+		self.rate = float(rate)
+		self.burst = burst if burst is not None else max(rate, 1)
+		self.tokens = self.burst
+		self.last = time.time()
+
+	def available(self):
+		now = time.time()
+		self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+		self.last = now
+		return self.tokens >= 1
+
+	def take(self):
+		if not self.available():
+			return False
+		self.tokens -= 1
+		return True
+
+class Tracker(object):
+	"""
+	A tracker of a TrackerPool, with its rate limit and health
+
+	The health score is an average of the latency in seconds plus 10 times the
+	error rate, lower is better. A tracker failing `max_errors` times in a row
+	is not used during `disable_time` seconds.
+	"""
+	max_errors = 5
+	disable_time = 60
+
+	def __init__(self, url, rate, max_in_flight):
+		self.url = url.lower()
+		self.scheme = urlparse(self.url).scheme
+		self.bucket = TokenBucket(rate)
+		self.max_in_flight = max_in_flight
+		self.in_flight = 0
+		self.addrs = []
+		self.addr_index = 0
+		self.latency = 0.0
+		self.error_rate = 0.0
+		self.errors = 0 # in a row
+		self.disabled_until = 0
+
+		self.requests = 0
+		self.scraped = 0
+		self.failed = 0
+
+	def score(self):
+		return self.latency + 10 * self.error_rate
+
+	def enabled(self):
+		return time.time() >= self.disabled_until
+
+	def ready(self):
+		return self.in_flight < self.max_in_flight and self.enabled() and self.bucket.available()
+
+	def next_addr(self):
+		self.addr_index += 1
+		return self.addrs[self.addr_index % len(self.addrs)]
+
+	def record(self, latency, error, count):
+		if error is None:
+			self.latency = self.latency * 0.8 + latency * 0.2
+			self.error_rate = self.error_rate * 0.8
+			self.errors = 0
+			self.scraped += count
+		else:
+			self.error_rate = self.error_rate * 0.8 + 0.2
+			self.errors += 1
+			self.failed += count
+			if self.errors >= self.max_errors:
+				self.disabled_until = time.time() + self.disable_time
+				self.errors = 0
+
+	def stats(self):
+		return {
+			'requests': self.requests,
+			'scraped': self.scraped,
+			'failed': self.failed,
+			'latency': self.latency,
+			'error_rate': self.error_rate,
+			'score': self.score(),
+			'enabled': self.enabled(),
+		}
+
+class ScrapeBatch(object):
+	"""Hashes scraped on one or more trackers of a TrackerPool"""
+	__slots__ = ('hashes', 'callback', 'todo', 'wanted', 'pending', 'tried', 'result', 'error')
+
+	def __init__(self, hashes, callback, wanted):
+		self.hashes = hashes
+		self.callback = callback
+		self.todo = hashes # hashes without result yet
+		self.wanted = wanted # trackers still to send the batch to
+		self.pending = 0 # hashes sent and waiting for a result
+		self.tried = set() # trackers urls
+		self.result = {}
+		self.error = None
+
+class TrackerPool(object):
+	"""
+	Scrape batches of hashes over several udp and http trackers
+
+	Each batch is sent to the `fanout` healthiest trackers able to take it: a
+	tracker sends at most `rate` requests by second (token bucket) and has at
+	most `in_flight` requests waiting for an answer. The results of the
+	trackers are merged keeping the max of each value, and the hashes without
+	result are sent to a tracker not tried yet for the batch. `trackers` is a
+	list of announce urls or of (url, rate, in_flight) tuples. Udp trackers are
+	scraped through one UdpScraper, http trackers by a thread by request.
+
+	`callback(hashes, result, error)` is called once by submitted batch, from a
+	scraper thread, `error` is the last error when no tracker gave a result.
+	"""
+
+	def __init__(self, trackers, fanout=1, rate=5, in_flight=10, timeout=2):
+		self.fanout = fanout
+		self.timeout = timeout
+		self.trackers = []
+		for tracker in trackers:
+			if isinstance(tracker, (tuple, list)):
+				self.trackers.append(Tracker(*tracker))
+			else:
+				self.trackers.append(Tracker(tracker, rate, in_flight))
+		self.udp = UdpScraper(max_in_flight=sum(t.max_in_flight for t in self.trackers if t.scheme == "udp") or 1, timeout=timeout)
+		self._queue = collections.deque() # ScrapeBatch to send
+		self._lock = Lock()
+		self._event = Event()
+		self.stoped = True
+		self.threads = []
+
+	def start(self):
+		for tracker in self.trackers:
+			if tracker.scheme == "udp":
+				try:
+					tracker.addrs = resolve(tracker.url)
+				except (socket.gaierror, socket.error, RuntimeError) as e:
+					print("%s: %r" % (tracker.url, e))
+					tracker.disabled_until = float("inf")
+			elif tracker.scheme not in ["http", "https"] or "announce" not in tracker.url:
+				print("%s does not support scrape" % tracker.url)
+				tracker.disabled_until = float("inf")
+		if not [t for t in self.trackers if t.enabled()]:
+			raise RuntimeError("No usable tracker")
+		self.stoped = False
+		self.udp.start()
+		self.threads.extend(self.udp.threads)
+		t = Thread(target=self._loop)
+		t.setName("TrackerPool:loop")
+		t.daemon = True
+		t.start()
+		self.threads.append(t)
+
+	def stop(self):
+		self.stoped = True
+		self._event.set()
+		self.udp.stop()
+		for t in self.threads:
+			t.join()
+
+	def submit(self, hashes, callback):
+		"""Queue the scrape of the hex `hashes`"""
+		batch = ScrapeBatch(hashes, callback, min(self.fanout, len(self.trackers)))
+		with self._lock:
+			self._queue.append(batch)
+		self._event.set()
+
+	def pending(self):
+		return len(self._queue)
+
+	def alive(self):
+		"""Return True if the pool and udp scraper threads are running"""
+		return bool(self.threads) and all(t.is_alive() for t in self.threads)
+
+	def stats(self):
+		return dict((tracker.url, tracker.stats()) for tracker in self.trackers)
+
+	def _loop(self):
+		while not self.stoped:
+			self._event.wait(0.05)
+			self._event.clear()
+			with self._lock:
+				self._dispatch()
+		with self._lock:
+			while self._queue:
+				batch = self._queue.popleft()
+				batch.error = RuntimeError("scraper stopped")
+				self._finish(batch)
+
+	def _dispatch(self):
+		"""Send the queued batches to the healthiest ready trackers, in order"""
+		ready = sorted([t for t in self.trackers if t.ready()], key=lambda t:t.score())
+		waiting = collections.deque()
+		while self._queue:
+			batch = self._queue.popleft()
+			for tracker in [t for t in ready if not t.url in batch.tried][:batch.wanted]:
+				if tracker.bucket.take():
+					self._send(tracker, batch)
+			if batch.wanted > 0:
+				if [t for t in self.trackers if t.enabled() and not t.url in batch.tried]:
+					waiting.append(batch)
+				else:
+					# no other tracker to send it to
+					batch.wanted = 0
+					if batch.error is None:
+						batch.error = RuntimeError("No tracker available")
+					if batch.pending == 0:
+						self._finish(batch)
+			ready = [t for t in ready if t.ready()]
+		waiting.extend(self._queue)
+		self._queue = waiting
+
+	def _send(self, tracker, batch):
+		batch.wanted -= 1
+		batch.pending += len(batch.todo)
+		batch.tried.add(tracker.url)
+		tracker.in_flight += 1
+		tracker.requests += 1
+		hashes = batch.todo
+		remaining = [len(hashes)]
+		start = time.time()
+		def callback(hashes, result, error):
+			with self._lock:
+				remaining[0] -= len(hashes)
+				if remaining[0] <= 0:
+					tracker.in_flight -= 1
+				tracker.record(time.time() - start, error, len(hashes))
+				self._result(batch, hashes, result, error)
+			self._event.set()
+		if tracker.scheme == "udp":
+			self.udp.submit(tracker.next_addr(), hashes, callback)
+		else:
+			t = Thread(target=self._http, args=(tracker.url, hashes, callback))
+			t.setName("TrackerPool:http")
+			t.daemon = True
+			t.start()
+
+	def _http(self, url, hashes, callback):
+		try:
+			ret = scrape(url, hashes, timeout=self.timeout * 4)
+			by_lower = dict((h.lower(), h) for h in hashes)
+			result = dict((by_lower[h], info) for (h, info) in ret.items() if h in by_lower)
+			error = None
+		except Exception as e:
+			result = None
+			error = e
+		callback(hashes, result, error)
+
+	def _result(self, batch, hashes, result, error):
+		batch.pending -= len(hashes)
+		if error is not None:
+			batch.error = error
+		else:
+			for hash, info in result.items():
+				if hash in batch.result:
+					merged = batch.result[hash]
+					for key in ["seeds", "peers", "complete"]:
+						merged[key] = max(merged[key], info[key])
+				else:
+					batch.result[hash] = dict(info)
+		if batch.pending > 0 or batch.wanted > 0:
+			return
+		missing = [h for h in batch.todo if not h in batch.result]
+		if missing and [t for t in self.trackers if t.enabled() and not t.url in batch.tried]:
+			batch.todo = missing
+			batch.wanted = 1
+			self._queue.appendleft(batch)
+		else:
+			self._finish(batch)
 
+	def _finish(self, batch):
+		try:
+			batch.callback(batch.hashes, batch.result, None if batch.result else batch.error)
+		except Exception as e:
+			print("TrackerPool callback: %r" % e)
@@ -52,7 +52,7 @@ CREATE TABLE `torrents` (
   KEY `dht_last_announce` (`dht_last_announce`),
   KEY `torcache` (`torcache`),
   KEY `torcache_notfound` (`torcache_notfound`),
-  KEY `scrape_date` (`scrape_date`)
+  KEY `scrape_date_id` (`scrape_date`,`id`)
 ) ENGINE=MyISAM AUTO_INCREMENT=17824994 DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci ROW_FORMAT=COMPACT;
 /*!40101 SET character_set_client = @saved_cs_client */;
 /*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;
@@ -0,0 +1,9 @@
+-- Append only table used by the crawlers when update_hash_mode is "staging"
+-- or "infile". Its rows are periodically merged into the torrents table.
+CREATE TABLE IF NOT EXISTS `torrents_dht_staging` (
+  `id` bigint(20) unsigned NOT NULL AUTO_INCREMENT,
+  `hash` varchar(40) CHARACTER SET ascii NOT NULL,
+  `kind` tinyint(1) NOT NULL COMMENT '0 = announce, 1 = get',
+  `ts` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`)
+) ENGINE=MyISAM DEFAULT CHARSET=utf8;
@@ -6,3 +6,4 @@ CREATE INDEX `dht_last_get` ON torrents(`dht_last_get`);
 CREATE INDEX `dht_last_announce` ON torrents(`dht_last_announce`);
 CREATE INDEX `torcache` ON torrents(`torcache`);
 CREATE INDEX `torcache_notfound` ON torrents(`torcache_notfound`);
+CREATE INDEX `scrape_date_id` ON torrents(`scrape_date`, `id`);
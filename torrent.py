@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
+import os
 import time
 import hashlib
 import socket
 import select
 import struct
 import math
+import errno
+import heapq
+import itertools
 import collections
-from threading import Thread
+from threading import Thread, Lock
 
 from btdht.utils import bencode, bdecode, _bdecode, BcodeError, ID
 
@@ -18,41 +22,216 @@ class MetaDataToBig(Exception):
 class ToRead(Exception):
     pass
 
+class TimerWheel(object):
+    """A hashed timer wheel of `slots` slots of `tick` seconds
+
+    Adding, removing and expiring an item is O(1). Items with a timeout
+    longer than a wheel turn stay in their slot until their deadline.
+    """
+    def __init__(self, tick=0.1, slots=512):
+        self.tick = tick
+        self._slots = [set() for i in range(slots)]
+        self._deadline = {} # item -> tick number
+        self._current = int(time.time() / tick)
+        self._lock = Lock()
+
+    def add(self, item, timeout):
+        with self._lock:
+            self._remove(item)
+            deadline = max(int((time.time() + timeout) / self.tick), self._current + 1)
+            self._deadline[item] = deadline
+            self._slots[deadline % len(self._slots)].add(item)
+
+    def _remove(self, item):
+        deadline = self._deadline.pop(item, None)
+        if deadline is not None:
+            self._slots[deadline % len(self._slots)].discard(item)
+
+    def remove(self, item):
+        with self._lock:
+            self._remove(item)
+
+    def __len__(self):
+        return len(self._deadline)
+
+    def expire(self, now=None):
+        """Return the list of the items whose timeout has expired"""
+        target = int((now or time.time()) / self.tick)
+        expired = []
+        with self._lock:
+            # no need to go more than one turn
+            ticks = min(target - self._current, len(self._slots))
+            for i in range(1, ticks + 1):
+                slot = self._slots[(self._current + i) % len(self._slots)]
+                for item in [item for item in slot if self._deadline[item] <= target]:
+                    self._remove(item)
+                    expired.append(item)
+            self._current = max(self._current, target)
+        return expired
+
+class Peer(object):
+    """State of one connection to a peer"""
+    __slots__ = (
+        'sock', 'fd', 'ip', 'port', 'hash', 'buf', 'view', 'buf_start', 'buf_end', 'buf_need', 'handshake', 'connecting', 'closed',
+        'peer_extended', 'peer_metadata', 'am_choking', 'am_interested', 'peer_choking', 'peer_interested',
+        'requests', 'timeouts', 'started'
+    )
+
+    def __init__(self, sock, ip, port, hash):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.ip = ip
+        self.port = port
+        self.hash = hash
+        # received bytes not yet handled are buf[buf_start:buf_end]
+        self.buf = None
+        self.view = None # memoryview of buf
+        self.buf_start = 0
+        self.buf_end = 0
+        # number of bytes from buf_start needed to handle the next message
+        self.buf_need = 1
+        self.handshake = False
+        self.connecting = True
+        self.closed = False
+        self.peer_extended = False
+        self.peer_metadata = False
+        self.am_choking = True
+        self.am_interested = False
+        self.peer_choking = True
+        self.peer_interested = False
+        self.requests = set() # metadata pieces requested to the peer
+        self.timeouts = 0 # requests timed out
+        self.started = time.time() # None once the peer has sent a metadata piece
+
+class PieceScheduler(object):
+    """Spread the metadata pieces requests of one info_hash over its peers
+
+    A missing piece is requested to one peer at a time. `release` gives a
+    piece back, for instance when its request timed out, so it is requested
+    to another peer. A piece in `excluded` is never requested to the
+    (ip, port) it maps to.
+    """
+    __slots__ = ('missing', 'requested', 'excluded')
+
+    def __init__(self, missing, excluded=None):
+        self.missing = collections.deque(missing) # pieces not requested yet
+        self.requested = {} # piece -> Peer
+        self.excluded = excluded or {} # piece -> (ip, port)
+
+    def assign(self, peer, max_requests):
+        """Return the pieces to request to `peer` so it has `max_requests` pending"""
+        pieces = []
+        skipped = []
+        while self.missing and len(peer.requests) < max_requests:
+            piece = self.missing.popleft()
+            if self.excluded.get(piece) == (peer.ip, peer.port):
+                skipped.append(piece)
+                continue
+            self.requested[piece] = peer
+            peer.requests.add(piece)
+            pieces.append(piece)
+        self.missing.extendleft(reversed(skipped))
+        return pieces
+
+    def received(self, piece):
+        """Return the peer `piece` was requested to"""
+        peer = self.requested.pop(piece, None)
+        if peer is not None:
+            peer.requests.discard(piece)
+        else:
+            try: self.missing.remove(piece)
+            except ValueError: pass
+        return peer
+
+    def release(self, piece):
+        peer = self.requested.pop(piece, None)
+        if peer is not None:
+            peer.requests.discard(piece)
+            self.missing.appendleft(piece)
+
+    def release_peer(self, peer):
+        for piece in peer.requests:
+            if self.requested.get(piece) is peer:
+                del self.requested[piece]
+                self.missing.appendleft(piece)
+        peer.requests.clear()
+
 class Client(object):
     """A torrent client retrieving metadata files"""
 
-    _am_choking = {} # socket -> bool
-    _am_interested = {} # socket -> bool
-    _peer_choking = {} # socket -> bool
-    _peer_interested = {} # socket -> bool
-
     _am_metadata = 1
-    _peer_extended = {} # socket -> bool
-    _peer_metadata = {} # socket -> int
-
-    _metadata_size = {}# hash -> int
-    _metadata_size_qorum = {} # hash -> size -> nb
-    _metadata_pieces = {} # hash -> list/array
-    _metadata_pieces_received = {} # hash -> int
-    _metadata_pieces_nb = {} # hash -> int
-
-    _socket_hash = {} # socket -> hash
-    _socket_toread = {} # socket -> str
-    _socket_handshake = {} # socket -> bool
-    _socket_ipport = {} # socket -> (ip, port)
-    _hash_socket = collections.defaultdict(set) # hash -> socket set
-    _peers_socket = {} # (ip, port, hash) -> socket
-    _fd_to_socket = {} # int -> socket
-
-    meta_data = {} # hash -> bytes
 
+    # initial size of the receive buffers and minimum free space for a recv
+    recv_size = 4096
+    # bigger messages close the connection
+    max_message_size = 1024 * 1024
+    # peers are closed after this many timed out pieces requests
+    max_peer_timeouts = 3
+    # peers sending bad pieces are not connected to during ban_time seconds
+    ban_time = 3600
 
-    stoped = True
-    threads = []
-
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, reputation=None, connect_timeout=3, max_connections=3000, max_peers_per_hash=8, max_requests_per_peer=4, piece_timeout=10, metadata_writer=None):
         self.debug = debug
-        self.poll = select.poll()
+        # scheduler.PeerReputation where to record the peers outcomes
+        self.reputation = reputation
+        # dirindex.TorrentWriter the completed metadata are handed to
+        self.metadata_writer = metadata_writer
+        self.connect_timeout = connect_timeout
+        self.max_connections = max_connections
+        self.max_peers_per_hash = max_peers_per_hash
+        self.max_requests_per_peer = max_requests_per_peer
+        self.piece_timeout = piece_timeout
+        self.stoped = True
+        self.threads = []
+        self.meta_data = {} # hash -> bytes, or True once handed to metadata_writer
+
+        self._metadata_size = {}# hash -> int
+        self._metadata_size_qorum = {} # hash -> size -> nb
+        self._metadata_pieces = {} # hash -> list/array
+        self._metadata_pieces_received = {} # hash -> int
+        self._metadata_pieces_nb = {} # hash -> int
+        self._hash_pieces = {} # hash -> PieceScheduler
+        self._metadata_pieces_source = {} # hash -> piece -> (ip, port)
+        self._metadata_suspects = {} # hash -> piece -> [((ip, port), data)] pieces dropped on a sha1 mismatch
+        self._metadata_strikes = {} # hash -> (ip, port) -> failed sha1 checks with pieces from it
+
+        self._hash_peers = collections.defaultdict(set) # hash -> Peer set
+        self._peers = {} # (ip, port, hash) -> Peer
+        self._fd_peer = {} # int -> Peer
+
+        self.poll = select.epoll()
+        # peers to close: not connected after connect_timeout seconds or not
+        # sending any metadata piece during piece_timeout seconds
+        self._peer_timers = TimerWheel()
+        self._request_timers = TimerWheel() # (peer, piece)
+        self.pieces_duplicate = 0
+        self.pieces_timeout = 0
+        self.metadata_mismatch = 0
+        self.pieces_refetched = 0
+        self.pieces_bad = 0
+        # unexpected errors handling a peer, the peer is closed
+        self.peer_errors = 0
+        self._banned = {} # (ip, port) -> ban time, shared by the ClientShards clients
+        # peers banned by another client, to disconnect from the receive loop
+        self._to_ban = collections.deque()
+        # hashs to clean from the receive loop, see clean_hash
+        self._to_clean = collections.deque()
+        # functions called with (ip, port) when a peer is banned
+        self.on_ban = []
+        # peers waiting for a connection slot
+        self._pending = [] # heap of (priority, -seq, ip, port, hash)
+        self._pending_seq = itertools.count()
+        self._pending_hash = collections.defaultdict(set) # hash -> (ip, port) queued
+        self._pending_count = 0
+        self._waiting_hash = collections.defaultdict(list) # hash -> heap entries waiting for a slot of the hash
+        self._pending_lock = Lock()
+        self.connections_deferred = 0
+        # functions called with the info_hash when its metadata is complete
+        self.on_metadata = []
+        self._handlers = {}
+        for msg_typ in range(256):
+            if hasattr(self, "handle_%s" % msg_typ):
+                self._handlers[msg_typ] = getattr(self, "handle_%s" % msg_typ)
 
     def stop(self):
         self.stoped = True
@@ -76,29 +255,59 @@ class Client(object):
         while True:
             if self.stoped:
                 return
+            for peer in self._peer_timers.expire():
+                try:
+                    if self.reputation is not None:
+                        if peer.connecting:
+                            self.reputation.connect_failed((peer.ip, peer.port))
+                        # a peer the scheduler gave no piece to is not to blame
+                        elif peer.started is not None and (peer.requests or not peer.peer_metadata):
+                            self.reputation.no_metadata((peer.ip, peer.port))
+                    self.clean_peer(peer)
+                except Exception as e:
+                    self.peer_errors += 1
+                    if self.debug:
+                        print "%s:%s %r" % (peer.ip, peer.port, e)
+            for (peer, piece) in self._request_timers.expire():
+                try:
+                    self.request_timeout(peer, piece)
+                except Exception as e:
+                    self.peer_errors += 1
+                    if self.debug:
+                        print "%s:%s %r" % (peer.ip, peer.port, e)
+                    self.clean_peer(peer)
+            while self._to_ban:
+                self.disconnect(*self._to_ban.popleft())
+            while self._to_clean:
+                self._clean_hash(self._to_clean.popleft())
             try:
-                events = self.poll.poll(1000)
-                #sockets, _, _ = select.select(self._socket_hash.keys(), [], [], 1)
-                for fileno, flag in events:
-                    s = self._fd_to_socket[fileno]
-                    if (flag & (select.POLLIN|select.POLLPRI)):
-                        try:
-                            self.recv(s)
-                        except (ToRead, socket.timeout):
-                            pass
-                        except socket.error as e:
-                            if e.errno not in [11]:
-                                self.clean_socket(s)
-                        except (MetaDataToBig, BcodeError, ValueError, KeyError) as e:
-                            self.clean_socket(s)
-                    elif (flag & (select.POLLERR | select.POLLHUP | select.POLLNVAL)):
-                        print flag
-                        self.clean_socket(s)
-            except (socket.error, select.error) as e:
-                if e.args[0] != 9:
+                if self._pending:
+                    self._admit()
+                events = self.poll.poll(0.1)
+            except (socket.error, select.error, IOError) as e:
+                if e.args[0] not in [errno.EBADF, errno.EINTR]:
                     print e
-            except KeyError:
-                pass
+                continue
+            for fileno, flag in events:
+                peer = self._fd_peer.get(fileno)
+                if peer is None:
+                    continue
+                # a peer must never stop the loop: with edge triggered
+                # events, the sockets after it would not be reported again
+                try:
+                    if peer.connecting and not self.connected(peer):
+                        continue
+                    # edge triggered: recv drains the socket until EAGAIN
+                    if (flag & (select.EPOLLIN|select.EPOLLPRI)):
+                        self.recv(peer)
+                    elif (flag & (select.EPOLLERR | select.EPOLLHUP)):
+                        self.clean_peer(peer)
+                except Exception as e:
+                    if not isinstance(e, (socket.error, MetaDataToBig, BcodeError, ValueError, KeyError)):
+                        self.peer_errors += 1
+                        if self.debug:
+                            print "%s:%s %r" % (peer.ip, peer.port, e)
+                    self.clean_peer(peer)
 
     def init_hash(self, hash):
         mps = self.most_probably_size(hash)
@@ -107,121 +316,336 @@ class Client(object):
         self._metadata_pieces[hash] = [None] * self._metadata_pieces_nb[hash]
         self._metadata_pieces_received[hash] = 0
         self._metadata_size_qorum[hash] = {mps:10}
-
-    def clean_socket(self, s, hash=None):
-        def rem(d, s):
-            try: del d[s]
-            except KeyError: pass
-        try:
-            if hash is None:
-                hash = self._socket_hash[s]
-            (ip, port) = self._socket_ipport[s]
-            rem(self._peers_socket, (ip, port, hash))
-        except KeyError:
-            pass
-        try: self.poll.unregister(s)
-        except (KeyError, select.error, socket.error): pass
-        try: del self._fd_to_socket[s.fileno()]
-        except (KeyError, socket.error): pass
-        rem(self._socket_toread, s)
-        rem(self._socket_handshake, s)
-        rem(self._socket_hash, s)
-        rem(self._peer_metadata, s)
-        rem(self._peer_extended, s)
-        rem(self._am_choking, s)
-        rem(self._am_interested, s)
-        rem(self._peer_choking, s)
-        rem(self._peer_interested, s)
-        rem(self._socket_ipport, s)
-        try:self._hash_socket[hash].remove(s)
-        except KeyError: pass
-        try:s.close()
+        self._metadata_pieces_source[hash] = {}
+        self._metadata_suspects.pop(hash, None)
+        self._reset_requests(hash)
+
+    def clean_peer(self, peer):
+        if peer.closed:
+            return
+        peer.closed = True
+        self._peer_timers.remove(peer)
+        # the fd may already be reused by a newer connection
+        if self._fd_peer.get(peer.fd) is peer:
+            del self._fd_peer[peer.fd]
+        if self._peers.get((peer.ip, peer.port, peer.hash)) is peer:
+            del self._peers[(peer.ip, peer.port, peer.hash)]
+        peers = self._hash_peers.get(peer.hash)
+        if peers is not None:
+            peers.discard(peer)
+        if peer.hash in self._waiting_hash:
+            with self._pending_lock:
+                for entry in self._waiting_hash.pop(peer.hash, []):
+                    heapq.heappush(self._pending, entry)
+        # closing the socket also removes it from the epoll set
+        try:peer.sock.close()
         except: pass
+        # give the pieces requested to the peer to the others
+        if peer.requests:
+            for piece in peer.requests:
+                self._request_timers.remove((peer, piece))
+            pieces = self._hash_pieces.get(peer.hash)
+            if pieces is not None:
+                pieces.release_peer(peer)
+                self.request_pieces(peer.hash)
+
+    def peers_count(self, hash):
+        """Return the number of peers connected, connecting or queued for `hash`"""
+        return len(self._hash_peers.get(hash, ())) + len(self._pending_hash.get(hash, ()))
+
+    def _reset_requests(self, hash, excluded=None):
+        """Start a new PieceScheduler for `hash` after its pieces list changed"""
+        for peer in self._hash_peers.get(hash, ()):
+            for piece in peer.requests:
+                self._request_timers.remove((peer, piece))
+            peer.requests.clear()
+        self._hash_pieces[hash] = PieceScheduler(
+            (i for (i, piece) in enumerate(self._metadata_pieces[hash]) if piece is None),
+            excluded
+        )
+
+    def request_pieces(self, hash):
+        """Request the missing pieces of `hash` to its peers, the least loaded first"""
+        pieces = self._hash_pieces.get(hash)
+        if pieces is None or not pieces.missing:
+            return
+        peers = [peer for peer in self._hash_peers.get(hash, ()) if peer.peer_metadata and not peer.am_choking]
+        peers.sort(key=lambda peer: (peer.timeouts, len(peer.requests)))
+        for peer in peers:
+            for piece in pieces.assign(peer, self.max_requests_per_peer):
+                self._request_timers.add((peer, piece), self.piece_timeout)
+                try:
+                    self.metadata_request(peer, piece)
+                except (socket.error, ValueError) as e:
+                    self.clean_peer(peer)
+                    break
+            if not pieces.missing:
+                return
+
+    def bad_metadata(self, hash):
+        """The pieces of `hash` do not match its sha1: drop the pieces of the most suspect peer
+
+        The dropped pieces are requested again to the others peers and kept
+        so that, once the metadata is complete, check_suspects can tell
+        which were bad.
+        """
+        self.metadata_mismatch += 1
+        sources = self._metadata_pieces_source.get(hash, {})
+        by_source = collections.defaultdict(list)
+        for piece, source in sources.items():
+            if piece < self._metadata_pieces_nb[hash]:
+                by_source[source].append(piece)
+        if self.most_probably_size(hash) != self._metadata_size[hash] or not by_source:
+            # the size was wrong, start over
+            self.init_hash(hash)
+            return
+        strikes = self._metadata_strikes.setdefault(hash, {})
+        if len(by_source) == 1:
+            # a single peer sent all the pieces, ban it if it already failed
+            # once, the mismatch may come from a wrong size quorum
+            source = by_source.keys()[0]
+            strikes[source] = strikes.get(source, 0) + 1
+            self.init_hash(hash)
+            if strikes[source] >= 2:
+                self.pieces_bad += 1
+                self.ban(*source)
+            return
+        for source in by_source:
+            strikes[source] = strikes.get(source, 0) + 1
+        source = max(by_source, key=lambda source: (strikes[source], len(by_source[source])))
+        suspects = self._metadata_suspects.setdefault(hash, {})
+        for piece in by_source[source]:
+            suspects.setdefault(piece, []).append((source, self._metadata_pieces[hash][piece]))
+            self._metadata_pieces[hash][piece] = None
+            self._metadata_pieces_received[hash] -= 1
+            del sources[piece]
+        self.pieces_refetched += len(by_source[source])
+        self._reset_requests(hash, dict((piece, source) for piece in by_source[source]))
+
+    def check_suspects(self, hash):
+        """Ban the peers whose dropped pieces differ from the ones of the valid metadata"""
+        for piece, dropped in self._metadata_suspects.get(hash, {}).items():
+            for ((ip, port), data) in dropped:
+                if data != self._metadata_pieces[hash][piece]:
+                    self.pieces_bad += 1
+                    self.ban(ip, port)
+
+    def request_timeout(self, peer, piece):
+        pieces = self._hash_pieces.get(peer.hash)
+        if pieces is not None and pieces.requested.get(piece) is peer:
+            self.pieces_timeout += 1
+            peer.timeouts += 1
+            if peer.timeouts >= self.max_peer_timeouts:
+                self.clean_peer(peer)
+            else:
+                pieces.release(piece)
+                self.request_pieces(peer.hash)
 
     def clean_hash(self, hash):
+        """Stop downloading the metadata of `hash`, from the receive loop"""
+        self._to_clean.append(hash)
+
+    def _clean_hash(self, hash):
         def rem(d, s):
             try: del d[s]
             except KeyError: pass
-        for s in list(self._hash_socket[hash]):
-            self.clean_socket(s, hash)
+        rem(self._hash_pieces, hash)
+        with self._pending_lock:
+            self._pending_count -= len(self._pending_hash.pop(hash, ()))
+            self._waiting_hash.pop(hash, None)
+        for peer in list(self._hash_peers.pop(hash, [])):
+            self.clean_peer(peer)
         rem(self._metadata_size, hash)
         rem(self._metadata_pieces, hash)
         rem(self._metadata_pieces_received, hash)
         rem(self._metadata_pieces_nb, hash)
-        rem(self._hash_socket, hash)
         rem(self._metadata_size_qorum, hash)
+        rem(self._metadata_pieces_source, hash)
+        rem(self._metadata_suspects, hash)
+        rem(self._metadata_strikes, hash)
+
+    def ban(self, ip, port):
+        """Close the connections to (ip, port) and do not connect to it during ban_time seconds"""
+        now = time.time()
+        if len(self._banned) > 100000:
+            for peer, when in self._banned.items():
+                if now - when > self.ban_time:
+                    self._banned.pop(peer, None)
+        self._banned[(ip, port)] = now
+        self.disconnect(ip, port)
+        for callback in self.on_ban:
+            callback(ip, port)
+
+    def disconnect(self, ip, port):
+        """Close the connections to (ip, port) and drop the pieces it sent"""
+        for peer in [peer for peer in self._fd_peer.values() if peer.ip == ip and peer.port == port]:
+            self.clean_peer(peer)
+        # the pieces it sent for the others hashs are likely bad too
+        for hash, sources in self._metadata_pieces_source.items():
+            dropped = [piece for piece, source in sources.items() if source == (ip, port)]
+            if not dropped or hash in self.meta_data or not hash in self._hash_pieces:
+                continue
+            for piece in dropped:
+                del sources[piece]
+                if piece < self._metadata_pieces_nb[hash] and self._metadata_pieces[hash][piece] is not None:
+                    self._metadata_pieces[hash][piece] = None
+                    self._metadata_pieces_received[hash] -= 1
+                    self._hash_pieces[hash].missing.append(piece)
+            self.request_pieces(hash)
+
+    def banned(self, ip, port):
+        return time.time() - self._banned.get((ip, port), 0) < self.ban_time
+
+    def stats(self):
+        return {
+            'peers': len(self._fd_peer),
+            'max_connections': self.max_connections,
+            'pending': self._pending_count,
+            'connections_deferred': self.connections_deferred,
+            'hashs': len(self._hash_pieces),
+            'pieces_duplicate': self.pieces_duplicate,
+            'pieces_timeout': self.pieces_timeout,
+            'metadata_mismatch': self.metadata_mismatch,
+            'pieces_refetched': self.pieces_refetched,
+            'pieces_bad': self.pieces_bad,
+            'peer_errors': self.peer_errors,
+            'banned': len(self._banned),
+        }
 
     @staticmethod
     def _create_connection(addr):
+        """Start a non blocking connect to addr"""
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(0.5)
+        s.setblocking(0)
         l_onoff = 1
         l_linger = 0
         # This will cause TCP to abort the connection when it is closed, flush the data and send a RST
         # instead of going to the state TIME_WAIT
         s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', l_onoff, l_linger))
-        s.connect(addr)
+        err = s.connect_ex(addr)
+        if err not in [0, errno.EINPROGRESS, errno.EWOULDBLOCK]:
+            s.close()
+            raise socket.error(err, os.strerror(err))
         return s
 
-    def add(self, ip, port, hash):
+    def connected(self, peer):
+        """Called when the peer socket, connecting, is writable: send the handshake"""
+        peer.connecting = False
+        self._peer_timers.add(peer, self.piece_timeout)
+        try:
+            err = peer.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err != 0:
+                raise socket.error(err, os.strerror(err))
+            self.handshake(peer)
+            return True
+        except (socket.error, ValueError) as e:
+            if self.debug:
+                print "connect fail:%r" % e
+            if self.reputation is not None:
+                self.reputation.connect_failed((peer.ip, peer.port))
+            self.clean_peer(peer)
+            return False
+
+    def add(self, ip, port, hash, priority=1):
+        """Download the metadata of `hash` from the peer (ip, port)
+
+        The peer is queued and connected by the receive loop once less than
+        max_connections sockets are open and less than max_peers_per_hash
+        peers are connected for `hash`, lower `priority` first then the last
+        added first.
+        """
         if hash in self.meta_data:
             return True
         if self.stoped:
             return None
-        if not (ip, port, hash) in self._peers_socket:
+        if self.banned(ip, port):
+            return False
+        if (ip, port, hash) in self._peers:
+            return True
+        with self._pending_lock:
+            if (ip, port) in self._pending_hash.get(hash, ()):
+                return True
+            self._pending_hash[hash].add((ip, port))
+            self._pending_count += 1
+            heapq.heappush(self._pending, (priority, -next(self._pending_seq), ip, port, hash))
+        if len(self._fd_peer) >= self.max_connections or len(self._hash_peers.get(hash, ())) >= self.max_peers_per_hash:
+            self.connections_deferred += 1
+        return True
+
+    def _admit(self):
+        """Connect the queued peers while the connections budgets allow it"""
+        admitted = []
+        with self._pending_lock:
+            while self._pending and len(self._fd_peer) + len(admitted) < self.max_connections:
+                entry = heapq.heappop(self._pending)
+                (_, _, ip, port, hash) = entry
+                # the hash may have been cleaned since
+                if not (ip, port) in self._pending_hash.get(hash, ()):
+                    continue
+                if len(self._hash_peers.get(hash, ())) + len([a for a in admitted if a[2] == hash]) >= self.max_peers_per_hash:
+                    # wait for a connection of this hash to close
+                    self._waiting_hash[hash].append(entry)
+                    continue
+                self._pending_hash[hash].discard((ip, port))
+                if not self._pending_hash[hash]:
+                    del self._pending_hash[hash]
+                self._pending_count -= 1
+                admitted.append((ip, port, hash))
+            # drop the entries of the cleaned hashs once they are the most part of the queue
+            if len(self._pending) > 2 * self._pending_count + 1000:
+                self._pending = [entry for entry in self._pending if (entry[2], entry[3]) in self._pending_hash.get(entry[4], ())]
+                heapq.heapify(self._pending)
+        for (ip, port, hash) in admitted:
+            self._connect(ip, port, hash)
+
+    def _connect(self, ip, port, hash):
+        if not (ip, port, hash) in self._peers:
             try:
                 s = self._create_connection((ip, port))
             except (socket.timeout, socket.error, ValueError, BcodeError):
+                if self.reputation is not None:
+                    self.reputation.connect_failed((ip, port))
                 return False
 
-            self._peers_socket[(ip, port, hash)] = s
-            self._socket_ipport[s] = (ip, port)
-            self._peer_extended[s] = False
-            self._peer_metadata[s] = False
-            self._peer_interested[s] = False
-            self._peer_choking[s] = True
-            self._am_interested[s] = False
-            self._am_choking[s] = True
-            self._socket_toread[s] = ""
-            self._socket_handshake[s] = False
-            self._hash_socket[hash].add(s)
+            peer = Peer(s, ip, port, hash)
+            self._peers[(ip, port, hash)] = peer
+            self._hash_peers[hash].add(peer)
 
             if not hash in self._metadata_size_qorum:
                 self._metadata_size_qorum[hash] = {}
 
-            self._socket_hash[s] = hash
-
-            self._fd_to_socket[s.fileno()]=s
+            self._fd_peer[peer.fd] = peer
+            self._peer_timers.add(peer, self.connect_timeout)
             try:
-                self.poll.register(s, select.POLLIN|select.POLLHUP|select.POLLERR|select.POLLNVAL|select.POLLPRI)
-                self.handshake(s)
-                s.settimeout(0.0)
-            except (socket.timeout, socket.error, ValueError, BcodeError) as e:
+                # registered once for both directions: the handshake is sent by
+                # connected on the first writable edge, then only reads matter
+                self.poll.register(peer.fd, select.EPOLLIN|select.EPOLLOUT|select.EPOLLPRI|select.EPOLLET)
+            except (socket.error, select.error, IOError, ValueError) as e:
                 if self.debug:
-                    print "handshake fail:%r" % e
-                self.clean_socket(s)
+                    print "register fail:%r" % e
+                self.clean_peer(peer)
                 return False
             return True
 
-    def handle_0(self, s, _): # choke
-        self._am_choking[s] = True
-    def handle_1(self, s, _): # unchoke
-        self._am_choking[s] = False
-        #print "requesting %s pieces for %s" % (self._metadata_pieces_nb, self.info_hash.encode("hex"))
-        try:
-            for i in range(self._metadata_pieces_nb[self._socket_hash[s]]):
-                if self._metadata_pieces[self._socket_hash[s]][i] is None:
-                    self.metadata_request(s, i)
-        except IndexError:
-            pass
-
-    def handle_2(self, s, _): # interested
-        self._peer_interested[s] = True
-    def handle_3(self, s, _): # not interested
-        self._peer_interested[s] = False
-    def handle_4(self, s, _): # have
+    def handle_0(self, peer, _): # choke
+        peer.am_choking = True
+        pieces = self._hash_pieces.get(peer.hash)
+        if pieces is not None and peer.requests:
+            for piece in peer.requests:
+                self._request_timers.remove((peer, piece))
+            pieces.release_peer(peer)
+            self.request_pieces(peer.hash)
+    def handle_1(self, peer, _): # unchoke
+        peer.am_choking = False
+        self.request_pieces(peer.hash)
+
+    def handle_2(self, peer, _): # interested
+        peer.peer_interested = True
+    def handle_3(self, peer, _): # not interested
+        peer.peer_interested = False
+    def handle_4(self, peer, _): # have
         pass
-    def handle_5(self, s, payload):
+    def handle_5(self, peer, payload):
         pass
 
     def most_probably_size(self, hash):
@@ -233,25 +657,31 @@ class Client(object):
                 s_nb = nb
         return s
 
-    def handle_20(self, s, payload): # extension type
+    def handle_20(self, peer, payload): # extension type
         msg_typ = ord(payload[0])
         msg = payload[1:]
+        hash = peer.hash
         if msg_typ == 0:
-            hash = self._socket_hash[s]
             msg = bdecode(msg)
+            if not isinstance(msg, dict) or not isinstance(msg.get('m'), dict) or not 'ut_metadata' in msg['m']:
+                if self.reputation is not None:
+                    self.reputation.no_metadata((peer.ip, peer.port))
+                self.clean_peer(peer)
+                return
             if 'metadata_size' in msg:
                 if msg['metadata_size'] > 8192000 or msg['metadata_size'] < 1: # plus de 8000ko or less thant 1o
-                    self.clean_socket(s)
+                    raise MetaDataToBig()
                 if not msg['metadata_size'] in self._metadata_size_qorum[hash]:
                      self._metadata_size_qorum[hash][msg['metadata_size']] = 1
                 else:
                      self._metadata_size_qorum[hash][msg['metadata_size']]+=1
-                self._peer_metadata[s] = msg['m']['ut_metadata']
+                peer.peer_metadata = msg['m']['ut_metadata']
                 if not hash in self._metadata_size:
                     self._metadata_size[hash] = msg['metadata_size']
                     self._metadata_pieces_nb[hash] = int(math.ceil(self._metadata_size[hash]/(16.0*1024)))
                     self._metadata_pieces[hash] = [None] * self._metadata_pieces_nb[hash]
                     self._metadata_pieces_received[hash] = 0
+                    self._reset_requests(hash)
                 else:
                     mps = self.most_probably_size(hash)
                     if self._metadata_size[hash] < mps:
@@ -259,181 +689,311 @@ class Client(object):
                         self._metadata_pieces[hash] = self._metadata_pieces[hash] + ([None] * (piece_nb - self._metadata_pieces_nb[hash]))
                         self._metadata_size[hash] = mps
                         self._metadata_pieces_nb[hash] = piece_nb
+                        self._reset_requests(hash)
                     elif self._metadata_size[hash] > mps:
                         self._metadata_size[hash] = mps
                         self._metadata_pieces_nb[hash] = int(math.ceil(mps/(16.0*1024)))
                         self._metadata_pieces[hash] = self._metadata_pieces[hash][0:self._metadata_pieces_nb[hash]]
                         self._metadata_pieces_received[hash] = len([i for i in self._metadata_pieces[hash] if i is not None])
+                        self._reset_requests(hash)
 
-                self.interested(s)
+                self.interested(peer)
+                # the peer may have unchoked us before its extended handshake
+                self.request_pieces(hash)
         elif msg_typ == self._am_metadata:
-            hash = self._socket_hash[s]
             msg, data = _bdecode(msg)
             if msg['msg_type'] == 0:
                 if self._metadata_pieces[hash] and msg['piece'] < self._metadata_pieces_nb[hash]:
-                    self.metadata_data(s, msg['piece'])
+                    self.metadata_data(peer, msg['piece'])
                 else:
-                    self.metadata_reject(s, msg['piece'])
+                    self.metadata_reject(peer, msg['piece'])
             elif msg['msg_type'] == 1:
                 try:
                     if msg['piece'] < self._metadata_pieces_nb[hash] and self._metadata_pieces[hash][msg['piece']] is None:
                         self._metadata_pieces[hash][msg['piece']] = data
                         self._metadata_pieces_received[hash] += 1
+                        self._metadata_pieces_source.setdefault(hash, {})[msg['piece']] = (peer.ip, peer.port)
+                        requested_to = self._hash_pieces[hash].received(msg['piece'])
+                        if requested_to is not None:
+                            self._request_timers.remove((requested_to, msg['piece']))
+                        self._peer_timers.add(peer, self.piece_timeout)
+                        if peer.started is not None:
+                            if self.reputation is not None:
+                                self.reputation.metadata_sent((peer.ip, peer.port), time.time() - peer.started)
+                            peer.started = None
                         if self._metadata_pieces_received[hash] == self._metadata_pieces_nb[hash]:
                             metadata = "".join(self._metadata_pieces[hash])
                             if hashlib.sha1(metadata).digest() == hash:
-                                self.meta_data[hash] = metadata
-                                self.clean_hash(hash)
+                                if self.metadata_writer is not None:
+                                    self.metadata_writer.put(hash, metadata)
+                                    self.meta_data[hash] = True
+                                else:
+                                    self.meta_data[hash] = metadata
+                                self.check_suspects(hash)
+                                self._clean_hash(hash)
+                                for callback in self.on_metadata:
+                                    callback(hash)
                                 if self.debug:
                                     print "metadata complete"
                             else:
-                                self.init_hash(hash)
                                 if self.debug:
                                     print "bad metadata %s != %s" % (hashlib.sha1(metadata).hexdigest(), hash.encode("hex"))
+                                self.bad_metadata(hash)
+                        self.request_pieces(hash)
+                    else:
+                        self.pieces_duplicate += 1
                 except (IndexError, TypeError):
                     pass
             elif msg['msg_type'] == 2:
-                pass
+                # rejected, the peer does not have the metadata, ask the others
+                if self.reputation is not None:
+                    self.reputation.no_metadata((peer.ip, peer.port))
+                self.clean_peer(peer)
         else:
             pass
 
-    def recv(self, s):
-        hash = self._socket_hash[s]
-        if hash in self.meta_data:
-            self.clean_socket(s)
-        msgl_old = len(self._socket_toread[s])
-        self._socket_toread[s] += s.recv(4096)
-        msgl = len(self._socket_toread[s])
-        # if read 0B socket closed
-        if msgl_old == msgl:
-            raise socket.error("recv 0 bytes")
-        while self._socket_toread[s]:
-            msg = self._socket_toread[s]
-            msgl = len(msg)
+    def recv(self, peer):
+        """Read everything available on the peer socket and handle the complete messages"""
+        if peer.hash in self.meta_data:
+            self.clean_peer(peer)
+            return
+        if peer.buf is None:
+            peer.buf = bytearray(self.recv_size)
+            peer.view = memoryview(peer.buf)
+        while not peer.closed:
+            if len(peer.buf) - peer.buf_end < self.recv_size:
+                self._buffer_room(peer)
+            try:
+                size = peer.sock.recv_into(peer.view[peer.buf_end:])
+            except socket.error as e:
+                if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    return
+                raise
+            # if read 0B socket closed
+            if size == 0:
+                raise socket.error("recv 0 bytes")
+            peer.buf_end += size
+            if peer.buf_end - peer.buf_start >= peer.buf_need:
+                self.handle_messages(peer)
+
+    def _buffer_room(self, peer):
+        """Move the pending bytes at the start of the peer buffer, resizing it to fit the next message"""
+        pending = peer.buf_end - peer.buf_start
+        size = max(pending + self.recv_size, peer.buf_need)
+        # grow for a big message, shrink once it has been handled. Buffers
+        # fitting a metadata piece are kept as they are reused for the next one
+        if size > len(peer.buf) or (len(peer.buf) > 64 * 1024 and len(peer.buf) > 4 * size):
+            buf = bytearray(max(size, 2 * len(peer.buf)) if size > len(peer.buf) else size)
+            buf[0:pending] = peer.view[peer.buf_start:peer.buf_end]
+            peer.buf = buf
+            peer.view = memoryview(buf)
+        elif pending:
+            peer.buf[0:pending] = peer.buf[peer.buf_start:peer.buf_end]
+        peer.buf_start = 0
+        peer.buf_end = pending
+
+    def handle_messages(self, peer):
+        """Handle the complete messages of the peer buffer, in place"""
+        buf = peer.buf
+        while peer.buf_start < peer.buf_end and not peer.closed:
+            start = peer.buf_start
+            available = peer.buf_end - start
             # if handshake not received
-            if not self._socket_handshake[s]:
-                pstrlen = ord(msg[0])
-                if len(msg) < 1+pstrlen+8+20+20:
-                    raise ToRead()
-                self._socket_handshake[s] = True
-                self._socket_toread[s] = msg[1+pstrlen+8+20+20:]
-                self.handle_handshake(s, msg[:1+pstrlen+8+20+20])
+            if not peer.handshake:
+                length = 1 + buf[start] + 8 + 20 + 20
+                if available < length:
+                    peer.buf_need = length
+                    return
+                peer.handshake = True
+                peer.buf_start += length
+                self.handle_handshake(peer, str(buf[start:start+length]))
             else:
-                if msgl < 4:
-                    raise ToRead()
-                msg_len = struct.unpack("!I", msg[:4])[0]
-                if msgl < msg_len + 4:
-                    raise ToRead()
+                if available < 4:
+                    peer.buf_need = 4
+                    return
+                msg_len = struct.unpack_from("!I", buf, start)[0]
+                if msg_len > self.max_message_size:
+                    raise MetaDataToBig()
+                if available < msg_len + 4:
+                    peer.buf_need = msg_len + 4
+                    return
+                peer.buf_start += 4 + msg_len
                 if msg_len > 0:
-                    msg_typ = ord(msg[4])
-                    paypload = msg[5:4+msg_len]
-                    self._socket_toread[s] = msg[4+msg_len:]
-                    if hasattr(self, "handle_%s" % msg_typ):
-                        getattr(self, "handle_%s" % msg_typ)(s, paypload)
-                else:
-                    self._socket_toread[s] = msg[4:]
-        
-
+                    handler = self._handlers.get(buf[start+4])
+                    if handler is not None:
+                        handler(peer, peer.view[start+5:start+4+msg_len].tobytes())
+        peer.buf_need = 1
 
-    def recv_fixlen(self, s, i):
-        msg = ""
-        msgl = 0
-        while msgl < i:
-            tmp = s.recv(i-msgl)
-            if tmp == "":
-                raise socket.error("recv 0 bytes")
-            msg+=tmp
-            msgl+=len(tmp)
-        return msg
-
-    def handle_handshake(self, s, msg):
+    def handle_handshake(self, peer, msg):
         pstrlen = ord(msg[0])
         pstr = msg[1:1+pstrlen]
         reserved = msg[1+pstrlen:1+pstrlen+8]
-        self._peer_extended[s] = (ord(reserved[5]) & 16) == 16
+        peer.peer_extended = (ord(reserved[5]) & 16) == 16
         info_hash = msg[1+pstrlen+8:1+pstrlen+8+20]
         peer_id = msg[1+pstrlen+8+20:1+pstrlen+8+20+20]
-        if self._peer_extended[s]:
-            self.extended_handshake(s)
+        if peer.peer_extended:
+            self.extended_handshake(peer)
         else:
-            self.clean_socket(s)
+            if self.reputation is not None:
+                self.reputation.not_extended((peer.ip, peer.port))
+            self.clean_peer(peer)
         
-    def handshake(self, s):
+    def handshake(self, peer):
         reserved_bits = ["\0","\0","\0","\0","\0","\0","\0","\0"]
         # advertise Extension Protocol
         reserved_bits[5]= chr(ord(reserved_bits[5]) | ord('\x10'))
         reserved_bits="".join(reserved_bits)
-        msg="%sBitTorrent protocol%s%s%s" % (chr(19), reserved_bits, self._socket_hash[s], self.id)
-        s.send(msg)
+        msg="%sBitTorrent protocol%s%s%s" % (chr(19), reserved_bits, peer.hash, self.id)
+        peer.sock.send(msg)
 
-    def keep_alive(self, s):
+    def keep_alive(self, peer):
         msg=struct.pack("!I", 0)
-        s.send(msg)
+        peer.sock.send(msg)
 
-    def choke(self, s):
+    def choke(self, peer):
         msg=struct.pack("!IB", 1, 0)
-        s.send(msg)
+        peer.sock.send(msg)
 
-    def unckoke(self, s):
+    def unckoke(self, peer):
         msg=struct.pack("!IB", 1, 1)
-        s.send(msg)
+        peer.sock.send(msg)
 
-    def interested(self, s):
-        if self._am_interested[s]:
+    def interested(self, peer):
+        if peer.am_interested:
             raise ValueError("already interested")
         msg=struct.pack("!IB", 1, 2)
-        s.send(msg)
-        self._am_interested[s] = True
+        peer.sock.send(msg)
+        peer.am_interested = True
 
-    def notinterested(self, s):
-        if not self._am_interested[s]:
+    def notinterested(self, peer):
+        if not peer.am_interested:
             raise ValueError("already not interested")
         msg=struct.pack("!IB", 1, 3)
-        s.send(msg)
-        self._am_interested[s] = False
+        peer.sock.send(msg)
+        peer.am_interested = False
 
-    def have(self, s, piece_index):
+    def have(self, peer, piece_index):
         msg=struct.pack("!IBI", 5, 4, piece_index)
-        s.send(msg)
+        peer.sock.send(msg)
 
-    def extended_handshake(self, s):
-        if not self._peer_extended[s]:
+    def extended_handshake(self, peer):
+        if not peer.peer_extended:
             raise ValueError("Peer does not support extension protocol")
         pl = bencode({'m':{'ut_metadata': self._am_metadata}})
         msg=struct.pack("!IBB", 1 + 1 + len(pl), 20, 0)
         msg+=pl
-        s.send(msg)
+        peer.sock.send(msg)
         
 
-    def metadata_request(self, s, piece):
-        if not self._peer_metadata[s]:
+    def metadata_request(self, peer, piece):
+        if not peer.peer_metadata:
             raise ValueError("peer does not support metadata extension")
-        if self._am_choking[s]:
+        if peer.am_choking:
             raise ValueError("chocked")
-        if piece < self._metadata_pieces_nb[self._socket_hash[s]]:
+        if piece < self._metadata_pieces_nb[peer.hash]:
             pl = bencode({'msg_type': 0, 'piece': piece})
-            msg=struct.pack("!IBB", 1 + 1 + len(pl), 20, self._peer_metadata[s])
+            msg=struct.pack("!IBB", 1 + 1 + len(pl), 20, peer.peer_metadata)
             msg+=pl
-            s.send(msg)
+            peer.sock.send(msg)
 
-    def metadata_reject(self, s, piece):
-        if not self._peer_metadata[s]:
+    def metadata_reject(self, peer, piece):
+        if not peer.peer_metadata:
             raise ValueError("peer does not support metadata extension")
-        if self._am_choking[s]:
+        if peer.am_choking:
             raise ValueError("chocked")
         pl = bencode({'msg_type': 2, 'piece': piece})
-        msg=struct.pack("!IBB", 1 + 1 + len(pl), 20, self._peer_metadata[s])
+        msg=struct.pack("!IBB", 1 + 1 + len(pl), 20, peer.peer_metadata)
         msg+=pl
-        s.send(msg)
+        peer.sock.send(msg)
 
-    def metadata_data(self, s, piece):
-        if not self._peer_metadata[s]:
+    def metadata_data(self, peer, piece):
+        if not peer.peer_metadata:
             raise ValueError("peer does not support metadata extension")
-        if self._am_choking[s]:
+        if peer.am_choking:
             raise ValueError("chocked")
-        pl = bencode({'msg_type': 1, 'piece': piece, 'total_size': len(self._metadata_pieces[self._socket_hash[s]][piece])})
-        pl += self._metadata_pieces[self._socket_hash[s]][piece]
-        msg=struct.pack("!IBB", 1 + 1 + len(pl), 20, self._peer_metadata[s])
+        pl = bencode({'msg_type': 1, 'piece': piece, 'total_size': len(self._metadata_pieces[peer.hash][piece])})
+        pl += self._metadata_pieces[peer.hash][piece]
+        msg=struct.pack("!IBB", 1 + 1 + len(pl), 20, peer.peer_metadata)
         msg+=pl
-        s.send(msg)
+        peer.sock.send(msg)
+
+
+class ClientShards(object):
+    """Spread the info_hashs over several clients, each with its own receive loop thread
+
+    Same interface as Client. All the shards share the `meta_data` dict,
+    the `on_metadata` callbacks list and the banned peers, a hash always goes
+    to the same shard. A peer banned by a shard is disconnected by the others
+    from their own receive loop.
+    """
+
+    def __init__(self, clients):
+        self.clients = clients
+        self.meta_data = {}
+        self.on_metadata = []
+        self._banned = {}
+        for client in clients:
+            client.meta_data = self.meta_data
+            client.on_metadata = self.on_metadata
+            client._banned = self._banned
+            client.on_ban.append(self._banned_by(client))
+        self.max_peers_per_hash = clients[0].max_peers_per_hash
+        self.threads = []
+
+    def _banned_by(self, client):
+        def callback(ip, port):
+            for other in self.clients:
+                if other is not client:
+                    other._to_ban.append((ip, port))
+        return callback
+
+    def shard(self, hash):
+        """Return the client of `hash`"""
+        return self.clients[ord(hash[-1]) % len(self.clients)]
+
+    @property
+    def stoped(self):
+        return all(client.stoped for client in self.clients)
+
+    @stoped.setter
+    def stoped(self, value):
+        for client in self.clients:
+            client.stoped = value
+
+    @property
+    def metadata_writer(self):
+        return self.clients[0].metadata_writer
+
+    @metadata_writer.setter
+    def metadata_writer(self, writer):
+        for client in self.clients:
+            client.metadata_writer = writer
 
+    def start(self):
+        for i, client in enumerate(self.clients):
+            client.start()
+            client.threads[-1].setName("Client%s:recv_loop" % i)
+            self.threads.extend(client.threads)
+
+    def stop(self):
+        for client in self.clients:
+            client.stoped = True
+        for client in self.clients:
+            client.stop()
+
+    def add(self, ip, port, hash, priority=1):
+        return self.shard(hash).add(ip, port, hash, priority)
+
+    def clean_hash(self, hash):
+        return self.shard(hash).clean_hash(hash)
+
+    def peers_count(self, hash):
+        return self.shard(hash).peers_count(hash)
+
+    def stats(self):
+        stats = collections.Counter()
+        for client in self.clients:
+            stats.update(client.stats())
+        stats['shards'] = len(self.clients)
+        stats['banned'] = len(self._banned)
+        return dict(stats)
@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+"""A gevent based metadata fetcher, alternative to torrent.Client
+
+Each peer connection is a greenlet with its own Connection state object,
+reading the peer with blocking style (cooperative) socket calls. All the
+greenlets run in one OS thread started by Client.start; `add` and
+`clean_hash` may be called from any thread. Pieces are spread over the
+peers of a hash by torrent.PieceScheduler, as torrent.Client does.
+"""
+import time
+import math
+import struct
+import heapq
+import hashlib
+import itertools
+import collections
+from threading import Thread
+
+import gevent
+import gevent.socket
+from gevent import socket
+
+from btdht.utils import bencode, bdecode, _bdecode, BcodeError, ID
+
+from torrent import PieceScheduler
+
+
+class PeerError(Exception):
+    pass
+
+
+class Connection(object):
+    """State of one peer connection"""
+    __slots__ = ('ip', 'port', 'hash', 'sock', 'greenlet', 'peer_metadata', 'am_choking', 'am_interested', 'started', 'requests', 'timeouts', 'closed')
+
+    def __init__(self, ip, port, hash):
+        self.ip = ip
+        self.port = port
+        self.hash = hash
+        self.sock = None
+        self.greenlet = None
+        self.peer_metadata = False # peer ut_metadata extension id
+        self.am_choking = True
+        self.am_interested = False
+        self.started = time.time() # None once the peer has sent a metadata piece
+        self.requests = set() # pieces requested and not received yet
+        self.timeouts = 0 # pieces requests timed out
+        self.closed = False
+
+
+class Metadata(object):
+    """Metadata download state of one info_hash"""
+    __slots__ = ('size', 'size_qorum', 'pieces', 'received', 'connections', 'scheduler', 'requested_at', 'sources', 'strikes')
+
+    def __init__(self):
+        self.size = None
+        self.size_qorum = {} # size -> nb
+        self.pieces = []
+        self.received = 0
+        self.connections = set()
+        self.scheduler = PieceScheduler([])
+        self.requested_at = {} # piece -> request time
+        self.sources = {} # piece -> (ip, port)
+        self.strikes = {} # (ip, port) -> failed sha1 checks with pieces from it
+
+    def most_probably_size(self):
+        s=0
+        s_nb=0
+        for size, nb in self.size_qorum.items():
+            if nb > s_nb or (nb == s_nb and size < s and size > 0):
+                s = size
+                s_nb = nb
+        return s
+
+    def resize(self, size):
+        pieces_nb = int(math.ceil(size/(16.0*1024)))
+        if pieces_nb > len(self.pieces):
+            self.pieces = self.pieces + [None] * (pieces_nb - len(self.pieces))
+        else:
+            self.pieces = self.pieces[0:pieces_nb]
+        self.size = size
+        self.received = len([p for p in self.pieces if p is not None])
+        self.reset_requests()
+
+    def reset(self):
+        self.resize(self.most_probably_size())
+        self.pieces = [None] * len(self.pieces)
+        self.received = 0
+        self.size_qorum = {self.size: 10}
+        self.sources = {}
+        self.reset_requests()
+
+    def reset_requests(self):
+        """Forget the pending requests, the missing pieces are requested again"""
+        for conn in self.connections:
+            conn.requests.clear()
+        self.scheduler = PieceScheduler([i for i, piece in enumerate(self.pieces) if piece is None])
+        self.requested_at = {}
+
+
+class Client(object):
+    """A gevent torrent client retrieving metadata files, same interface as torrent.Client"""
+
+    _am_metadata = 1
+
+    # peers are closed after this many timed out pieces requests
+    max_peer_timeouts = 3
+    # peers sending bad pieces are not connected to during ban_time seconds
+    ban_time = 3600
+
+    def __init__(self, debug=False, reputation=None, connect_timeout=3, read_timeout=30, max_connections=3000, max_peers_per_hash=8, max_requests_per_peer=4, piece_timeout=10, metadata_writer=None):
+        self.debug = debug
+        # scheduler.PeerReputation where to record the peers outcomes
+        self.reputation = reputation
+        # dirindex.TorrentWriter the completed metadata are handed to
+        self.metadata_writer = metadata_writer
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_connections = max_connections
+        self.max_peers_per_hash = max_peers_per_hash
+        self.max_requests_per_peer = max_requests_per_peer
+        self.piece_timeout = piece_timeout
+        self.meta_data = {} # hash -> bytes, or True once handed to metadata_writer
+        self.on_metadata = []
+        self.threads = []
+        self.stoped = True
+        self.pieces_duplicate = 0
+        self.pieces_timeout = 0
+        self.metadata_mismatch = 0
+        self.pieces_bad = 0
+        self._metadata = {} # hash -> Metadata
+        self._peers = {} # (ip, port, hash) -> Connection
+        self._connections = 0 # greenlets started and not closed
+        self._to_add = collections.deque() # (priority, ip, port, hash) added by others threads
+        # hash -> heap of (priority, -seq, ip, port) of the peers waiting for a slot
+        self._queued = {}
+        self._queued_seq = itertools.count()
+        self._queued_count = 0
+        # hashs with queued peers and less than max_peers_per_hash connections
+        self._ready = collections.OrderedDict()
+        self._to_clean = collections.deque()
+        self._banned = {} # (ip, port) -> ban time, shared by the ClientShards clients
+        # peers banned by another client, to disconnect from the hub thread
+        self._to_ban = collections.deque()
+        # functions called with (ip, port) when a peer is banned
+        self.on_ban = []
+
+    def start(self):
+        self.stoped = False
+        self.id = str(ID())
+        t = Thread(target=self._loop)
+        t.setName("Client:gevent_loop")
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
+
+    def stop(self):
+        self.stoped = True
+        for i in range(60):
+            if not [t for t in self.threads if t.is_alive()]:
+                break
+            time.sleep(1)
+        if [t for t in self.threads if t.is_alive()]:
+            print "Unable to stop threads"
+
+    def add(self, ip, port, hash, priority=1):
+        """Download the metadata of `hash` from the peer (ip, port)
+
+        The peer is queued by the hub thread and connected once less than
+        max_connections are open and less than max_peers_per_hash are open
+        for `hash`, lower `priority` first then the last added first.
+        """
+        if hash in self.meta_data:
+            return True
+        if self.stoped:
+            return None
+        if self.banned(ip, port):
+            return False
+        self._to_add.append((priority, ip, port, hash))
+        return True
+
+    def clean_hash(self, hash):
+        self._to_clean.append(hash)
+
+    def ban(self, ip, port):
+        """Close the connections to (ip, port) and do not connect to it during ban_time seconds"""
+        now = time.time()
+        if len(self._banned) > 100000:
+            for peer, when in self._banned.items():
+                if now - when > self.ban_time:
+                    self._banned.pop(peer, None)
+        self._banned[(ip, port)] = now
+        self.disconnect(ip, port)
+        for callback in self.on_ban:
+            callback(ip, port)
+
+    def disconnect(self, ip, port):
+        """Close the connections to (ip, port), from the hub thread"""
+        current = gevent.getcurrent()
+        for conn in [c for c in self._peers.values() if c is not None and c.ip == ip and c.port == port]:
+            if conn.greenlet is not None and conn.greenlet is not current:
+                conn.greenlet.kill(block=False)
+
+    def banned(self, ip, port):
+        return time.time() - self._banned.get((ip, port), 0) < self.ban_time
+
+    def stats(self):
+        return {
+            'peers': self._connections,
+            'max_connections': self.max_connections,
+            'pending': self._queued_count + len(self._to_add),
+            'hashs': len(self._metadata),
+            'pieces_duplicate': self.pieces_duplicate,
+            'pieces_timeout': self.pieces_timeout,
+            'metadata_mismatch': self.metadata_mismatch,
+            'pieces_bad': self.pieces_bad,
+            'banned': len(self._banned),
+        }
+
+    def peers_count(self, hash):
+        """Return the number of peers connected, connecting or queued for `hash`"""
+        metadata = self._metadata.get(hash)
+        queued = self._queued.get(hash)
+        return (len(metadata.connections) if metadata is not None else 0) + (len(queued) if queued else 0)
+
+    def _loop(self):
+        # the greenlets are started from here so that they all run in this thread hub
+        last_timeouts = time.time()
+        while not self.stoped:
+            while self._to_add:
+                self._queue(*self._to_add.popleft())
+            while self._to_clean:
+                self._clean_hash(self._to_clean.popleft())
+            self._admit()
+            while self._to_ban:
+                self.disconnect(*self._to_ban.popleft())
+            if time.time() - last_timeouts > 0.5:
+                last_timeouts = time.time()
+                self._request_timeouts()
+            gevent.sleep(0.01)
+        for metadata in self._metadata.values():
+            gevent.killall([c.greenlet for c in metadata.connections if c.greenlet is not None], block=False)
+
+    def _queue(self, priority, ip, port, hash):
+        """Queue the peer (ip, port) of `hash` for a connection, from the hub thread"""
+        if hash in self.meta_data or (ip, port, hash) in self._peers:
+            return
+        self._peers[(ip, port, hash)] = None # queued, not connected yet
+        # the hash is registered until _clean_hash
+        metadata = self._metadata.setdefault(hash, Metadata())
+        heapq.heappush(self._queued.setdefault(hash, []), (priority, -next(self._queued_seq), ip, port))
+        self._queued_count += 1
+        if len(metadata.connections) < self.max_peers_per_hash:
+            self._ready[hash] = None
+
+    def _admit(self):
+        """Start the queued connections while the connections budgets allow it"""
+        while self._ready and self._connections < self.max_connections:
+            hash = next(iter(self._ready))
+            metadata = self._metadata[hash]
+            queued = self._queued[hash]
+            while queued and len(metadata.connections) < self.max_peers_per_hash and self._connections < self.max_connections:
+                (_, _, ip, port) = heapq.heappop(queued)
+                self._queued_count -= 1
+                if self.banned(ip, port):
+                    self._peers.pop((ip, port, hash), None)
+                    continue
+                conn = Connection(ip, port, hash)
+                self._peers[(ip, port, hash)] = conn
+                metadata.connections.add(conn)
+                self._connections += 1
+                conn.greenlet = gevent.spawn(self._peer, conn)
+                # a greenlet killed before it started never runs _peer finally clause
+                conn.greenlet.link(lambda g, conn=conn: self._close(conn))
+            if queued and len(metadata.connections) < self.max_peers_per_hash:
+                # out of connections, the hash stays the first served
+                break
+            # empty or waiting for _close to free one of its connections
+            del self._ready[hash]
+            if not queued:
+                del self._queued[hash]
+
+    def _request_timeouts(self):
+        """Request to others peers the pieces not received after piece_timeout seconds"""
+        now = time.time()
+        for metadata in self._metadata.values():
+            expired = [piece for piece, when in metadata.requested_at.items() if now - when > self.piece_timeout]
+            if not expired:
+                continue
+            for piece in expired:
+                del metadata.requested_at[piece]
+                conn = metadata.scheduler.requested.get(piece)
+                if conn is None:
+                    continue
+                self.pieces_timeout += 1
+                conn.timeouts += 1
+                metadata.scheduler.release(piece)
+                if conn.timeouts >= self.max_peer_timeouts and conn.greenlet is not None:
+                    conn.greenlet.kill(block=False)
+            self.request_pieces(metadata)
+
+    def _clean_hash(self, hash):
+        metadata = self._metadata.pop(hash, None)
+        self._ready.pop(hash, None)
+        for (_, _, ip, port) in self._queued.pop(hash, []):
+            self._queued_count -= 1
+            self._peers.pop((ip, port, hash), None)
+        if metadata is None:
+            return
+        current = gevent.getcurrent()
+        for conn in list(metadata.connections):
+            if conn.greenlet is not None and conn.greenlet is not current:
+                conn.greenlet.kill(block=False)
+
+    def _close(self, conn):
+        if conn.closed:
+            return
+        conn.closed = True
+        self._connections -= 1
+        self._peers.pop((conn.ip, conn.port, conn.hash), None)
+        if conn.sock is not None:
+            try: conn.sock.close()
+            except socket.error: pass
+        metadata = self._metadata.get(conn.hash)
+        if metadata is not None:
+            metadata.connections.discard(conn)
+            if self._queued.get(conn.hash):
+                self._ready[conn.hash] = None
+            # give the pieces requested to the peer to the others
+            if conn.requests:
+                metadata.scheduler.release_peer(conn)
+                if not self.stoped:
+                    self.request_pieces(metadata)
+
+    def _recv(self, conn, size):
+        data = []
+        while size > 0:
+            chunk = conn.sock.recv(min(size, 65536))
+            if not chunk:
+                raise PeerError("recv 0 bytes")
+            data.append(chunk)
+            size -= len(chunk)
+        return "".join(data)
+
+    def _send_ext(self, conn, ext_id, payload):
+        conn.sock.sendall(struct.pack("!IBB", 1 + 1 + len(payload), 20, ext_id) + payload)
+
+    def _peer(self, conn):
+        try:
+            try:
+                conn.sock = gevent.socket.create_connection((conn.ip, conn.port), timeout=self.connect_timeout)
+            except (socket.error, socket.timeout):
+                if self.reputation is not None:
+                    self.reputation.connect_failed((conn.ip, conn.port))
+                raise
+            l_onoff = 1
+            l_linger = 0
+            conn.sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', l_onoff, l_linger))
+            conn.sock.settimeout(self.read_timeout)
+            self.handshake(conn)
+            while not self.stoped:
+                msg_len = struct.unpack("!I", self._recv(conn, 4))[0]
+                if msg_len == 0: # keep alive
+                    continue
+                if msg_len > 16 * 1024 + 1024:
+                    raise PeerError("message too long")
+                msg = self._recv(conn, msg_len)
+                msg_typ = ord(msg[0])
+                if msg_typ == 0: # choke
+                    conn.am_choking = True
+                    metadata = self._metadata.get(conn.hash)
+                    if metadata is not None and conn.requests:
+                        metadata.scheduler.release_peer(conn)
+                        self.request_pieces(metadata)
+                elif msg_typ == 1: # unchoke
+                    conn.am_choking = False
+                    metadata = self._metadata.get(conn.hash)
+                    if metadata is not None:
+                        self.request_pieces(metadata)
+                elif msg_typ == 20:
+                    if self.handle_20(conn, msg[1:]):
+                        return
+        except (socket.error, socket.timeout, PeerError, BcodeError, ValueError, KeyError, TypeError, IndexError) as e:
+            if self.debug:
+                print "%s:%s %r" % (conn.ip, conn.port, e)
+        finally:
+            self._close(conn)
+
+    def handshake(self, conn):
+        reserved_bits = ["\0","\0","\0","\0","\0","\0","\0","\0"]
+        # advertise Extension Protocol
+        reserved_bits[5]= chr(ord(reserved_bits[5]) | ord('\x10'))
+        conn.sock.sendall("%sBitTorrent protocol%s%s%s" % (chr(19), "".join(reserved_bits), conn.hash, self.id))
+        pstrlen = ord(self._recv(conn, 1))
+        msg = self._recv(conn, pstrlen + 8 + 20 + 20)
+        reserved = msg[pstrlen:pstrlen+8]
+        if not (ord(reserved[5]) & 16) == 16:
+            if self.reputation is not None:
+                self.reputation.not_extended((conn.ip, conn.port))
+            raise PeerError("Peer does not support extension protocol")
+        pl = bencode({'m':{'ut_metadata': self._am_metadata}})
+        self._send_ext(conn, 0, pl)
+
+    def request_pieces(self, metadata):
+        """Request the missing pieces of `metadata` to its peers, the least loaded first"""
+        if not metadata.scheduler.missing:
+            return
+        conns = [c for c in metadata.connections if c.peer_metadata and not c.am_choking and not c.closed]
+        conns.sort(key=lambda c: (c.timeouts, len(c.requests)))
+        now = time.time()
+        for conn in conns:
+            for piece in metadata.scheduler.assign(conn, self.max_requests_per_peer):
+                metadata.requested_at[piece] = now
+                try:
+                    self._send_ext(conn, conn.peer_metadata, bencode({'msg_type': 0, 'piece': piece}))
+                except socket.error:
+                    # its greenlet fails on the closed socket and releases its pieces
+                    try: conn.sock.close()
+                    except socket.error: pass
+                    break
+            if not metadata.scheduler.missing:
+                return
+
+    def handle_20(self, conn, payload):
+        """Handle an extension message, return True if the metadata is complete"""
+        msg_typ = ord(payload[0])
+        msg = payload[1:]
+        metadata = self._metadata.get(conn.hash)
+        if metadata is None:
+            return True
+        if msg_typ == 0:
+            msg = bdecode(msg)
+            if not isinstance(msg, dict) or not isinstance(msg.get('m'), dict):
+                raise PeerError("bad extended handshake")
+            if 'metadata_size' in msg:
+                if msg['metadata_size'] > 8192000 or msg['metadata_size'] < 1: # plus de 8000ko or less thant 1o
+                    raise PeerError("metadata_size %s" % msg['metadata_size'])
+                metadata.size_qorum[msg['metadata_size']] = metadata.size_qorum.get(msg['metadata_size'], 0) + 1
+                conn.peer_metadata = msg['m']['ut_metadata']
+                if metadata.size is None:
+                    metadata.resize(msg['metadata_size'])
+                elif metadata.size != metadata.most_probably_size():
+                    metadata.resize(metadata.most_probably_size())
+                if not conn.am_interested:
+                    conn.sock.sendall(struct.pack("!IB", 1, 2))
+                    conn.am_interested = True
+                self.request_pieces(metadata)
+        elif msg_typ == self._am_metadata:
+            msg, data = _bdecode(msg)
+            if msg['msg_type'] == 0:
+                piece = msg['piece']
+                if piece < len(metadata.pieces) and metadata.pieces[piece] is not None and conn.peer_metadata:
+                    pl = bencode({'msg_type': 1, 'piece': piece, 'total_size': len(metadata.pieces[piece])})
+                    self._send_ext(conn, conn.peer_metadata, pl + metadata.pieces[piece])
+                elif conn.peer_metadata:
+                    self._send_ext(conn, conn.peer_metadata, bencode({'msg_type': 2, 'piece': piece}))
+            elif msg['msg_type'] == 1:
+                piece = msg['piece']
+                if piece < len(metadata.pieces) and metadata.pieces[piece] is None:
+                    metadata.pieces[piece] = data
+                    metadata.received += 1
+                    metadata.sources[piece] = (conn.ip, conn.port)
+                    metadata.scheduler.received(piece)
+                    metadata.requested_at.pop(piece, None)
+                    if conn.started is not None:
+                        if self.reputation is not None:
+                            self.reputation.metadata_sent((conn.ip, conn.port), time.time() - conn.started)
+                        conn.started = None
+                    if metadata.received == len(metadata.pieces):
+                        return self.metadata_complete(conn.hash, metadata)
+                    self.request_pieces(metadata)
+                else:
+                    self.pieces_duplicate += 1
+            elif msg['msg_type'] == 2:
+                # the peer does not have the metadata
+                if self.reputation is not None:
+                    self.reputation.no_metadata((conn.ip, conn.port))
+                return True
+        return False
+
+    def metadata_complete(self, hash, metadata):
+        data = "".join(metadata.pieces)
+        if hashlib.sha1(data).digest() == hash:
+            if self.metadata_writer is not None:
+                self.metadata_writer.put(hash, data)
+                self.meta_data[hash] = True
+            else:
+                self.meta_data[hash] = data
+            self._clean_hash(hash)
+            for callback in self.on_metadata:
+                callback(hash)
+            if self.debug:
+                print "metadata complete"
+            return True
+        else:
+            self.metadata_mismatch += 1
+            if self.debug:
+                print "bad metadata %s != %s" % (hashlib.sha1(data).hexdigest(), hash.encode("hex"))
+            sources = set(metadata.sources.values())
+            for source in sources:
+                metadata.strikes[source] = metadata.strikes.get(source, 0) + 1
+            metadata.reset()
+            if len(sources) == 1:
+                # a single peer sent all the pieces, ban it on its second strike
+                source = sources.pop()
+                if metadata.strikes[source] >= 2:
+                    self.pieces_bad += 1
+                    self.ban(*source)
+                    return True
+            self.request_pieces(metadata)
+            return False